@@ -0,0 +1,232 @@
+import os
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from peft.tuners.lora import LoraLayer
+
+# Adapter name PEFT uses for rows that should run on the plain base model.
+BASE_ADAPTER_NAME = '__base__'
+
+
+class AdapterManager:
+    """
+    Keeps LoRA adapters resident on the shared base model and switches between
+    them with `set_adapter` instead of loading/deleting them on every request.
+    Adapters are evicted in LRU order once the configured budget is exceeded.
+    """
+    def __init__(self, config: dict = None):
+        """
+        :param config: The 'adapter_cache' section of the config.yaml.
+        """
+        config = config or {}
+        self.max_resident = int(config.get('max_resident', 8))
+        self.memory_budget_bytes = int(float(config.get('memory_budget_mb', 2048)) * 1024 * 1024)
+        self.pinned = set(config.get('pinned', ['router']))
+
+        self._resident = OrderedDict()  # adapter_name -> {'path': ..., 'bytes': ...}
+        self._paths = {}  # adapter_name -> path, kept after eviction so `acquire` can reload
+        self._active = None
+        self._in_use = Counter()
+        self._refused = set()
+        self._eviction_listeners = []
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _adapter_bytes(self, model, adapter_name: str, adapter_path: str) -> int:
+        """Measures the memory used by an adapter's LoRA weights on the model."""
+        marker = f".{adapter_name}."
+        total = 0
+        for name, param in model.named_parameters():
+            if marker in name:
+                total += param.numel() * param.element_size()
+        if total:
+            return total
+        # Fall back to the on-disk size if the parameter names could not be matched.
+        for filename in ('adapter_model.safetensors', 'adapter_model.bin'):
+            file_path = os.path.join(adapter_path, filename)
+            if os.path.exists(file_path):
+                return os.path.getsize(file_path)
+        return 0
+
+    def _resident_bytes(self) -> int:
+        return sum(entry['bytes'] for entry in self._resident.values())
+
+    def _evict_one(self, model, protected: str) -> bool:
+        """Evicts the least recently used adapter that is neither pinned nor protected."""
+        for name in self._resident:
+            if name == protected or name in self.pinned or self._in_use[name]:
+                continue
+            print(f"[Adapter Manager] Evicting adapter '{name}' (LRU).")
+            model.delete_adapter(name)
+            del self._resident[name]
+            if self._active == name:
+                # PEFT switches to another resident adapter when the active one is deleted,
+                # so turn adapters off to match `_active` being the base model again.
+                model.disable_adapters()
+                self._active = None
+            self.evictions += 1
+            for listener in self._eviction_listeners:
+                listener(name)
+            return True
+        return False
+
+    def _enforce_budget(self, model, protected: str):
+        while len(self._resident) > self.max_resident or self._resident_bytes() > self.memory_budget_bytes:
+            if not self._evict_one(model, protected):
+                print("[Adapter Manager] WARNING: Adapter budget exceeded but nothing left to evict.")
+                break
+
+    def add_eviction_listener(self, callback):
+        """Registers `callback(adapter_name)` to be called whenever an adapter is evicted."""
+        self._eviction_listeners.append(callback)
+
+    def ensure(self, model, adapter_name: str, adapter_path: str):
+        """
+        Makes sure an adapter is resident on the model, loading it from disk on a miss.
+        Returns the adapter name, or None if the adapter is unavailable and the base
+        model should be used instead.
+        """
+        with self._lock:
+            if adapter_name in self._resident:
+                self._resident.move_to_end(adapter_name)
+                self.hits += 1
+                return adapter_name
+
+            if not getattr(model, 'supports_lora_adapters', True):
+                if adapter_name not in self._refused:
+                    print(f"[Adapter Manager] WARNING: The 'cpu-int8-dynamic' precision profile can't run LoRA adapters. Agent '{adapter_name}' uses the base model.")
+                    self._refused.add(adapter_name)
+                return None
+
+            if not os.path.isdir(adapter_path):
+                print(f"[Adapter Manager] WARNING: Adapter '{adapter_name}' not found at '{adapter_path}'. Using base model.")
+                return None
+
+            self.misses += 1
+            try:
+                print(f"[Adapter Manager] Loading adapter '{adapter_name}' from: {adapter_path}")
+                model.load_adapter(adapter_path, adapter_name=adapter_name)
+            except Exception as e:
+                print(f"[Adapter Manager] ERROR: Failed to load adapter from '{adapter_path}'. Error: {e}")
+                return None
+
+            # Loading can make the new adapter the active one; keep the model on `_active`.
+            if self._active is None:
+                model.disable_adapters()
+            else:
+                model.set_adapter(self._active)
+            self._paths[adapter_name] = adapter_path
+            self._resident[adapter_name] = {
+                'path': adapter_path,
+                'bytes': self._adapter_bytes(model, adapter_name, adapter_path),
+            }
+            self._enforce_budget(model, protected=adapter_name)
+            return adapter_name
+
+    def activate(self, model, adapter_name: str = None):
+        """Switches the model to a resident adapter, or to the plain base model if None."""
+        with self._lock:
+            if adapter_name == self._active:
+                return
+            if adapter_name is None:
+                if self._resident:
+                    model.disable_adapters()
+            else:
+                if adapter_name not in self._resident:
+                    raise ValueError(f"Adapter '{adapter_name}' is not resident. Call ensure() first.")
+                model.set_adapter(adapter_name)
+                model.enable_adapters()
+            self._active = adapter_name
+
+    def acquire(self, model, adapter_name: str):
+        """
+        `ensure` and `retain` in one step, so the adapter can't be evicted in between;
+        an adapter evicted since it was last ensured is loaded again. Returns the
+        adapter name (retained), or None if it is unavailable and the base model
+        should be used instead.
+        """
+        if not adapter_name:
+            return None
+        with self._lock:
+            adapter_path = self._resident[adapter_name]['path'] if adapter_name in self._resident else self._paths.get(adapter_name)
+            if adapter_path is None or self.ensure(model, adapter_name, adapter_path) is None:
+                return None
+            self._in_use[adapter_name] += 1
+            return adapter_name
+
+    def retain(self, adapter_name: str):
+        """Marks an adapter as used by an in-flight sequence so it is never evicted under it."""
+        if adapter_name:
+            with self._lock:
+                self._in_use[adapter_name] += 1
+
+    def release(self, adapter_name: str):
+        if adapter_name:
+            with self._lock:
+                self._in_use[adapter_name] -= 1
+                if self._in_use[adapter_name] <= 0:
+                    del self._in_use[adapter_name]
+
+    @contextmanager
+    def per_row_adapters(self, model, adapter_names: list):
+        """
+        Runs the forward passes inside the block with a separate adapter for every row
+        of the batch (None for the base model). PEFT's LoRA layers apply each adapter's
+        delta only to its own rows, so sequences for different agents share one forward.
+        """
+        with self._lock:
+            if not self._resident:
+                yield
+                return
+
+            names = [name or BASE_ADAPTER_NAME for name in adapter_names]
+
+            def inject_adapter_names(module, args, kwargs):
+                kwargs['adapter_names'] = names
+                return args, kwargs
+
+            if self._active is None:
+                model.enable_adapters()
+            handles = [
+                module.register_forward_pre_hook(inject_adapter_names, with_kwargs=True)
+                for module in model.modules() if isinstance(module, LoraLayer)
+            ]
+            try:
+                yield
+            finally:
+                for handle in handles:
+                    handle.remove()
+                if self._active is None:
+                    model.disable_adapters()
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and the current residency for reporting."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'resident': list(self._resident.keys()),
+                'resident_mb': round(self._resident_bytes() / (1024 * 1024), 1),
+                'active': self._active,
+            }
+
+
+ADAPTER_MANAGER = None
+
+def init_adapter_manager(config: dict = None) -> AdapterManager:
+    """Creates the process-wide adapter manager from the 'adapter_cache' config section."""
+    global ADAPTER_MANAGER
+    ADAPTER_MANAGER = AdapterManager(config)
+    return ADAPTER_MANAGER
+
+def get_adapter_manager() -> AdapterManager:
+    """Returns the process-wide adapter manager, creating one with defaults if needed."""
+    if ADAPTER_MANAGER is None:
+        return init_adapter_manager()
+    return ADAPTER_MANAGER
@@ -0,0 +1,434 @@
+import contextlib
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from transformers import DynamicCache
+
+from app.adapter_manager import get_adapter_manager
+from app.prefix_cache import get_prefix_cache, cache_layers, cache_from_layers
+from app.llm_inference import stop_string_in_tail
+
+
+class GenerationRequest:
+    """A single sequence submitted to the BatchingEngine."""
+    def __init__(self, input_ids: list, max_new_tokens: int, temperature: float, top_p: float, adapter_name: str = None, prefix_len: int = 0, stop_strings: list = None, stopping_criteria: list = None):
+        self.input_ids = list(input_ids)
+        self.prefix_len = prefix_len
+        self.stop_strings = list(stop_strings or [])
+        self.stopping_criteria = list(stopping_criteria or [])
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.adapter_name = adapter_name
+        self.generated = []
+        self.error = None
+        self.cancelled = False
+        self.submitted_at = time.time()
+        self._tokens = queue.Queue()
+        self._done = threading.Event()
+
+    def _push(self, token_id: int):
+        self.generated.append(token_id)
+        self._tokens.put(token_id)
+
+    def _finish(self, error: Exception = None):
+        self.error = error
+        self._done.set()
+        self._tokens.put(None)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self):
+        """Asks the engine to retire the sequence at its next step, e.g. because nobody reads it anymore."""
+        self.cancelled = True
+
+    def result(self, timeout: float = None) -> list:
+        """Blocks until the sequence is finished and returns the generated token ids."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation request did not finish in time.")
+        if self.error:
+            raise self.error
+        return list(self.generated)
+
+    def stream(self) -> iter:
+        """Yields generated token ids as soon as the engine produces them."""
+        while True:
+            token_id = self._tokens.get()
+            if token_id is None:
+                break
+            yield token_id
+        if self.error:
+            raise self.error
+
+
+def _sample(logits: torch.Tensor, temperatures: torch.Tensor, top_ps: torch.Tensor) -> torch.Tensor:
+    """Per-row temperature and nucleus sampling over a [batch, vocab] logits tensor."""
+    logits = torch.nan_to_num(logits.float(), nan=-1e9, posinf=1e9, neginf=-1e9)
+    logits = logits / temperatures.clamp(min=1e-5).unsqueeze(1)
+    probs = torch.softmax(logits, dim=-1)
+
+    sorted_probs, sorted_idx = torch.sort(probs, descending=True, dim=-1)
+    cumulative = torch.cumsum(sorted_probs, dim=-1)
+    remove = (cumulative - sorted_probs) > top_ps.unsqueeze(1)
+    sorted_probs = sorted_probs.masked_fill(remove, 0.0)
+    sorted_probs = sorted_probs / sorted_probs.sum(dim=-1, keepdim=True)
+
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    return sorted_idx.gather(-1, choice).squeeze(1)
+
+
+def _cache_to_layers(cache) -> list:
+    if isinstance(cache, (tuple, list)):
+        return [tuple(layer) for layer in cache]
+    return cache_layers(cache)
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = missing
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=dim)
+
+
+class BatchingEngine:
+    """
+    Continuous batching scheduler that owns the shared MODEL/TOKENIZER.
+    New requests are prefilled and merged into the running decode batch between
+    decode steps, and finished sequences are retired without stalling the rest.
+    All model access (including adapter loading) happens on the engine thread.
+    """
+    def __init__(self, model, tokenizer, config: dict = None):
+        """
+        :param config: The 'inference' section of the config.yaml.
+        """
+        config = config or {}
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = int(config.get('max_batch_size', 8))
+        self.adapter_switch_after_s = float(config.get('adapter_switch_after_s', 2.0))
+        self.mixed_adapter_batches = config.get('mixed_adapter_batches', True)
+        self.device = model.device
+
+        eos = model.generation_config.eos_token_id
+        if eos is None:
+            eos = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+
+        self._pending = queue.Queue()
+        self._waiting = []
+        self._calls = queue.Queue()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+        self._rows = []
+        self._layers = None
+        self._attention_mask = None
+        self._next_tokens = None
+        self._batch_adapter = None
+
+        self.steps = 0
+        self.tokens_generated = 0
+        self.started_at = None
+
+    def start(self):
+        self._running = True
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._loop, name="batching-engine", daemon=True)
+        self._thread.start()
+        print(f"[Batching Engine] Started with max_batch_size={self.max_batch_size}, mixed_adapter_batches={self.mixed_adapter_batches}.")
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def submit(self, input_ids: list, max_new_tokens: int = 1024, temperature: float = 0.7, top_p: float = 0.9, adapter_name: str = None, prefix_len: int = 0, stop_strings: list = None, stopping_criteria: list = None) -> GenerationRequest:
+        """
+        Queues a sequence for generation and returns its request handle.
+        The first `prefix_len` tokens are served from the prefix cache when possible.
+        The sequence retires as soon as one of `stop_strings` or `stopping_criteria` fires.
+        Stopping criteria only get the newest token, which is enough for signals like
+        cancellation; stop strings are checked against the decoded tail of the sequence.
+        """
+        request = GenerationRequest(input_ids, max_new_tokens, temperature, top_p, adapter_name, prefix_len, stop_strings, stopping_criteria)
+        self._pending.put(request)
+        self._wakeup.set()
+        return request
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Runs `fn(model, tokenizer, *args, **kwargs)` on the engine thread between decode
+        steps and returns its result. Use this for anything that touches the model.
+        """
+        future = Future()
+        self._calls.put((future, fn, args, kwargs))
+        self._wakeup.set()
+        return future.result()
+
+    def stats(self) -> dict:
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        return {
+            'active_sequences': len(self._rows),
+            'pending_requests': self._pending.qsize() + len(self._waiting),
+            'decode_steps': self.steps,
+            'tokens_generated': self.tokens_generated,
+            'tokens_per_second': round(self.tokens_generated / elapsed, 2) if elapsed else 0.0,
+        }
+
+    def _loop(self):
+        while self._running:
+            try:
+                self._run_calls()
+
+                while True:
+                    try:
+                        self._waiting.append(self._pending.get_nowait())
+                    except queue.Empty:
+                        break
+                self._admit_waiting()
+            except Exception as e:
+                # Never let the engine thread die: every waiting caller would hang forever.
+                print(f"[Batching Engine] ERROR in engine loop: {e}")
+                self._fail_batch(e)
+
+            if not self._rows:
+                if not self._waiting:
+                    self._wakeup.wait(timeout=1.0)
+                    self._wakeup.clear()
+                continue
+
+            try:
+                self._decode_step()
+            except Exception as e:
+                print(f"[Batching Engine] ERROR during decode step: {e}")
+                self._fail_batch(e)
+
+    def _admit_waiting(self):
+        """
+        Admits waiting requests into the running batch. With mixed adapter batches every
+        row carries its own adapter. Otherwise set_adapter is global, so a batch only
+        holds one adapter; once a request for another adapter has waited longer than
+        `adapter_switch_after_s`, the batch is drained so it can switch.
+        """
+        if self.mixed_adapter_batches:
+            while self._waiting and len(self._rows) < self.max_batch_size:
+                self._admit(self._waiting.pop(0))
+            return
+
+        if self._rows and self._waiting:
+            oldest = self._waiting[0]
+            if oldest.adapter_name != self._batch_adapter and time.time() - oldest.submitted_at > self.adapter_switch_after_s:
+                return
+
+        for request in list(self._waiting):
+            if len(self._rows) >= self.max_batch_size:
+                break
+            if self._rows and request.adapter_name != self._batch_adapter:
+                continue
+            self._waiting.remove(request)
+            self._admit(request)
+
+    def _run_calls(self):
+        ran_any = False
+        while True:
+            try:
+                future, fn, args, kwargs = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            ran_any = True
+            try:
+                with torch.no_grad():
+                    future.set_result(fn(self.model, self.tokenizer, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        if ran_any and self._rows and not self.mixed_adapter_batches:
+            try:
+                get_adapter_manager().activate(self.model, self._batch_adapter)
+            except Exception as e:
+                print(f"[Batching Engine] ERROR: Could not restore adapter '{self._batch_adapter}': {e}")
+                self._fail_batch(e)
+
+    def _fail_batch(self, error: Exception):
+        for request in self._rows:
+            self._finish(request, error)
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self._rows = []
+        self._layers = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _adapters_for(self, requests: list):
+        """Context for a forward pass over `requests`, applying each row's own adapter if mixing."""
+        if self.mixed_adapter_batches:
+            return get_adapter_manager().per_row_adapters(self.model, [r.adapter_name for r in requests])
+        return contextlib.nullcontext()
+
+    def _finish(self, request: GenerationRequest, error: Exception = None):
+        if request.done:
+            return
+        get_adapter_manager().release(request.adapter_name)
+        request._finish(error)
+
+    def _is_finished(self, request: GenerationRequest, token_id: int) -> bool:
+        if request.cancelled or token_id in self.eos_token_ids or len(request.generated) >= request.max_new_tokens:
+            return True
+        if request.stop_strings and stop_string_in_tail(self.tokenizer, request.generated, request.stop_strings):
+            return True
+        if request.stopping_criteria:
+            # Rebuilding the whole sequence every step would make long generations quadratic.
+            newest = torch.tensor([[token_id]])
+            return any(bool(criteria(newest, None).all()) for criteria in request.stopping_criteria)
+        return False
+
+    @torch.no_grad()
+    def _admit(self, request: GenerationRequest):
+        """Prefills a new sequence and merges its KV cache into the running batch."""
+        if request.cancelled:
+            request._finish()
+            return
+        # Retained before anything else, so the adapter can't be evicted while a row uses it.
+        # An adapter evicted after the worker ensured it is loaded again; if that fails, the
+        # sequence runs on the base model like any request whose adapter is unavailable.
+        adapter_name = get_adapter_manager().acquire(self.model, request.adapter_name)
+        if adapter_name != request.adapter_name:
+            print(f"[Batching Engine] WARNING: Adapter '{request.adapter_name}' is unavailable. Using base model.")
+            request.adapter_name = adapter_name
+
+        try:
+            if not self._rows and not self.mixed_adapter_batches:
+                get_adapter_manager().activate(self.model, request.adapter_name)
+                self._batch_adapter = request.adapter_name
+            input_ids = torch.tensor([request.input_ids], device=self.device)
+            with self._adapters_for([request]):
+                cache = None
+                if request.prefix_len:
+                    cache = get_prefix_cache().get(self.model, request.adapter_name, request.input_ids[:request.prefix_len])
+                start = cache.get_seq_length() if cache is not None else 0
+                outputs = self.model(
+                    input_ids=input_ids[:, start:],
+                    attention_mask=torch.ones_like(input_ids),
+                    cache_position=torch.arange(start, input_ids.shape[1], device=self.device),
+                    past_key_values=cache if cache is not None else DynamicCache(),
+                    use_cache=True
+                )
+        except Exception as e:
+            print(f"[Batching Engine] ERROR during prefill: {e}")
+            self._finish(request, e)
+            return
+
+        try:
+            self._merge_prefill(request, outputs, input_ids)
+        except Exception as e:
+            # A half-merged cache would corrupt every row, so the whole batch is failed.
+            print(f"[Batching Engine] ERROR while merging a new sequence into the batch: {e}")
+            self._finish(request, e)
+            self._fail_batch(e)
+
+    def _merge_prefill(self, request: GenerationRequest, outputs, input_ids: torch.Tensor):
+        token = _sample(
+            outputs.logits[:, -1, :],
+            torch.tensor([request.temperature], device=self.device),
+            torch.tensor([request.top_p], device=self.device)
+        )
+        token_id = int(token[0])
+        request._push(token_id)
+        self.tokens_generated += 1
+        if self._is_finished(request, token_id):
+            self._finish(request)
+            return
+
+        new_layers = _cache_to_layers(outputs.past_key_values)
+        new_mask = torch.ones((1, input_ids.shape[1]), dtype=torch.long, device=self.device)
+
+        if not self._rows:
+            self._layers = new_layers
+            self._attention_mask = new_mask
+            self._next_tokens = token
+        else:
+            merged = []
+            for (k_old, v_old), (k_new, v_new) in zip(self._layers, new_layers):
+                length = max(k_old.shape[2], k_new.shape[2])
+                merged.append((
+                    torch.cat([_left_pad(k_old, length, 2), _left_pad(k_new, length, 2)], dim=0),
+                    torch.cat([_left_pad(v_old, length, 2), _left_pad(v_new, length, 2)], dim=0),
+                ))
+            self._layers = merged
+            length = max(self._attention_mask.shape[1], new_mask.shape[1])
+            self._attention_mask = torch.cat([
+                _left_pad(self._attention_mask, length, 1),
+                _left_pad(new_mask, length, 1)
+            ], dim=0)
+            self._next_tokens = torch.cat([self._next_tokens, token], dim=0)
+        self._rows.append(request)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        """Runs one decode step for every active sequence and retires finished ones."""
+        attention_mask = torch.cat([
+            self._attention_mask,
+            self._attention_mask.new_ones((len(self._rows), 1))
+        ], dim=1)
+        position_ids = (attention_mask.sum(dim=1, keepdim=True) - 1).clamp(min=0)
+        cache = cache_from_layers(self._layers)
+        cache_position = torch.tensor([cache.get_seq_length()], device=self.device)
+
+        with self._adapters_for(self._rows):
+            outputs = self.model(
+                input_ids=self._next_tokens.unsqueeze(1),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                cache_position=cache_position,
+                past_key_values=cache,
+                use_cache=True
+            )
+        self.steps += 1
+
+        temperatures = torch.tensor([r.temperature for r in self._rows], device=self.device)
+        top_ps = torch.tensor([r.top_p for r in self._rows], device=self.device)
+        tokens = _sample(outputs.logits[:, -1, :], temperatures, top_ps)
+
+        self._layers = _cache_to_layers(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self._next_tokens = tokens
+
+        keep = []
+        for row, request in enumerate(self._rows):
+            token_id = int(tokens[row])
+            request._push(token_id)
+            self.tokens_generated += 1
+            if self._is_finished(request, token_id):
+                self._finish(request)
+            else:
+                keep.append(row)
+
+        if len(keep) == len(self._rows):
+            return
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self._rows = [self._rows[row] for row in keep]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._layers = [(k.index_select(0, index), v.index_select(0, index)) for k, v in self._layers]
+
+        # Drop left columns that are now padding for every remaining row.
+        padding = int((self._attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        if padding:
+            self._attention_mask = self._attention_mask[:, padding:]
+            self._layers = [
+                (k[:, :, max(0, k.shape[2] - self._attention_mask.shape[1]):], v[:, :, max(0, v.shape[2] - self._attention_mask.shape[1]):])
+                for k, v in self._layers
+            ]
@@ -0,0 +1,70 @@
+import time
+from contextlib import contextmanager
+
+from app.llm_inference import generate_response_stream, load_base_model_and_tokenizer
+from app.cpu_affinity import apply_cpu_partition
+
+BENCH_PROMPTS = [
+    "What is the capital of France? Answer in one sentence.",
+    "Explain the difference between a process and a thread.",
+    "Write a short Python function that checks whether a string is a palindrome.",
+    "Summarize the benefits of unit testing in three bullet points.",
+    "What should I consider when choosing a database for a new web application?",
+]
+
+
+@contextmanager
+def count_forward_calls(model):
+    """Counts the forward passes of `model` inside the block; yields a one-element list."""
+    calls = [0]
+
+    def hook(module, args, output):
+        calls[0] += 1
+
+    handle = model.register_forward_hook(hook)
+    try:
+        yield calls
+    finally:
+        handle.remove()
+
+def measure_generation(model, tokenizer, prompts: list, max_new_tokens: int = 128, adapter_name: str = None, **kwargs) -> dict:
+    """
+    Runs every prompt through `generate_response_stream` and reports mean time to
+    first token, decode throughput and how many tokens each target forward produced.
+    """
+    ttfts, durations, token_counts, forward_counts = [], [], [], []
+    for prompt in prompts:
+        with count_forward_calls(model) as calls:
+            start = time.perf_counter()
+            first_token_at = None
+            text = ""
+            for chunk in generate_response_stream(model, tokenizer, prompt_text=prompt, max_new_tokens=max_new_tokens, adapter_name=adapter_name, **kwargs):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter() - start
+                text += chunk
+            durations.append(time.perf_counter() - start)
+        ttfts.append(first_token_at or durations[-1])
+        token_counts.append(len(tokenizer(text, add_special_tokens=False)["input_ids"]))
+        forward_counts.append(calls[0])
+
+    total_tokens = sum(token_counts)
+    return {
+        'ttft_ms': round(1000 * sum(ttfts) / len(ttfts), 1),
+        'tokens_per_s': round(total_tokens / sum(durations), 2) if sum(durations) else 0.0,
+        'tokens': total_tokens,
+        'tokens_per_forward': round(total_tokens / max(sum(forward_counts), 1), 3),
+    }
+
+def cpu_bench_worker(base_model: str, precision: str, cores: list, interop_threads: int, prompts: list, max_new_tokens: int, barrier) -> dict:
+    """
+    One process of the CPU throughput benchmark: pins itself to `cores`, loads the model,
+    waits for the other processes and then generates, so all of them decode concurrently.
+    """
+    apply_cpu_partition(cores, interop_threads)
+    model, tokenizer = load_base_model_and_tokenizer(base_model, precision)
+    measure_generation(model, tokenizer, prompts[:1], max_new_tokens=8)
+    barrier.wait()
+    start = time.perf_counter()
+    result = measure_generation(model, tokenizer, prompts, max_new_tokens)
+    result['duration_s'] = time.perf_counter() - start
+    return result
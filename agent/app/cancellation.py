@@ -0,0 +1,76 @@
+import time
+
+import redis
+import torch
+from transformers import StoppingCriteria
+
+from app.redis_client import get_redis_client, get_async_redis_client
+
+
+def cancel_key(job_id: str) -> str:
+    return f"cancel:{job_id}"
+
+def is_job_cancelled(redis_client, job_id: str) -> bool:
+    """Returns True if the web app has marked the job as cancelled."""
+    try:
+        return bool(redis_client.exists(cancel_key(job_id)))
+    except redis.exceptions.RedisError as e:
+        print(f"[Cancellation] WARNING: Could not check cancellation for job {job_id}: {e}")
+        return False
+
+async def is_job_cancelled_async(redis_client, job_id: str) -> bool:
+    """`is_job_cancelled` for an asyncio Redis client."""
+    try:
+        return bool(await redis_client.exists(cancel_key(job_id)))
+    except redis.exceptions.RedisError as e:
+        print(f"[Cancellation] WARNING: Could not check cancellation for job {job_id}: {e}")
+        return False
+
+
+class CancellationCriteria(StoppingCriteria):
+    """
+    Stops generation once the job's `cancel:{job_id}` key is set, e.g. because the
+    browser closed the stream or the request timed out. Redis is polled at most every
+    `check_interval_s` so the check stays off the decode hot path.
+    """
+    def __init__(self, job_id: str, check_interval_s: float = 0.5):
+        self.job_id = job_id
+        self.check_interval_s = check_interval_s
+        self.cancelled = False
+        self._last_check = 0.0
+        self._redis = None
+
+    def __getstate__(self):
+        # Sent to the inference server in server mode; the connection is recreated there.
+        state = self.__dict__.copy()
+        state['_redis'] = None
+        return state
+
+    def check(self) -> bool:
+        """Polls Redis (throttled) and returns whether the job was cancelled."""
+        if self.cancelled:
+            return True
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval_s:
+            self._last_check = now
+            if self._redis is None:
+                self._redis = get_redis_client()
+            if is_job_cancelled(self._redis, self.job_id):
+                print(f"[Cancellation] Job {self.job_id} was cancelled. Stopping generation.")
+                self.cancelled = True
+        return self.cancelled
+
+    async def check_async(self) -> bool:
+        """`check` for coroutines; polls Redis without blocking the event loop."""
+        if self.cancelled:
+            return True
+        now = time.monotonic()
+        if now - self._last_check >= self.check_interval_s:
+            self._last_check = now
+            if await is_job_cancelled_async(get_async_redis_client(), self.job_id):
+                print(f"[Cancellation] Job {self.job_id} was cancelled. Stopping generation.")
+                self.cancelled = True
+        return self.cancelled
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.check(), dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,89 @@
+# Rough per-message cost of the chat template's role markers.
+MESSAGE_OVERHEAD_TOKENS = 4
+TRUNCATION_MARKER = "[...] "
+
+
+def count_tokens(tokenizer, text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def _truncate_to_tokens(tokenizer, text: str, max_tokens: int) -> str:
+    """Keeps the last `max_tokens` tokens of `text`, marking the cut."""
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    if len(ids) <= max_tokens:
+        return text
+    return TRUNCATION_MARKER + tokenizer.decode(ids[-max_tokens:], skip_special_tokens=True).lstrip()
+
+def pack_history(
+    tokenizer,
+    history: list,
+    token_budget: int,
+    max_messages: int = None,
+    min_truncated_tokens: int = 64,
+    summary: str = None,
+    summary_through: str = None
+) -> tuple:
+    """
+    Fits chat history into `token_budget` tokens, keeping the newest turns first.
+    The turn at the budget boundary is truncated if at least `min_truncated_tokens`
+    are left; everything older is dropped. A `summary` of earlier turns is added to
+    the system message and counts towards the budget. It is left out when the turns it
+    covers, up to the message with id `summary_through`, all fit into the window.
+
+    :param history: Messages as built by `format_chat_history_for_llm`, chronological.
+        A leading system message and the trailing user query are always kept.
+    :return: (packed_history, dropped_turns), dropped turns in chronological order.
+    """
+    if not history:
+        return [], []
+
+    if summary and summary_through is not None and any(turn.get("id") == summary_through for turn in history):
+        packed, dropped = pack_history(tokenizer, history, token_budget, max_messages, min_truncated_tokens)
+        if not dropped:
+            return packed, dropped
+
+    turns = list(history)
+    system = turns.pop(0) if turns[0].get("role") == "system" else None
+    current = turns.pop() if turns and turns[-1].get("role") == "user" else None
+
+    if system is not None and summary:
+        system = dict(system, content=f"{system['content']}\n\nSummary of the earlier conversation:\n{summary}")
+
+    used = 0
+    if system is not None:
+        used += count_tokens(tokenizer, system["content"]) + MESSAGE_OVERHEAD_TOKENS
+    elif summary:
+        used += count_tokens(tokenizer, summary) + MESSAGE_OVERHEAD_TOKENS
+
+    kept = []
+    cut = len(turns)
+    for index in range(len(turns) - 1, -1, -1):
+        if max_messages is not None and len(kept) >= max_messages:
+            break
+        message = turns[index]
+        cost = count_tokens(tokenizer, message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost <= token_budget:
+            kept.append(message)
+            used += cost
+            cut = index
+            continue
+        remaining = token_budget - used - MESSAGE_OVERHEAD_TOKENS
+        if remaining >= min_truncated_tokens:
+            kept.append(dict(message, content=_truncate_to_tokens(tokenizer, message["content"], remaining)))
+            cut = index
+        break
+
+    kept.reverse()
+    # The chat template needs the history to start with a user turn.
+    while kept and kept[0].get("role") != "user":
+        kept.pop(0)
+        cut += 1
+
+    packed = []
+    if system is not None:
+        packed.append(system)
+    elif summary:
+        packed.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    packed.extend(kept)
+    if current is not None:
+        packed.append(current)
+    return packed, turns[:cut]
@@ -0,0 +1,120 @@
+import json
+import threading
+import uuid
+
+import redis
+
+from app.llm_inference import generate_response
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an assistant.
+Update the existing summary with the new messages below. Keep facts, decisions, names and open questions; drop small talk.
+Answer with the updated summary only, in at most a few short paragraphs.
+
+Existing summary:
+{summary}
+
+New messages:
+{messages}"""
+
+
+def summary_key(conversation_id: str) -> str:
+    return f"conversation_summary:{conversation_id}"
+
+def load_summary(redis_client, conversation_id: str) -> dict:
+    """
+    Returns the stored summary record of a conversation:
+    {'summary': str, 'last_message_id': str or None}.
+    """
+    empty = {'summary': '', 'last_message_id': None}
+    if not conversation_id:
+        return empty
+    try:
+        record = redis_client.get(summary_key(conversation_id))
+    except redis.exceptions.RedisError as e:
+        print(f"[Conversation Summary] WARNING: Could not load summary for {conversation_id}: {e}")
+        return empty
+    return json.loads(record) if record else empty
+
+def unsummarized_turns(record: dict, dropped_turns: list, kept_turns: list) -> list:
+    """
+    Returns the dropped turns that are not covered by the summary yet.
+    Turns are matched by the message 'id' the web app puts into the history.
+    """
+    last_id = record.get('last_message_id')
+    if not last_id:
+        return list(dropped_turns)
+    dropped_ids = [turn.get('id') for turn in dropped_turns]
+    if last_id in dropped_ids:
+        return list(dropped_turns[dropped_ids.index(last_id) + 1:])
+    if any(turn.get('id') == last_id for turn in kept_turns):
+        return []
+    # The summary ends before the current window, so all dropped turns are new.
+    return list(dropped_turns)
+
+def _format_turns(turns: list) -> str:
+    return "\n".join(f"{turn['role'].capitalize()}: {turn['content']}" for turn in turns)
+
+def update_summary(model, tokenizer, redis_client, conversation_id: str, record: dict, new_turns: list, max_new_tokens: int = 256) -> dict:
+    """Folds `new_turns` into the conversation's summary with the local model and stores it."""
+    prompt = SUMMARY_PROMPT.format(summary=record.get('summary') or "(none yet)", messages=_format_turns(new_turns))
+    summary = generate_response(
+        model=model,
+        tokenizer=tokenizer,
+        prompt_text=prompt,
+        max_new_tokens=max_new_tokens,
+        temperature=0.3
+    )
+    updated = {'summary': summary, 'last_message_id': new_turns[-1].get('id')}
+    try:
+        redis_client.set(summary_key(conversation_id), json.dumps(updated))
+    except redis.exceptions.RedisError as e:
+        print(f"[Conversation Summary] WARNING: Could not store summary for {conversation_id}: {e}")
+    print(f"[Conversation Summary] Folded {len(new_turns)} turns into the summary of {conversation_id}.")
+    return updated
+
+def update_summary_in_background(model, tokenizer, redis_client, conversation_id: str, record: dict, new_turns: list, max_new_tokens: int = 256):
+    """Runs `update_summary` off the request path; the next turn picks up the result."""
+    def run():
+        try:
+            update_summary(model, tokenizer, redis_client, conversation_id, record, new_turns, max_new_tokens)
+        except Exception as e:
+            print(f"[Conversation Summary] ERROR: Could not update summary for {conversation_id}: {e}")
+    thread = threading.Thread(target=run, name=f"summary-{conversation_id}", daemon=True)
+    thread.start()
+    return thread
+
+def enqueue_summary_update(job_queue, conversation_id: str, record: dict, new_turns: list, max_new_tokens: int = 256):
+    """
+    Queues `update_summary` as a 'batch' lane job, so the worker pool runs it like any
+    other job instead of sharing the model with the next one.
+    """
+    job_id = f"summary-{conversation_id}-{uuid.uuid4().hex[:8]}"
+    job_data = {
+        'job_id': job_id,
+        'kind': 'summary',
+        'conversation_id': conversation_id,
+        'record': record,
+        'new_turns': new_turns,
+        'max_new_tokens': max_new_tokens
+    }
+    job_queue.add(job_id, json.dumps(job_data), {'user_id': None, 'lane': 'batch', 'kind': 'summary'})
+
+def run_summary_job(model, tokenizer, redis_client, job_data: dict) -> dict:
+    """
+    Runs a job from `enqueue_summary_update`. If the stored summary moved on since the
+    job was queued, only the turns it doesn't cover yet are folded in; if it no longer
+    ends inside the queued turns, the job is skipped and a later turn queues what is left.
+    """
+    conversation_id = job_data['conversation_id']
+    record = load_summary(redis_client, conversation_id)
+    new_turns = job_data['new_turns']
+    last_id = record.get('last_message_id')
+    if last_id != job_data['record'].get('last_message_id'):
+        turn_ids = [turn.get('id') for turn in new_turns]
+        if last_id not in turn_ids:
+            print(f"[Conversation Summary] Skipping an outdated summary update for {conversation_id}.")
+            return record
+        new_turns = new_turns[turn_ids.index(last_id) + 1:]
+    if not new_turns:
+        return record
+    return update_summary(model, tokenizer, redis_client, conversation_id, record, new_turns, job_data.get('max_new_tokens', 256))
@@ -0,0 +1,44 @@
+import os
+
+import torch
+
+
+def available_cores() -> list:
+    """The CPU cores this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def partition_cores(num_workers: int, threads_per_worker: int = None) -> list:
+    """
+    Splits the available cores into `num_workers` disjoint sets of `threads_per_worker`
+    cores (by default an even share), so worker processes don't oversubscribe the CPU.
+    """
+    cores = available_cores()
+    if not threads_per_worker:
+        threads_per_worker = max(len(cores) // max(num_workers, 1), 1)
+    if num_workers * threads_per_worker > len(cores):
+        print(f"[CPU Affinity] WARNING: {num_workers} workers x {threads_per_worker} threads exceeds {len(cores)} cores; core sets will overlap.")
+    return [
+        [cores[(worker * threads_per_worker + i) % len(cores)] for i in range(threads_per_worker)]
+        for worker in range(num_workers)
+    ]
+
+def apply_cpu_partition(cores: list, interop_threads: int = 1):
+    """Pins the current process to `cores` and sizes torch's thread pools to match."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # Can only be set before the first inter-op parallel work in this process.
+        pass
+    print(f"[CPU Affinity] PID {os.getpid()} pinned to cores {cores} ({len(cores)} intra-op threads).")
+
+def init_cpu_worker(core_queue, interop_threads: int = 1):
+    """ProcessPoolExecutor initializer: claims the next free core set from `core_queue`."""
+    apply_cpu_partition(core_queue.get(), interop_threads)
+
+def uses_cpu_inference(precision: str) -> bool:
+    return precision == 'cpu-int8-dynamic' or not torch.cuda.is_available()
@@ -0,0 +1,69 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import redis
+
+from app.redis_client import get_redis_client
+
+HEARTBEAT_INTERVAL_S = 5
+HEARTBEAT_TTL_S = 15
+# Hash of worker id -> readiness payload; readers skip (and remove) expired entries.
+WORKER_READY_KEY = "worker:ready"
+
+_active_jobs = 0
+_active_lock = threading.Lock()
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def job_started():
+    global _active_jobs
+    with _active_lock:
+        _active_jobs += 1
+
+def job_finished():
+    global _active_jobs
+    with _active_lock:
+        _active_jobs = max(_active_jobs - 1, 0)
+
+def start_heartbeat(capacity: int, mode: str) -> threading.Thread:
+    """
+    Publishes this warmed-up process's readiness in the `worker:ready` hash every few
+    seconds. Each entry carries an 'expires_at', so entries of dead processes stop
+    counting on their own and the web app can count live capacity with one HGETALL
+    and refuse jobs while no worker is warm.
+    """
+    started_at = time.time()
+
+    def run():
+        redis_client = get_redis_client()
+        while True:
+            now = time.time()
+            payload = {
+                'pid': os.getpid(),
+                'host': socket.gethostname(),
+                'mode': mode,
+                'capacity': capacity,
+                'active_jobs': _active_jobs,
+                'started_at': started_at,
+                'updated_at': now,
+                'expires_at': now + HEARTBEAT_TTL_S,
+            }
+            try:
+                pipe = redis_client.pipeline()
+                pipe.hset(WORKER_READY_KEY, worker_id(), json.dumps(payload))
+                # Drops the whole hash once every worker is gone.
+                pipe.expire(WORKER_READY_KEY, HEARTBEAT_TTL_S)
+                pipe.execute()
+            except redis.exceptions.RedisError as e:
+                print(f"[Heartbeat] WARNING: Could not publish readiness: {e}")
+            time.sleep(HEARTBEAT_INTERVAL_S)
+
+    thread = threading.Thread(target=run, name="worker-heartbeat", daemon=True)
+    thread.start()
+    print(f"[Heartbeat] PID {os.getpid()} is ready (capacity {capacity}).")
+    return thread
@@ -0,0 +1,174 @@
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from app.llm_inference import load_base_model_and_tokenizer, get_cache_stats
+from app.batching_engine import BatchingEngine
+from app.adapter_manager import init_adapter_manager
+from app.prefix_cache import init_prefix_cache
+
+
+class InferenceServer:
+    """
+    Owns the one loaded base model and serves generation requests to worker processes
+    over a local multiprocessing connection. Every request gets its own connection
+    and is handed to the shared BatchingEngine, so concurrent jobs share its batch.
+    """
+    def __init__(self, engine: BatchingEngine, address: tuple, authkey: bytes):
+        self.engine = engine
+        self.address = address
+        self.authkey = authkey
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"[Inference Server] Listening on {self.address[0]}:{self.address[1]}.")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f"[Inference Server] WARNING: Rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            kind, payload = conn.recv()
+            if kind == 'ping':
+                conn.send(('result', 'pong'))
+            elif kind == 'submit':
+                request = self.engine.submit(**payload)
+                try:
+                    for token_id in request.stream():
+                        conn.send(('token', token_id))
+                    conn.send(('done', None))
+                except (EOFError, BrokenPipeError, ConnectionResetError):
+                    # The worker stopped reading; don't keep a batch row busy for nobody.
+                    request.cancel()
+                    raise
+            elif kind == 'call':
+                fn, args, kwargs = payload
+                conn.send(('result', self.engine.call(fn, *args, **kwargs)))
+            else:
+                conn.send(('error', f"Unknown request type '{kind}'."))
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"[Inference Server] ERROR while serving request: {e}")
+            try:
+                conn.send(('error', repr(e)))
+            except Exception:
+                pass
+        finally:
+            conn.close()
+
+
+def serve_inference(config: dict, address: tuple, authkey: bytes):
+    """
+    Entry point of the inference server process: loads the model once, starts the
+    batching engine and serves requests until the process is terminated.
+    """
+    model, tokenizer = load_base_model_and_tokenizer(config['base_model'], config.get('precision', {}).get('profile', 'int8'))
+    init_adapter_manager(config.get('adapter_cache', {}))
+    init_prefix_cache(config.get('prefix_cache', {}))
+    engine = BatchingEngine(model, tokenizer, config.get('inference', {}))
+    engine.start()
+    InferenceServer(engine, address, authkey).serve_forever()
+
+
+class RemoteGenerationRequest:
+    """Client-side handle for a sequence that is being generated by the InferenceServer."""
+    def __init__(self, conn):
+        self._conn = conn
+        self._generated = None
+
+    def stream(self) -> iter:
+        """Yields generated token ids as the server produces them."""
+        return self._read()
+
+    def _read(self, deadline: float = None) -> iter:
+        generated = []
+        try:
+            while True:
+                if deadline is not None and not self._conn.poll(max(deadline - time.monotonic(), 0)):
+                    raise TimeoutError("Generation request did not finish in time.")
+                kind, value = self._conn.recv()
+                if kind == 'token':
+                    generated.append(value)
+                    yield value
+                elif kind == 'done':
+                    break
+                else:
+                    raise RuntimeError(f"Inference server error: {value}")
+        finally:
+            self._conn.close()
+        self._generated = generated
+
+    def cancel(self):
+        """Closes the connection, which makes the server cancel the sequence."""
+        self._conn.close()
+
+    def result(self, timeout: float = None) -> list:
+        """
+        Blocks until the sequence is finished and returns the generated token ids.
+        On timeout the connection is closed, which also cancels the sequence on the server.
+        """
+        if self._generated is None:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            for _ in self._read(deadline):
+                pass
+        return list(self._generated)
+
+
+class InferenceClient:
+    """
+    Stands in for a BatchingEngine in worker processes that don't load the model.
+    Pass it to `set_inference_engine` and generation is served by the InferenceServer.
+    """
+    def __init__(self, address: tuple, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+
+    def _connect(self):
+        return Client(self.address, authkey=self.authkey)
+
+    def submit(self, input_ids: list, max_new_tokens: int = 1024, temperature: float = 0.7, top_p: float = 0.9, adapter_name: str = None, prefix_len: int = 0, stop_strings: list = None, stopping_criteria: list = None) -> RemoteGenerationRequest:
+        conn = self._connect()
+        conn.send(('submit', {
+            'input_ids': list(input_ids),
+            'max_new_tokens': max_new_tokens,
+            'temperature': temperature,
+            'top_p': top_p,
+            'adapter_name': adapter_name,
+            'prefix_len': prefix_len,
+            'stop_strings': stop_strings,
+            'stopping_criteria': stopping_criteria,
+        }))
+        return RemoteGenerationRequest(conn)
+
+    def call(self, fn, *args, **kwargs):
+        """Runs a top-level `fn(model, tokenizer, ...)` in the server process and returns its result."""
+        with self._connect() as conn:
+            conn.send(('call', (fn, args, kwargs)))
+            kind, value = conn.recv()
+        if kind == 'error':
+            raise RuntimeError(f"Inference server error: {value}")
+        return value
+
+    def stats(self) -> dict:
+        return self.call(get_cache_stats)
+
+
+def wait_for_inference_server(address: tuple, authkey: bytes, process=None, timeout: float = 1800.0):
+    """Blocks until the inference server answers, e.g. while it is still loading the model."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and not process.is_alive():
+            raise RuntimeError("Inference server process exited during startup.")
+        try:
+            with Client(address, authkey=authkey) as conn:
+                conn.send(('ping', None))
+                conn.recv()
+            return
+        except (ConnectionRefusedError, FileNotFoundError, EOFError):
+            time.sleep(1.0)
+    raise TimeoutError(f"Inference server at {address} did not come up within {timeout}s.")
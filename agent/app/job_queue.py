@@ -0,0 +1,104 @@
+import json
+import os
+import socket
+import time
+
+import redis
+
+
+class JobQueue:
+    """
+    Job intake on a Redis Stream read through a consumer group. Entries stay pending
+    until they are acked, so jobs an orchestrator took but never finished (e.g. it
+    crashed) are reclaimed by another one with XAUTOCLAIM. Entries that keep getting
+    reclaimed are moved to a dead-letter stream instead of being retried forever.
+    """
+    def __init__(self, redis_client, config: dict = None):
+        """
+        :param config: The 'job_queue' section of the config.yaml.
+        """
+        config = config or {}
+        self.redis = redis_client
+        self.stream = config.get('stream', 'jobs')
+        self.group = config.get('group', 'workers')
+        self.dead_letter_stream = config.get('dead_letter_stream', 'jobs:dead')
+        self.block_ms = int(config.get('block_ms', 1000))
+        self.claim_idle_ms = int(config.get('claim_idle_ms', 60000))
+        self.max_deliveries = int(config.get('max_deliveries', 3))
+        self.dead_letter_maxlen = int(config.get('dead_letter_maxlen', 1000))
+        self.consumer = f"{socket.gethostname()}:{os.getpid()}"
+
+    def ensure_group(self):
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+            print(f"[Job Queue] Created consumer group '{self.group}' on stream '{self.stream}'.")
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def add(self, job_id: str, job_data_str: str, meta: dict):
+        """Queues a job in the same format the web app uses."""
+        self.redis.xadd(self.stream, {'job': json.dumps([job_id, job_data_str]), 'meta': json.dumps(meta)})
+
+    @staticmethod
+    def _parse(entry_id: str, fields: dict) -> dict:
+        job_id, job_data_str = json.loads(fields['job'])
+        return {'entry_id': entry_id, 'job_id': job_id, 'job_data': job_data_str, 'meta': json.loads(fields.get('meta', '{}'))}
+
+    def read(self, count: int, block: bool = True) -> list:
+        """
+        Returns up to `count` new jobs as dicts with 'entry_id', 'job_id', 'job_data'
+        and 'meta', waiting up to `block_ms` for one to arrive if `block` is set.
+        """
+        response = self.redis.xreadgroup(self.group, self.consumer, {self.stream: '>'}, count=count, block=self.block_ms if block else None)
+        jobs = []
+        for _, entries in response or []:
+            for entry_id, fields in entries:
+                jobs.append(self._parse(entry_id, fields))
+        return jobs
+
+    def reclaim(self, count: int) -> list:
+        """
+        Takes over jobs that another consumer has left pending for longer than
+        `claim_idle_ms`. Jobs delivered more than `max_deliveries` times are
+        dead-lettered and returned with 'job_data' set to None.
+        """
+        _, entries, *deleted = self.redis.xautoclaim(self.stream, self.group, self.consumer, self.claim_idle_ms, start_id='0-0', count=count)
+        for entry_id in (deleted[0] if deleted else []):
+            # The entry's payload is gone, so there is nothing left to run.
+            self.redis.xack(self.stream, self.group, entry_id)
+        jobs = []
+        for entry_id, fields in entries:
+            if not fields:
+                self.ack(entry_id)
+                continue
+            job = self._parse(entry_id, fields)
+            if self._deliveries(entry_id) > self.max_deliveries:
+                self.dead_letter(entry_id, fields, f"Delivered more than {self.max_deliveries} times.")
+                job['job_data'] = None
+            else:
+                print(f"[Job Queue] Reclaimed stale job {job['job_id']} from a crashed consumer.")
+            jobs.append(job)
+        return jobs
+
+    def _deliveries(self, entry_id: str) -> int:
+        pending = self.redis.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+        return pending[0]['times_delivered'] if pending else 0
+
+    def keep_alive(self, entry_ids: list):
+        """Resets the idle time of jobs this consumer has buffered or is running so they aren't reclaimed."""
+        if entry_ids:
+            self.redis.xclaim(self.stream, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    def ack(self, entry_id: str):
+        pipe = self.redis.pipeline()
+        pipe.xack(self.stream, self.group, entry_id)
+        pipe.xdel(self.stream, entry_id)
+        pipe.execute()
+
+    def dead_letter(self, entry_id: str, fields: dict, reason: str):
+        entry = dict(fields)
+        entry.update({'entry_id': entry_id, 'reason': reason, 'failed_at': time.time()})
+        self.redis.xadd(self.dead_letter_stream, entry, maxlen=self.dead_letter_maxlen, approximate=True)
+        self.ack(entry_id)
+        print(f"[Job Queue] Moved entry {entry_id} to '{self.dead_letter_stream}': {reason}")
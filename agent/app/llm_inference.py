@@ -1,7 +1,9 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, LogitsProcessor, LogitsProcessorList, TextIteratorStreamer
-from threading import Thread
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from threading import Event, Thread
 import os
+from app.adapter_manager import get_adapter_manager
+from app.prefix_cache import get_prefix_cache, split_static_prefix
 
 class NanInfLogitsProcessor(LogitsProcessor):
     """
@@ -15,34 +17,221 @@ class NanInfLogitsProcessor(LogitsProcessor):
             # Forcing bad tokens to a very low value to prevent them from being sampled
             scores = torch.nan_to_num(scores, -1e9)
         return scores
-    
 
-def load_base_model_and_tokenizer(model_id: str):
+def stop_string_in_tail(tokenizer, generated_ids, stop_strings: list, window: int = 16) -> bool:
+    """
+    Whether a stop string appears in the last `window` generated tokens. Checked after
+    every new token, so a stop string always shows up at the end of the tail first.
+    """
+    tail = tokenizer.decode(generated_ids[-window:], skip_special_tokens=True)
+    if len(generated_ids) <= window:
+        tail = tail.lstrip()
+    return any(stop in tail for stop in stop_strings)
+
+class StopOnStringsCriteria(StoppingCriteria):
+    """
+    Stops generation as soon as any of the stop strings appears in the generated text.
+    Only the last `window` tokens are decoded on each step, and leading whitespace is
+    ignored so a stop string like "\n" does not fire before any content was produced.
+    """
+    def __init__(self, tokenizer, stop_strings: list, prompt_length: int, window: int = 16):
+        self.tokenizer = tokenizer
+        self.stop_strings = list(stop_strings)
+        self.prompt_length = prompt_length
+        self.window = window
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = [
+            stop_string_in_tail(self.tokenizer, row[self.prompt_length:], self.stop_strings, self.window)
+            for row in input_ids
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class StopFlagCriteria(StoppingCriteria):
+    """Stops generation once `stop()` is called from another thread, e.g. when a stream's reader goes away."""
+    def __init__(self):
+        self._stopped = Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self._stopped.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def truncate_at_stop(text: str, stop_strings: list) -> tuple:
+    """
+    Cuts `text` right after the first stop string (ignoring leading whitespace).
+    Returns (text, stopped).
+    """
+    if not stop_strings:
+        return text, False
+    offset = len(text) - len(text.lstrip())
+    positions = [(text.find(stop, offset), stop) for stop in stop_strings]
+    positions = [(index, stop) for index, stop in positions if index >= 0]
+    if not positions:
+        return text, False
+    index, stop = min(positions)
+    return text[:index + len(stop)], True
+
+def _stop_stream_at(chunks, stop_strings: list) -> iter:
+    """Passes text chunks through until the accumulated text reaches a stop string."""
+    text = ""
+    for chunk in chunks:
+        truncated, stopped = truncate_at_stop(text + chunk, stop_strings)
+        if len(truncated) > len(text):
+            yield truncated[len(text):]
+        text = truncated
+        if stopped:
+            return
+
+
+INFERENCE_ENGINE = None
+
+def set_inference_engine(engine):
+    """
+    Routes all generation in this process through a shared BatchingEngine.
+    Pass None to go back to calling `model.generate` directly.
+    """
+    global INFERENCE_ENGINE
+    INFERENCE_ENGINE = engine
+
+DRAFT_MODEL = None
+
+def set_draft_model(draft_model):
+    """
+    Enables assisted (speculative) generation with a small draft model of the same
+    family for `model.generate` calls. Pass None to disable it.
+    """
+    global DRAFT_MODEL
+    DRAFT_MODEL = draft_model
+
+STATIC_CACHE_POOL = None
+
+def set_static_cache_pool(pool):
+    """
+    Enables the compiled fast path: `model.generate` calls use a pre-allocated static
+    KV cache from `pool` (see app.static_cache). Pass None to disable it.
+    """
+    global STATIC_CACHE_POOL
+    STATIC_CACHE_POOL = pool
+
+def _acquire_kv_cache(model, adapter_name: str, input_ids: list, prefix_len: int, max_new_tokens: int) -> tuple:
+    """
+    Picks the KV cache for a `model.generate` call: a bucketed static cache on the
+    compiled fast path, otherwise the cached prefix (or None for a fresh cache).
+    Returns (past_key_values, max_new_tokens, is_static).
+    """
+    if STATIC_CACHE_POOL is not None and DRAFT_MODEL is None:
+        cache = STATIC_CACHE_POOL.acquire(len(input_ids), max_new_tokens)
+        if cache is not None:
+            return cache, max_new_tokens, True
+    if prefix_len:
+        return get_prefix_cache().get(model, adapter_name, input_ids[:prefix_len]), max_new_tokens, False
+    return None, max_new_tokens, False
+
+def _release_kv_cache(past_key_values, is_static: bool):
+    if is_static:
+        STATIC_CACHE_POOL.release(past_key_values)
+
+def _assisted_generation_kwargs() -> dict:
+    return {'assistant_model': DRAFT_MODEL} if DRAFT_MODEL is not None else {}
+
+def _ensure_adapter_on_model(model, tokenizer, adapter_name: str, adapter_path: str):
+    return get_adapter_manager().ensure(model, adapter_name, adapter_path)
+
+def run_on_model(model, tokenizer, fn, *args, **kwargs):
+    """
+    Runs `fn(model, tokenizer, *args, **kwargs)` for work that needs direct model access.
+    With a BatchingEngine active it runs on the engine thread between decode steps.
+    """
+    if INFERENCE_ENGINE is not None:
+        return INFERENCE_ENGINE.call(fn, *args, **kwargs)
+    with torch.no_grad():
+        return fn(model, tokenizer, *args, **kwargs)
+
+def get_cache_stats(model, tokenizer) -> dict:
+    """Returns the adapter and prefix cache counters of the process that owns the model."""
+    return {'adapter_cache': get_adapter_manager().stats(), 'prefix_cache': get_prefix_cache().stats()}
+
+def ensure_adapter(model, adapter_name: str, adapter_path: str):
+    """Makes an adapter resident, on the engine thread if a BatchingEngine is active."""
+    return run_on_model(model, None, _ensure_adapter_on_model, adapter_name, adapter_path)
+
+def _stream_engine_text(tokenizer, request) -> iter:
+    """
+    Incrementally decodes the token ids of an engine request into text chunks. Only the
+    tokens since the last emitted chunk are decoded, together with the chunk before them
+    (`prefix_offset`) so tokenizers that merge spaces across tokens still decode right.
+    """
+    token_ids = []
+    prefix_offset = read_offset = 0
+    for token_id in request.stream():
+        token_ids.append(token_id)
+        prefix_text = tokenizer.decode(token_ids[prefix_offset:read_offset], skip_special_tokens=True)
+        text = tokenizer.decode(token_ids[prefix_offset:], skip_special_tokens=True)
+        if len(text) > len(prefix_text) and not text.endswith("\ufffd"):
+            yield text[len(prefix_text):]
+            prefix_offset, read_offset = read_offset, len(token_ids)
+
+def load_tokenizer(model_id: str):
+    """Loads only the tokenizer, for processes that send generation to an inference server."""
+    return AutoTokenizer.from_pretrained(model_id)
+
+PRECISION_PROFILES = ('bf16', 'fp16', 'int8', 'nf4', 'cpu-int8-dynamic')
+
+def precision_profile_available(profile: str) -> bool:
+    """Whether a precision profile can run on this host."""
+    if profile == 'cpu-int8-dynamic':
+        return True
+    if not torch.cuda.is_available():
+        return False
+    if profile == 'bf16':
+        return torch.cuda.is_bf16_supported()
+    return True
+
+def load_base_model_and_tokenizer(model_id: str, precision: str = 'int8'):
     """
     Loads the base model and tokenizer ONCE.
     This is called at the start of the application.
+    `precision` is one of PRECISION_PROFILES (the 'precision.profile' config value).
     """
-    print(f"[LLM Inference] Loading base model: '{model_id}'...")
+    if precision not in PRECISION_PROFILES:
+        raise ValueError(f"Unknown precision profile '{precision}'. Choose one of: {', '.join(PRECISION_PROFILES)}")
+    if not precision_profile_available(precision):
+        print(f"[LLM Inference] WARNING: Precision profile '{precision}' is not available on this host. Falling back to 'cpu-int8-dynamic'.")
+        precision = 'cpu-int8-dynamic'
+
+    print(f"[LLM Inference] Loading base model: '{model_id}' with precision profile '{precision}'...")
     print("This may take a few minutes for the initial download...")
 
     attn_implementation = "sdpa"
     print(f"[LLM Inference] Using PyTorch's Scaled Dot Product Attention ({attn_implementation}). This is optimized for your hardware.")
 
-    compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
-    print(f"[LLM Inference] Using compute dtype: {compute_dtype}")
+    device = "cpu" if precision == 'cpu-int8-dynamic' else "cuda"
+    print(f"[LLM Inference] Using device: {device}")
 
-    quantization_config = BitsAndBytesConfig(
-        load_in_8bit=True,
-        #load_in_4bit=True,
-        #bnb_4bit_quant_type="nf4",
-        #bnb_4bit_compute_dtype=compute_dtype,
-        #bnb_4bit_use_double_quant=False,
-    )
+    if precision == 'bf16':
+        compute_dtype = torch.bfloat16
+    elif precision == 'cpu-int8-dynamic':
+        compute_dtype = torch.float32
+    elif precision == 'fp16' or not torch.cuda.is_bf16_supported():
+        compute_dtype = torch.float16
+    else:
+        compute_dtype = torch.bfloat16
+    print(f"[LLM Inference] Using compute dtype: {compute_dtype}")
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"[LLM Inference] Using device: {device}")
+    quantization_config = None
+    if precision == 'int8':
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    elif precision == 'nf4':
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=compute_dtype,
+            bnb_4bit_use_double_quant=False,
+        )
 
-    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    tokenizer = load_tokenizer(model_id)
         
     model = AutoModelForCausalLM.from_pretrained(
         model_id,
@@ -51,8 +240,27 @@ def load_base_model_and_tokenizer(model_id: str):
         attn_implementation=attn_implementation,
         torch_dtype=compute_dtype
     )
+    if precision == 'cpu-int8-dynamic':
+        # Dynamic int8 Linear layers; LoRA adapters can't attach to them, so agents run on the base model.
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model.supports_lora_adapters = False
     return model, tokenizer
 
+def load_draft_model(model_id: str, num_assistant_tokens: int = 5, device: str = None):
+    """
+    Loads the draft model used for speculative decoding. It must share the base
+    model's tokenizer; it is small, so it is kept unquantized.
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    compute_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
+    if device == "cpu":
+        compute_dtype = torch.float32
+    print(f"[LLM Inference] Loading draft model for speculative decoding: '{model_id}'...")
+    draft_model = AutoModelForCausalLM.from_pretrained(model_id, device_map=device, torch_dtype=compute_dtype)
+    draft_model.generation_config.num_assistant_tokens = num_assistant_tokens
+    draft_model.generation_config.num_assistant_tokens_schedule = "heuristic"
+    return draft_model
+
 def clean_chat_history(history: list) -> list:
     cleaned = []
     last_role = None
@@ -83,6 +291,35 @@ def clean_chat_history(history: list) -> list:
 
     return cleaned
 
+def _build_stopping_criteria(tokenizer, prompt_length: int, stop_strings: list = None, stopping_criteria: list = None) -> StoppingCriteriaList:
+    criteria = StoppingCriteriaList(stopping_criteria or [])
+    if stop_strings:
+        criteria.append(StopOnStringsCriteria(tokenizer, stop_strings, prompt_length))
+    return criteria
+
+def build_chat(prompt_text: str, prompt_master_prompt: str = None, prompt_history: list = None) -> list:
+    """
+    Builds the chat for `apply_chat_template`. The master prompt always opens the
+    system message so the static part of the prompt is a stable, cacheable prefix.
+    """
+    history = clean_chat_history(prompt_history) if prompt_history else []
+
+    system_parts = []
+    if prompt_master_prompt:
+        system_parts.append(prompt_master_prompt)
+    if history and history[0]["role"] == "system":
+        system_parts.append(history.pop(0)["content"])
+    # The newest user message is replaced by `prompt_text`.
+    if history and history[-1]["role"] == "user":
+        history.pop()
+
+    chat = []
+    if system_parts:
+        chat.append({"role": "system", "content": "\n\n".join(system_parts)})
+    chat.extend(history)
+    chat.append({"role": "user", "content": prompt_text})
+    return chat
+
 def generate_response(
     model: AutoModelForCausalLM,
     tokenizer: AutoTokenizer,
@@ -90,73 +327,129 @@ def generate_response(
     prompt_master_prompt: str = None,
     prompt_history: list = None,
     max_new_tokens: int = 4096,
+    adapter_name: str = None,
+    cache_prefix: str = None,
+    stop_strings: list = None,
+    stopping_criteria: list = None,
     **kwargs
 ) -> str:
     """
     Generates a response from a pre-loaded LLM.
+    `adapter_name` selects a resident LoRA adapter; None uses the plain base model.
+    The master prompt's KV cache is reused across calls through the prefix cache;
+    pass `cache_prefix` when only the start of the master prompt is static.
+    Generation ends early at any of `stop_strings` (kept in the response) or when a
+    token-level StoppingCriteria in `stopping_criteria` fires.
+    Uses the draft model for speculative decoding when one is set (not in engine mode).
     """
-    device = model.device
-
     temperature = kwargs.get('temperature', 0.7)
     top_p = kwargs.get('top_p', 0.9)
-    
-    chat = []
-    
-    if prompt_history:
-        chat.extend(clean_chat_history(prompt_history))
 
-    if prompt_master_prompt:
-        chat.append({"role": "system", "content": prompt_master_prompt})
-    
+    chat = build_chat(prompt_text, prompt_master_prompt, prompt_history)
+    prompt_for_model = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
+    input_ids, prefix_len = split_static_prefix(tokenizer, prompt_for_model, cache_prefix or prompt_master_prompt)
 
-    chat.append({"role": "user", "content": prompt_text})
+    if INFERENCE_ENGINE is not None:
+        request = INFERENCE_ENGINE.submit(
+            input_ids, max_new_tokens, temperature, top_p, adapter_name, prefix_len=prefix_len,
+            stop_strings=stop_strings, stopping_criteria=stopping_criteria
+        )
+        response = tokenizer.decode(request.result(), skip_special_tokens=True)
+        return truncate_at_stop(response, stop_strings)[0].strip()
 
-    prompt_for_model = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
-    
-    inputs = tokenizer(prompt_for_model, return_tensors="pt").to(device)
+    device = model.device
+    get_adapter_manager().activate(model, adapter_name)
+    input_tensor = torch.tensor([input_ids], device=device)
+
+    past_key_values, max_new_tokens, is_static = _acquire_kv_cache(model, adapter_name, input_ids, prefix_len, max_new_tokens)
 
     logits_processor = LogitsProcessorList([NanInfLogitsProcessor()])
 
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=max_new_tokens,
-        do_sample=True,
-        temperature=temperature,
-        top_p=top_p,
-        logits_processor=logits_processor
-    )
+    try:
+        outputs = model.generate(
+            input_ids=input_tensor,
+            attention_mask=torch.ones_like(input_tensor),
+            past_key_values=past_key_values,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=temperature,
+            top_p=top_p,
+            logits_processor=logits_processor,
+            stopping_criteria=_build_stopping_criteria(tokenizer, len(input_ids), stop_strings, stopping_criteria),
+            **({} if is_static else _assisted_generation_kwargs())
+        )
+    finally:
+        _release_kv_cache(past_key_values, is_static)
 
-    response = tokenizer.decode(outputs[0][len(inputs.input_ids[0]):], skip_special_tokens=True)
-    return response.strip()
+    response = tokenizer.decode(outputs[0][len(input_ids):], skip_special_tokens=True)
+    return truncate_at_stop(response, stop_strings)[0].strip()
 
 def generate_response_stream(
     model: AutoModelForCausalLM,
     tokenizer: AutoTokenizer,
     prompt_text: str,
-    max_new_tokens: int = 1024,
+    prompt_master_prompt: str = None,
+    prompt_history: list = None,
+    max_new_tokens: int = 4096,
+    adapter_name: str = None,
+    cache_prefix: str = None,
+    stop_strings: list = None,
+    stopping_criteria: list = None,
     **kwargs
 ) -> iter:
     """
     A generator function that yields tokens as they are generated by the model.
+    Takes the same arguments as `generate_response`.
     """
+    temperature = kwargs.get('temperature', 0.7)
+    top_p = kwargs.get('top_p', 0.9)
 
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-    
-    chat = [{"role": "user", "content": prompt_text}]
+    chat = build_chat(prompt_text, prompt_master_prompt, prompt_history)
     prompt_for_model = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer(prompt_for_model, return_tensors="pt").to(model.device)
+    input_ids, prefix_len = split_static_prefix(tokenizer, prompt_for_model, cache_prefix or prompt_master_prompt)
+
+    if INFERENCE_ENGINE is not None:
+        request = INFERENCE_ENGINE.submit(
+            input_ids, max_new_tokens, temperature, top_p, adapter_name, prefix_len=prefix_len,
+            stop_strings=stop_strings, stopping_criteria=stopping_criteria
+        )
+        try:
+            yield from _stop_stream_at(_stream_engine_text(tokenizer, request), stop_strings)
+        finally:
+            # Frees the batch slot if the reader went away or a stop string ended the text.
+            request.cancel()
+        return
+
+    get_adapter_manager().activate(model, adapter_name)
+    input_tensor = torch.tensor([input_ids], device=model.device)
+
+    past_key_values, max_new_tokens, is_static = _acquire_kv_cache(model, adapter_name, input_ids, prefix_len, max_new_tokens)
+
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    stop_flag = StopFlagCriteria()
     
     generation_kwargs = dict(
-        inputs,
+        input_ids=input_tensor,
+        attention_mask=torch.ones_like(input_tensor),
+        past_key_values=past_key_values,
         streamer=streamer,
         max_new_tokens=max_new_tokens,
         do_sample=True,
-        temperature=kwargs.get('temperature', 0.7),
-        top_p=kwargs.get('top_p', 0.9)
+        temperature=temperature,
+        top_p=top_p,
+        logits_processor=LogitsProcessorList([NanInfLogitsProcessor()]),
+        stopping_criteria=_build_stopping_criteria(tokenizer, len(input_ids), stop_strings, list(stopping_criteria or []) + [stop_flag]),
+        **({} if is_static else _assisted_generation_kwargs())
     )
     
     thread = Thread(target=model.generate, kwargs=generation_kwargs)
     thread.start()
     
-    for new_text in streamer:
-        yield new_text
\ No newline at end of file
+    try:
+        yield from _stop_stream_at(streamer, stop_strings)
+    finally:
+        # Also reached when the reader closes the stream early: generate must not keep
+        # running on the shared model into the next job's adapter switch.
+        stop_flag.stop()
+        thread.join()
+        _release_kv_cache(past_key_values, is_static)
@@ -3,7 +3,9 @@ import os
 import torch
 from app.router import route_request
 from app.subagent_handler import handle_with_subagent
-from app.llm_inference import load_base_model_and_tokenizer, generate_response
+from app.llm_inference import load_base_model_and_tokenizer, load_draft_model, set_draft_model, generate_response
+from app.adapter_manager import init_adapter_manager
+from app.prefix_cache import init_prefix_cache
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.abspath(os.path.join(BASE_DIR, '..'))
@@ -16,7 +18,12 @@ def main():
     config = load_config()
     base_model_id = config['base_model']
     
-    model, tokenizer = load_base_model_and_tokenizer(base_model_id)
+    model, tokenizer = load_base_model_and_tokenizer(base_model_id, config.get('precision', {}).get('profile', 'int8'))
+    speculative_config = config.get('speculative', {})
+    if speculative_config.get('enabled', False):
+        set_draft_model(load_draft_model(speculative_config['draft_model'], speculative_config.get('num_assistant_tokens', 5)))
+    init_adapter_manager(config.get('adapter_cache', {}))
+    init_prefix_cache(config.get('prefix_cache', {}))
     
     print("\nWelcome to the Gemma Multi-Agent System (Optimized)!")
     print("Type 'exit' or 'quit' to end the session.")
@@ -32,7 +39,11 @@ def main():
 
             router_adapter_path = os.path.join(BASE_DIR, '..', config['router']['model_path'])
             chosen_agent_name = route_request(
-                model, tokenizer, user_query, available_agents, router_adapter_path
+                model, tokenizer, user_query, available_agents, router_adapter_path,
+                mode=config['router'].get('mode', 'generate'),
+                min_confidence=config['router'].get('min_confidence', 0.0),
+                classifier_path=os.path.join(PROJECT_ROOT, config['router'].get('classifier_path', 'models/router_classifier')),
+                classifier_min_confidence=config['router'].get('classifier_min_confidence', 0.8)
             )
 
             if chosen_agent_name and chosen_agent_name in agents_config:
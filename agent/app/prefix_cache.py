@@ -0,0 +1,150 @@
+import copy
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+from app.adapter_manager import get_adapter_manager
+
+
+def cache_layers(cache) -> list:
+    """The (key, value) tensors of every layer of a DynamicCache."""
+    if hasattr(cache, 'to_legacy_cache'):
+        return [tuple(layer) for layer in cache.to_legacy_cache()]
+    # transformers 5 dropped the legacy tuple format.
+    return [(layer.keys, layer.values) for layer in cache.layers]
+
+def cache_from_layers(layers) -> DynamicCache:
+    """Builds a DynamicCache from (key, value) tensors per layer, the inverse of `cache_layers`."""
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(tuple(layers))
+
+def _cache_bytes(cache) -> int:
+    total = 0
+    for layer in cache_layers(cache):
+        for tensor in layer:
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class PrefixCache:
+    """
+    Stores the past_key_values of static prompt prefixes (agent master prompt plus
+    tool preamble) so generation can start from the cached state instead of
+    re-prefilling the same tokens on every call. Keyed by (adapter, prefix hash).
+    """
+    def __init__(self, config: dict = None):
+        """
+        :param config: The 'prefix_cache' section of the config.yaml.
+        """
+        config = config or {}
+        self.enabled = config.get('enabled', True)
+        self.memory_budget_bytes = int(float(config.get('memory_budget_mb', 1024)) * 1024 * 1024)
+        self.min_prefix_tokens = int(config.get('min_prefix_tokens', 32))
+
+        self._entries = OrderedDict()  # (adapter, hash) -> {'cache': DynamicCache, 'bytes': int, 'tokens': int}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefill_tokens_saved = 0
+
+    @staticmethod
+    def _key(adapter_name: str, prefix_ids: list) -> tuple:
+        digest = hashlib.sha1(array('q', prefix_ids).tobytes()).hexdigest()
+        return (adapter_name or '__base__', digest)
+
+    def _memory_bytes(self) -> int:
+        return sum(entry['bytes'] for entry in self._entries.values())
+
+    def _enforce_budget(self):
+        while self._entries and self._memory_bytes() > self.memory_budget_bytes:
+            key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            print(f"[Prefix Cache] Evicted prefix for adapter '{key[0]}' (LRU).")
+
+    @torch.no_grad()
+    def get(self, model, adapter_name: str, prefix_ids: list):
+        """
+        Returns a private copy of the KV cache for `prefix_ids`, prefilling and storing
+        it on a miss. The model must already have `adapter_name` active.
+        Returns None when the prefix is too short to be worth caching.
+        """
+        if not self.enabled or len(prefix_ids) < self.min_prefix_tokens:
+            return None
+
+        key = self._key(adapter_name, prefix_ids)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.prefill_tokens_saved += entry['tokens']
+                return copy.deepcopy(entry['cache'])
+
+            self.misses += 1
+            input_ids = torch.tensor([prefix_ids], device=model.device)
+            outputs = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=DynamicCache(), use_cache=True)
+            cache = outputs.past_key_values
+            self._entries[key] = {'cache': cache, 'bytes': _cache_bytes(cache), 'tokens': len(prefix_ids)}
+            self._enforce_budget()
+            return copy.deepcopy(cache)
+
+    def invalidate_adapter(self, adapter_name: str):
+        """Drops every prefix computed with the given adapter."""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] == (adapter_name or '__base__')]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'entries': len(self._entries),
+                'memory_mb': round(self._memory_bytes() / (1024 * 1024), 1),
+                'prefill_tokens_saved': self.prefill_tokens_saved,
+            }
+
+
+PREFIX_CACHE = None
+
+def init_prefix_cache(config: dict = None) -> PrefixCache:
+    """Creates the process-wide prefix cache from the 'prefix_cache' config section."""
+    global PREFIX_CACHE
+    PREFIX_CACHE = PrefixCache(config)
+    get_adapter_manager().add_eviction_listener(PREFIX_CACHE.invalidate_adapter)
+    return PREFIX_CACHE
+
+def get_prefix_cache() -> PrefixCache:
+    """Returns the process-wide prefix cache, creating one with defaults if needed."""
+    if PREFIX_CACHE is None:
+        return init_prefix_cache()
+    return PREFIX_CACHE
+
+def split_static_prefix(tokenizer, prompt_for_model: str, static_text: str) -> tuple:
+    """
+    Tokenizes a rendered prompt and returns (input_ids, prefix_len), where the first
+    `prefix_len` tokens cover everything up to and including `static_text`.
+    The last prefix token is left out because it may merge with what follows.
+    """
+    input_ids = tokenizer(prompt_for_model)["input_ids"]
+    if not static_text:
+        return input_ids, 0
+
+    end = prompt_for_model.find(static_text)
+    if end < 0:
+        return input_ids, 0
+
+    prefix_ids = tokenizer(prompt_for_model[:end + len(static_text)])["input_ids"][:-1]
+    if input_ids[:len(prefix_ids)] != prefix_ids:
+        return input_ids, 0
+    return input_ids, len(prefix_ids)
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+
+
+class ProviderExecutor:
+    """
+    Runs external-provider jobs as coroutines on one event loop in a background thread.
+    Provider calls only wait on the network, so they don't take a worker slot and many
+    of them can be in flight at once, up to `max_concurrency`. `submit` returns a
+    concurrent.futures.Future like the worker pool's executors do.
+    """
+    def __init__(self, max_concurrency: int = 64):
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+        self._thread = threading.Thread(target=self.loop.run_forever, name="provider-executor", daemon=True)
+        self._thread.start()
+
+    async def _run(self, coroutine_fn, *args):
+        async with self._semaphore:
+            self._in_flight += 1
+            try:
+                return await coroutine_fn(*args)
+            finally:
+                self._in_flight -= 1
+
+    def submit(self, coroutine_fn, *args):
+        """Schedules `coroutine_fn(*args)` on the executor's loop."""
+        return asyncio.run_coroutine_threadsafe(self._run(coroutine_fn, *args), self.loop)
+
+    def stats(self) -> dict:
+        return {'in_flight': self._in_flight, 'max_concurrency': self.max_concurrency}
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+PROVIDER_EXECUTOR = None
+
+def init_provider_executor(max_concurrency: int = 64) -> ProviderExecutor:
+    global PROVIDER_EXECUTOR
+    PROVIDER_EXECUTOR = ProviderExecutor(max_concurrency)
+    return PROVIDER_EXECUTOR
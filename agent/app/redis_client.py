@@ -0,0 +1,47 @@
+import asyncio
+import os
+import weakref
+
+import redis
+import redis.asyncio
+
+_REDIS_CLIENT = None
+_REDIS_CLIENT_PID = None
+_ASYNC_REDIS_POOLS = weakref.WeakKeyDictionary()
+
+
+def _connection_kwargs() -> dict:
+    return {
+        'host': os.getenv('REDIS_HOST', 'localhost'),
+        'port': int(os.getenv('REDIS_PORT', 6379)),
+        'db': int(os.getenv('REDIS_DB', 0)),
+        'password': os.getenv('REDIS_PASSWORD'),
+        'decode_responses': True,
+        'health_check_interval': 30,
+    }
+
+
+def get_redis_client():
+    """
+    Returns this process's Redis client, created from the REDIS_* environment variables
+    on first use. Jobs, threads and helpers all share it, so they reuse the connections
+    in its pool instead of connecting to Redis per job.
+    """
+    global _REDIS_CLIENT, _REDIS_CLIENT_PID
+    if _REDIS_CLIENT is None or _REDIS_CLIENT_PID != os.getpid():
+        _REDIS_CLIENT = redis.Redis(**_connection_kwargs())
+        _REDIS_CLIENT_PID = os.getpid()
+    return _REDIS_CLIENT
+
+def get_async_redis_client():
+    """
+    Returns an asyncio Redis client for coroutines, e.g. provider jobs on the provider
+    executor's loop, so they don't block the loop on Redis round trips. asyncio
+    connections can't be shared across loops, so there is one pool per event loop.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _ASYNC_REDIS_POOLS.get(loop)
+    if pool is None:
+        pool = redis.asyncio.ConnectionPool(**_connection_kwargs())
+        _ASYNC_REDIS_POOLS[loop] = pool
+    return redis.asyncio.Redis(connection_pool=pool)
@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+import numpy as np
+import redis
+
+STATS_KEY = "response_cache:stats"
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases and strips punctuation/extra whitespace so trivially different queries match."""
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return re.sub(r"\s+", " ", query).strip()
+
+def adapter_version(adapter_path: str) -> str:
+    """
+    Version of an agent's adapter, taken from its weights' modification time.
+    Retraining an adapter changes it, which invalidates that agent's cached responses.
+    """
+    if not adapter_path:
+        return "0"
+    for filename in ('adapter_model.safetensors', 'adapter_model.bin'):
+        file_path = os.path.join(adapter_path, filename)
+        if os.path.exists(file_path):
+            return str(int(os.path.getmtime(file_path)))
+    return str(int(os.path.getmtime(adapter_path))) if os.path.exists(adapter_path) else "0"
+
+def scope_version(model_paths: list) -> str:
+    """
+    Version of a cache scope, combined from the versions of every adapter or model that can
+    decide its answers: the router's and those of the agents it may pick.
+    """
+    versions = "|".join(adapter_version(path) for path in model_paths)
+    return hashlib.sha1(versions.encode('utf-8')).hexdigest()[:12]
+
+def _scope_name(agent_names: list) -> str:
+    return ",".join(sorted(agent_names)) or "__none__"
+
+def _encode_embedding(embedding: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(embedding, dtype=np.float16).tobytes()).decode('ascii')
+
+def _decode_embedding(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float16).astype(np.float32)
+
+
+class ResponseCache:
+    """
+    Redis-backed cache of final local-agent responses, shared by all worker processes.
+    Lookups try an exact match on the normalized query first and then the most similar
+    cached query by embedding. Entries are namespaced by the agents the request may be
+    routed to and their `scope_version`, so a hit needs no routing. They expire after
+    `ttl_seconds` and are evicted LRU beyond `max_entries_per_agent` per namespace.
+    """
+    def __init__(self, redis_client, config: dict = None):
+        """
+        :param config: The 'response_cache' section of the config.yaml.
+        """
+        config = config or {}
+        self.redis = redis_client
+        self.enabled = config.get('enabled', True)
+        self.ttl_seconds = int(config.get('ttl_seconds', 3600))
+        self.max_entries_per_agent = int(config.get('max_entries_per_agent', 256))
+        self.similarity_threshold = float(config.get('similarity_threshold', 0.92))
+        self.max_temperature = float(config.get('max_temperature', 0.7))
+
+    def is_eligible(self, history: list, temperature: float, has_summary: bool = False) -> bool:
+        """
+        Only history-free requests at low enough temperature get cached answers.
+        `history` must be the conversation as sent by the web app, before it is packed,
+        and a conversation with a stored summary has history even if none is sent.
+        """
+        if not self.enabled or temperature > self.max_temperature or has_summary:
+            return False
+        return not any(message.get("role") in ("user", "assistant") for message in history[:-1])
+
+    @staticmethod
+    def _namespace(allowed_agents: list, version: str) -> str:
+        return f"response_cache:{_scope_name(allowed_agents)}:{version}"
+
+    @staticmethod
+    def _settings_suffix(settings: dict) -> str:
+        return json.dumps(settings or {}, sort_keys=True)
+
+    def _exact_key(self, namespace: str, normalized_query: str, settings: dict) -> str:
+        digest = hashlib.sha1(f"{normalized_query}|{self._settings_suffix(settings)}".encode('utf-8')).hexdigest()
+        return f"{namespace}:exact:{digest}"
+
+    def _embed(self, text: str) -> np.ndarray:
+        # Imported here so invalidating the cache doesn't load the RAG stack.
+        from rag.rag_handler import get_sentence_model
+        return np.asarray(get_sentence_model().encode([text], normalize_embeddings=True)[0], dtype=np.float32)
+
+    def _record(self, hit: bool, agent_name: str):
+        field = 'hits' if hit else 'misses'
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(STATS_KEY, field, 1)
+            pipe.hincrby(STATS_KEY, f"{field}:{agent_name}", 1)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+    def get(self, allowed_agents: list, version: str, query: str, settings: dict = None):
+        """
+        Returns the cached {'response': str, 'agent_name': str} for the query, or None on a miss.
+        `allowed_agents` are the agents the request may be routed to.
+        """
+        namespace = self._namespace(allowed_agents, version)
+        normalized = normalize_query(query)
+        try:
+            entry_id = self.redis.get(self._exact_key(namespace, normalized, settings))
+            if entry_id is None and self.similarity_threshold < 1.0:
+                entry_id = self._most_similar(namespace, normalized, settings)
+            entry = self.redis.hget(f"{namespace}:entries", entry_id) if entry_id else None
+            if entry:
+                entry = json.loads(entry)
+                if time.time() - entry['created_at'] > self.ttl_seconds:
+                    self._delete(namespace, entry_id, entry)
+                    entry = None
+                else:
+                    self.redis.zadd(f"{namespace}:lru", {entry_id: time.time()})
+        except redis.exceptions.RedisError as e:
+            print(f"[Response Cache] WARNING: Lookup failed: {e}")
+            return None
+
+        if entry is None:
+            return None
+        self._record(True, entry['agent_name'])
+        print(f"[Response Cache] Hit for agent '{entry['agent_name']}'.")
+        return {'response': entry['response'], 'agent_name': entry['agent_name']}
+
+    def _most_similar(self, namespace: str, normalized_query: str, settings: dict):
+        entries = self.redis.hgetall(f"{namespace}:entries")
+        if not entries:
+            return None
+        settings_suffix = self._settings_suffix(settings)
+        candidates = [(entry_id, json.loads(data)) for entry_id, data in entries.items()]
+        candidates = [(entry_id, entry) for entry_id, entry in candidates if entry['settings'] == settings_suffix]
+        if not candidates:
+            return None
+        matrix = np.stack([_decode_embedding(entry['embedding']) for _, entry in candidates])
+        similarities = matrix @ self._embed(normalized_query)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return candidates[best][0]
+
+    def put(self, allowed_agents: list, version: str, query: str, response: str, agent_name: str, settings: dict = None):
+        """
+        Stores the response `agent_name` gave after a miss on the same arguments. The miss is
+        counted here, since only now is the agent that answered known.
+        """
+        self._record(False, agent_name)
+        namespace = self._namespace(allowed_agents, version)
+        normalized = normalize_query(query)
+        entry_id = uuid.uuid4().hex
+        entry = {
+            'query': normalized,
+            'response': response,
+            'agent_name': agent_name,
+            'settings': self._settings_suffix(settings),
+            'embedding': _encode_embedding(self._embed(normalized)),
+            'created_at': time.time(),
+        }
+        exact_key = self._exact_key(namespace, normalized, settings)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(f"{namespace}:entries", entry_id, json.dumps(entry))
+            pipe.zadd(f"{namespace}:lru", {entry_id: time.time()})
+            pipe.set(exact_key, entry_id, ex=self.ttl_seconds)
+            pipe.expire(f"{namespace}:entries", self.ttl_seconds)
+            pipe.expire(f"{namespace}:lru", self.ttl_seconds)
+            pipe.execute()
+
+            overflow = self.redis.zcard(f"{namespace}:lru") - self.max_entries_per_agent
+            if overflow > 0:
+                for evicted_id, _ in self.redis.zpopmin(f"{namespace}:lru", overflow):
+                    data = self.redis.hget(f"{namespace}:entries", evicted_id)
+                    self._delete(namespace, evicted_id, json.loads(data) if data else None)
+        except redis.exceptions.RedisError as e:
+            print(f"[Response Cache] WARNING: Could not store response: {e}")
+
+    def _delete(self, namespace: str, entry_id: str, entry: dict = None):
+        pipe = self.redis.pipeline()
+        pipe.hdel(f"{namespace}:entries", entry_id)
+        pipe.zrem(f"{namespace}:lru", entry_id)
+        if entry is not None:
+            exact_key = self._exact_key(namespace, entry['query'], json.loads(entry['settings']))
+            pipe.delete(exact_key)
+        pipe.execute()
+
+    def invalidate_agent(self, agent_name: str) -> int:
+        """Drops every cached response a request that may use the agent could get, for all versions."""
+        keys = []
+        for key in self.redis.scan_iter(match="response_cache:*:*"):
+            scope = key.split(':')[1]
+            if agent_name in scope.split(','):
+                keys.append(key)
+        if keys:
+            self.redis.delete(*keys)
+        return len(keys)
+
+    def stats(self) -> dict:
+        raw = self.redis.hgetall(STATS_KEY)
+        hits, misses = int(raw.get('hits', 0)), int(raw.get('misses', 0))
+        return {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0}
@@ -1,29 +1,17 @@
-from app.llm_inference import generate_response
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from app.llm_inference import generate_response, ensure_adapter, run_on_model
+from app.adapter_manager import get_adapter_manager
+from app.prefix_cache import get_prefix_cache, split_static_prefix, cache_layers, cache_from_layers
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+import torch
 import os
-import re
-
-def _parse_agent(response: str):
-    """Parses the LLM response to find a tool call."""
-    match = re.search(r'</think>\s*(.*)', response, re.DOTALL)
-    if '<think>' in response and match:
-        after_think = match.group(1).strip()
-        return after_think
-    else:
-        return response
+import time
 
-def route_request(
-    model: AutoModelForCausalLM,
-    tokenizer: AutoTokenizer,
-    user_query: str,
-    agents: list,
-    router_adapter_path: str,
-    **kwargs
-) -> str:
-    """Analyzes the user query using the shared model with router adapters."""
+ROUTER_PROMPT_STATIC_END = "User Query:"
+
+def _build_router_prompt(user_query: str, agents: list) -> str:
     agent_list_str = ", ".join(agents)
     
-    prompt = f"""Given the user's query, determine which of the following agents is best suited to respond. If no agent is clearly suitable, select the default agent: general_agent. 
+    return f"""Given the user's query, determine which of the following agents is best suited to respond. If no agent is clearly suitable, select the default agent: general_agent. 
 
 The available agents are: [{agent_list_str}].
 
@@ -35,38 +23,177 @@ Only replace AGENT_NAME with the chosen agent.
 User Query: "{user_query}"
 Agent:"""
 
-    print(prompt)
+def _end_of_turn_id(tokenizer) -> int:
+    """The token the chat template closes an assistant turn with, or EOS if it has none."""
+    marker = "AGENT_NAME"
+    try:
+        chat = [{"role": "user", "content": "Query"}, {"role": "assistant", "content": marker}]
+        rendered = tokenizer.apply_chat_template(chat, tokenize=False)
+        suffix = rendered[rendered.rindex(marker) + len(marker):].lstrip(" ")
+        suffix_ids = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+    except Exception:
+        suffix_ids = []
+    return suffix_ids[0] if suffix_ids else tokenizer.eos_token_id
+
+def _candidate_token_ids(tokenizer, prompt_for_model: str, prompt_ids: list, candidate: str) -> list:
+    """Returns the tokens of `candidate` as the model would emit them after the prompt."""
+    full_ids = tokenizer(prompt_for_model + candidate)["input_ids"]
+    if full_ids[:len(prompt_ids)] == prompt_ids:
+        return full_ids[len(prompt_ids):]
+    return tokenizer(candidate, add_special_tokens=False)["input_ids"]
+
+def _score_agents_on_model(model, tokenizer, prompt_ids: list, prefix_len: int, candidate_ids: list, adapter_name: str) -> list:
+    """
+    Returns the total log-likelihood of every candidate continuation. The prompt is
+    prefilled once (reusing the prefix cache) and all candidates are scored together
+    in a single batched forward pass over the shared prompt KV cache.
+    """
+    get_adapter_manager().activate(model, adapter_name)
+    device = model.device
+
+    cache = None
+    if prefix_len:
+        cache = get_prefix_cache().get(model, adapter_name, prompt_ids[:prefix_len])
+    start = cache.get_seq_length() if cache is not None else 0
+
+    prompt_tensor = torch.tensor([prompt_ids], device=device)
+    prefill = model(
+        input_ids=prompt_tensor[:, start:],
+        attention_mask=torch.ones_like(prompt_tensor),
+        cache_position=torch.arange(start, len(prompt_ids), device=device),
+        past_key_values=cache if cache is not None else DynamicCache(),
+        use_cache=True
+    )
+    first_log_probs = torch.log_softmax(prefill.logits[0, -1].float(), dim=-1)
+
+    num_candidates = len(candidate_ids)
+    max_len = max(len(ids) for ids in candidate_ids)
+    if max_len == 1:
+        return [float(first_log_probs[ids[0]]) for ids in candidate_ids]
+
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    cand_tensor = torch.full((num_candidates, max_len), pad_id, dtype=torch.long, device=device)
+    cand_mask = torch.zeros((num_candidates, max_len), dtype=torch.long, device=device)
+    for row, ids in enumerate(candidate_ids):
+        cand_tensor[row, :len(ids)] = torch.tensor(ids, device=device)
+        cand_mask[row, :len(ids)] = 1
+
+    shared_cache = cache_from_layers([
+        (k.expand(num_candidates, -1, -1, -1).contiguous(), v.expand(num_candidates, -1, -1, -1).contiguous())
+        for k, v in cache_layers(prefill.past_key_values)
+    ])
+    prompt_len = len(prompt_ids)
+    outputs = model(
+        input_ids=cand_tensor,
+        attention_mask=torch.cat([cand_mask.new_ones((num_candidates, prompt_len)), cand_mask], dim=1),
+        position_ids=torch.arange(prompt_len, prompt_len + max_len, device=device).unsqueeze(0).expand(num_candidates, -1),
+        cache_position=torch.arange(prompt_len, prompt_len + max_len, device=device),
+        past_key_values=shared_cache,
+        use_cache=True
+    )
+    log_probs = torch.log_softmax(outputs.logits.float(), dim=-1)
+
+    scores = []
+    for row, ids in enumerate(candidate_ids):
+        score = first_log_probs[ids[0]]
+        for position in range(1, len(ids)):
+            score = score + log_probs[row, position - 1, ids[position]]
+        scores.append(float(score))
+    return scores
+
+def score_agents(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    user_query: str,
+    agents: list,
+    adapter_name: str = None
+) -> tuple:
+    """
+    Scores every agent name by its log-likelihood as the router's answer.
+    Returns (best_agent, confidence, {agent: probability}) without any sampling.
+    """
+    prompt = _build_router_prompt(user_query, agents)
+    chat = [{"role": "user", "content": prompt}]
+    prompt_for_model = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
+    static_text = prompt[:prompt.index(ROUTER_PROMPT_STATIC_END)]
+    prompt_ids, prefix_len = split_static_prefix(tokenizer, prompt_for_model, static_text)
+
+    # Close each name with the end-of-turn token so a name that is a prefix of another isn't favoured.
+    end_of_turn = _end_of_turn_id(tokenizer)
+    candidate_ids = [_candidate_token_ids(tokenizer, prompt_for_model, prompt_ids, agent) + [end_of_turn] for agent in agents]
+
+    scores = run_on_model(model, tokenizer, _score_agents_on_model, prompt_ids, prefix_len, candidate_ids, adapter_name)
+
+    probabilities = torch.softmax(torch.tensor(scores), dim=0).tolist()
+    distribution = dict(zip(agents, probabilities))
+    best_index = max(range(len(agents)), key=lambda i: probabilities[i])
+    return agents[best_index], probabilities[best_index], distribution
+
+def route_request(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    user_query: str,
+    agents: list,
+    router_adapter_path: str,
+    mode: str = 'generate',
+    min_confidence: float = 0.0,
+    classifier_path: str = None,
+    classifier_min_confidence: float = 0.8,
+    **kwargs
+) -> str:
+    """
+    Analyzes the user query using the shared model with router adapters.
+    If a trained embedding classifier exists at `classifier_path` it is tried first,
+    and the LLM router is only used when its confidence is too low.
+    mode='score' picks the most likely agent name in one forward pass;
+    mode='generate' lets the router write the agent name freely.
+    """
+    if not agents:
+        return None
+
     print(f"\n[Router] Determining best agent for query: '{user_query}'")
 
-    adapter_loaded = False
-    if os.path.isdir(router_adapter_path):
-        try:
-            print(f"[Router] Loading adapter from: {router_adapter_path}")
-            model.load_adapter(router_adapter_path, adapter_name="router")
-            model.set_adapter("router")
-            adapter_loaded = True
-        except Exception as e:
-            print(f"[Router] ERROR: Failed to load adapter from '{router_adapter_path}'. Error: {e}")
-            print("[Router] Using base model for routing instead.")
-    else:
-        print(f"[Router] WARNING: Router adapter not found at '{router_adapter_path}'. Using base model for routing.")
+    classifier = None
+    if classifier_path:
+        from app.router_classifier import get_router_classifier
+        classifier = get_router_classifier(classifier_path)
+    if classifier is not None:
+        start = time.perf_counter()
+        chosen_agent, confidence = classifier.predict(user_query, agents)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if chosen_agent and confidence >= classifier_min_confidence:
+            print(f"[Router] Classifier decision: Route to '{chosen_agent}' agent (confidence {confidence:.2f}, {elapsed_ms:.1f} ms).")
+            return chosen_agent
+        print(f"[Router] Classifier unsure ('{chosen_agent}', confidence {confidence:.2f}, {elapsed_ms:.1f} ms). Falling back to the LLM router.")
+
+    adapter_name = ensure_adapter(model, "router", router_adapter_path)
+    if adapter_name is None:
+        print("[Router] Using base model for routing instead.")
+
+    if mode == 'score':
+        chosen_agent, confidence, distribution = score_agents(model, tokenizer, user_query, agents, adapter_name)
+        print(f"[Router] Scores: {distribution}")
+        if confidence < min_confidence:
+            print(f"[Router] Warning: Best agent '{chosen_agent}' is below the confidence threshold ({confidence:.2f} < {min_confidence}).")
+            return None
+        print(f"[Router] Decision: Route to '{chosen_agent}' agent (confidence {confidence:.2f}).")
+        return chosen_agent
+
+    prompt = _build_router_prompt(user_query, agents)
+    print(prompt)
 
+    # The router answers with the agent name alone, so its first line is the whole answer.
     chosen_agent = generate_response(
         model=model,
         tokenizer=tokenizer,
         prompt_text=prompt,
-        max_new_tokens=1024
+        max_new_tokens=1024,
+        adapter_name=adapter_name,
+        stop_strings=["\n"]
     )
     
     print(chosen_agent)
 
-    if adapter_loaded:
-        print("[Router] Unloading adapter.")
-        model.delete_adapter("router")
-
-    chosen_agent = _parse_agent(chosen_agent)
-    print(chosen_agent)
-
     chosen_agent = chosen_agent.strip().replace('.', '')
 
     if chosen_agent in agents:
@@ -0,0 +1,131 @@
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+CLASSIFIER_FILENAME = 'classifier.npz'
+
+
+def extract_router_query(prompt: str) -> str:
+    """Pulls the raw user query out of a router training prompt."""
+    match = re.search(r'User Query:\s*"(.*)"\s*Agent:\s*$', prompt, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    match = re.search(r'\n\n(.*)\nAgent:\s*$', prompt, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    return prompt.strip()
+
+def load_router_examples(dataset_paths: list) -> list:
+    """Reads (query, agent) pairs from router SFT .jsonl files that exist."""
+    examples = []
+    for path in dataset_paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                query = extract_router_query(record.get('prompt', ''))
+                label = record.get('completion', '').strip().replace('.', '')
+                if query and label:
+                    examples.append((query, label))
+    return examples
+
+
+class RouterClassifier:
+    """
+    A softmax-regression classifier over sentence-transformer embeddings.
+    Used as a fast routing tier in front of the LLM router.
+    """
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, labels: list):
+        self.weights = weights
+        self.bias = bias
+        self.labels = list(labels)
+
+    @staticmethod
+    def _embed(texts: list) -> np.ndarray:
+        # Imported on first use: rag_handler pulls in faiss and sentence-transformers.
+        from rag.rag_handler import get_sentence_model
+        return np.asarray(get_sentence_model().encode(texts, normalize_embeddings=True), dtype=np.float32)
+
+    @classmethod
+    def train(cls, examples: list, epochs: int = 500, learning_rate: float = 5.0, l2: float = 1e-4):
+        """Fits the classifier on (query, agent) pairs with full-batch gradient descent."""
+        labels = sorted({label for _, label in examples})
+        label_index = {label: i for i, label in enumerate(labels)}
+
+        features = cls._embed([query for query, _ in examples])
+        targets = np.zeros((len(examples), len(labels)), dtype=np.float32)
+        for row, (_, label) in enumerate(examples):
+            targets[row, label_index[label]] = 1.0
+
+        weights = np.zeros((features.shape[1], len(labels)), dtype=np.float32)
+        bias = np.zeros(len(labels), dtype=np.float32)
+        for _ in range(epochs):
+            probs = _softmax(features @ weights + bias)
+            error = (probs - targets) / len(examples)
+            weights -= learning_rate * (features.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        return cls(weights, bias, labels)
+
+    def predict(self, query: str, agents: list = None) -> tuple:
+        """
+        Returns (agent, confidence) for the query, restricted to `agents` if given.
+        The confidence is the agent's probability among all trained labels, so a query
+        meant for an agent the user can't use doesn't look certain for the ones they can.
+        Returns (None, 0.0) if none of the allowed agents were seen in training.
+        """
+        allowed = [i for i, label in enumerate(self.labels) if agents is None or label in agents]
+        if not allowed:
+            return None, 0.0
+        probs = _softmax(self._embed([query]) @ self.weights + self.bias)[0]
+        best = allowed[int(np.argmax(probs[allowed]))]
+        return self.labels[best], float(probs[best])
+
+    def save(self, output_dir: str):
+        os.makedirs(output_dir, exist_ok=True)
+        np.savez(os.path.join(output_dir, CLASSIFIER_FILENAME), weights=self.weights, bias=self.bias, labels=np.array(self.labels))
+
+    @classmethod
+    def load(cls, model_dir: str):
+        data = np.load(os.path.join(model_dir, CLASSIFIER_FILENAME))
+        return cls(data['weights'], data['bias'], [str(label) for label in data['labels']])
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+_CLASSIFIERS = {}
+
+def get_router_classifier(model_dir: str):
+    """
+    Returns the classifier stored in `model_dir`, or None if it hasn't been trained.
+    It is cached by the file's modification time, so a classifier trained or retrained
+    while the worker runs is picked up on the next request.
+    """
+    file_path = os.path.join(model_dir, CLASSIFIER_FILENAME)
+    mtime = os.path.getmtime(file_path) if os.path.exists(file_path) else None
+    cached = _CLASSIFIERS.get(model_dir)
+    if cached is None or cached[0] != mtime:
+        if mtime is not None:
+            print(f"[Router Classifier] Loading classifier from: {model_dir}")
+            _CLASSIFIERS[model_dir] = (mtime, RouterClassifier.load(model_dir))
+        else:
+            print(f"[Router Classifier] WARNING: No classifier found at '{model_dir}'. Using the LLM router only.")
+            _CLASSIFIERS[model_dir] = (None, None)
+    return _CLASSIFIERS[model_dir][1]
+
+def time_predictions(classifier: RouterClassifier, queries: list) -> float:
+    """Returns the mean prediction latency in milliseconds."""
+    start = time.perf_counter()
+    for query in queries:
+        classifier.predict(query)
+    return (time.perf_counter() - start) * 1000 / max(len(queries), 1)
@@ -0,0 +1,95 @@
+from collections import Counter, deque
+
+DEFAULT_LANE_WEIGHTS = {'admin': 8, 'interactive': 4, 'api': 2, 'batch': 1}
+
+
+class FairScheduler:
+    """
+    Decides which buffered job runs next when a worker slot frees up. Jobs are
+    grouped into priority lanes and, within a lane, into per-user queues. Both levels
+    use stride scheduling: the lane (or user) with the lowest pass runs next and its
+    pass then grows by 1/weight, so a lane or user with twice the weight gets twice
+    the slots and a user with many queued jobs can't starve one with a single job.
+    Users at their concurrency cap are skipped until one of their jobs finishes.
+    """
+    def __init__(self, config: dict = None):
+        """
+        :param config: The 'scheduler' section of the config.yaml.
+        """
+        config = config or {}
+        self.lane_weights = dict(DEFAULT_LANE_WEIGHTS)
+        self.lane_weights.update(config.get('lane_weights') or {})
+        self.default_lane = config.get('default_lane', 'interactive')
+        self.max_concurrent_per_user = int(config.get('max_concurrent_per_user', 2))
+        self._queues = {lane: {} for lane in self.lane_weights}
+        self._lane_pass = {lane: 0.0 for lane in self.lane_weights}
+        self._user_pass = {}
+        self._lane_clock = {lane: 0.0 for lane in self.lane_weights}
+        self._clock = 0.0
+        self._running = Counter()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, job: dict):
+        """
+        Buffers a job. `job['meta']` may carry the 'user_id', 'lane', 'weight' and
+        'max_concurrent' the web app attached when queueing it.
+        """
+        meta = job.get('meta') or {}
+        lane = meta.get('lane') if meta.get('lane') in self.lane_weights else self.default_lane
+        user_key = (lane, meta.get('user_id'))
+        queues = self._queues[lane]
+        if not queues:
+            # An idle lane rejoins at the current clock instead of cashing in saved-up credit.
+            self._lane_pass[lane] = max(self._lane_pass[lane], self._clock)
+        if user_key[1] not in queues:
+            queues[user_key[1]] = deque()
+            self._user_pass[user_key] = max(self._user_pass.get(user_key, 0.0), self._lane_clock[lane])
+        queues[user_key[1]].append(job)
+        self._size += 1
+
+    def _runnable_user(self, lane: str):
+        best = None
+        for user_id, queue in self._queues[lane].items():
+            meta = queue[0].get('meta') or {}
+            cap = meta.get('max_concurrent') or self.max_concurrent_per_user
+            if self._running[user_id] >= cap:
+                continue
+            if best is None or self._user_pass[(lane, user_id)] < self._user_pass[(lane, best)]:
+                best = user_id
+        return best
+
+    def pop(self):
+        """Returns the next job to run, or None if nothing is buffered or every user is at their cap."""
+        for lane in sorted((lane for lane in self._queues if self._queues[lane]), key=lambda lane: self._lane_pass[lane]):
+            user_id = self._runnable_user(lane)
+            if user_id is None:
+                continue
+            queue = self._queues[lane][user_id]
+            job = queue.popleft()
+            if not queue:
+                del self._queues[lane][user_id]
+
+            weight = max(float((job.get('meta') or {}).get('weight') or 1), 0.01)
+            self._clock = self._lane_pass[lane]
+            self._lane_pass[lane] += 1.0 / self.lane_weights[lane]
+            self._lane_clock[lane] = self._user_pass[(lane, user_id)]
+            self._user_pass[(lane, user_id)] += 1.0 / weight
+            self._running[user_id] += 1
+            self._size -= 1
+            return job
+        return None
+
+    def finished(self, user_id):
+        """Frees one of the user's concurrency slots."""
+        self._running[user_id] -= 1
+        if self._running[user_id] <= 0:
+            del self._running[user_id]
+
+    def entry_ids(self) -> list:
+        return [job['entry_id'] for queues in self._queues.values() for queue in queues.values() for job in queue]
+
+    def stats(self) -> dict:
+        return {lane: sum(len(queue) for queue in queues.values()) for lane, queues in self._queues.items()}
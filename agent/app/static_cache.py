@@ -0,0 +1,124 @@
+import threading
+
+import torch
+from transformers import StaticCache
+
+
+def _cache_class(model):
+    """
+    The static cache type the model needs: models with sliding-window layers (Gemma 2/3)
+    ask for a HybridCache through their generation config, the rest use a StaticCache.
+    """
+    if getattr(model.generation_config, 'cache_implementation', None) == 'hybrid':
+        from transformers import HybridCache
+        return HybridCache
+    return StaticCache
+
+def _compute_dtype(model) -> torch.dtype:
+    """The dtype the KV states are computed in. For int8/nf4 models `model.dtype` can be the storage dtype."""
+    return model.get_input_embeddings().weight.dtype
+
+
+class StaticCachePool:
+    """
+    Pre-allocated static KV caches for the compiled `model.generate` fast path. Total
+    sequence lengths are rounded up to a fixed set of buckets, so the compiled decode
+    step only ever sees a handful of cache shapes and doesn't recompile per request.
+    """
+    def __init__(self, model, config: dict = None):
+        """
+        :param config: The 'compile' section of the config.yaml.
+        """
+        config = config or {}
+        self.model = model
+        self.buckets = sorted(int(b) for b in config.get('length_buckets', [1024, 2048, 4096, 8192]))
+        self._caches = {}
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def cache_for(self, bucket: int):
+        """Returns the bucket's reset cache, allocating it on first use."""
+        cache = self._caches.get(bucket)
+        if cache is None:
+            print(f"[Static Cache] Allocating static KV cache for {bucket} tokens.")
+            cache = _cache_class(self.model)(
+                config=self.model.config,
+                max_batch_size=1,
+                max_cache_len=bucket,
+                device=self.model.device,
+                dtype=_compute_dtype(self.model)
+            )
+            self._caches[bucket] = cache
+        else:
+            cache.reset()
+        return cache
+
+    def bucket_for(self, prompt_len: int, max_new_tokens: int):
+        """Returns the smallest bucket that fits the prompt and all new tokens, or None if none does."""
+        for bucket in self.buckets:
+            if prompt_len + max_new_tokens <= bucket:
+                return bucket
+        return None
+
+    def acquire(self, prompt_len: int, max_new_tokens: int):
+        """
+        Returns a cache for the request, or None if no bucket fits it or the bucket's
+        cache is in use. Requests are never shortened to fit a bucket; those that don't
+        fit generate with a regular dynamic cache instead.
+        """
+        bucket = self.bucket_for(prompt_len, max_new_tokens)
+        if bucket is None:
+            print(f"[Static Cache] {prompt_len} prompt + {max_new_tokens} new tokens exceed the largest bucket ({self.buckets[-1]}). Using a dynamic cache.")
+            return None
+        with self._lock:
+            if bucket in self._busy:
+                return None
+            self._busy.add(bucket)
+        return self.cache_for(bucket)
+
+    def owns(self, cache) -> bool:
+        return any(pooled is cache for pooled in self._caches.values())
+
+    def release(self, cache):
+        with self._lock:
+            for bucket, pooled in self._caches.items():
+                if pooled is cache:
+                    self._busy.discard(bucket)
+
+
+def enable_compiled_decoding(model, config: dict = None) -> StaticCachePool:
+    """
+    Compiles the model's single-token decode step and returns the static cache pool to
+    generate with. Prefill has a different length every request, so it stays eager,
+    as do calls on any cache that isn't from the pool.
+    """
+    config = config or {}
+    mode = config.get('mode', 'reduce-overhead')
+    pool = StaticCachePool(model, config)
+    print(f"[Static Cache] Compiling the model's decode step with torch.compile (mode={mode}).")
+    eager_forward = model.forward
+    compiled_forward = torch.compile(eager_forward, mode=mode, dynamic=False)
+
+    def forward(*args, **kwargs):
+        input_ids = kwargs.get('input_ids', args[0] if args else None)
+        if input_ids is not None and input_ids.shape[-1] == 1 and pool.owns(kwargs.get('past_key_values')):
+            return compiled_forward(*args, **kwargs)
+        return eager_forward(*args, **kwargs)
+
+    model.forward = forward
+    return pool
+
+def warm_up_compiled_decoding(model, tokenizer, pool: StaticCachePool, warmup_tokens: int = 8):
+    """Runs a short generation per bucket so compilation happens before the first request."""
+    input_ids = tokenizer("Hello", return_tensors="pt")["input_ids"].to(model.device)
+    for bucket in pool.buckets:
+        cache = pool.cache_for(bucket)
+        print(f"[Static Cache] Warming up compiled decoding for the {bucket}-token bucket...")
+        with torch.no_grad():
+            model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                max_new_tokens=warmup_tokens,
+                do_sample=False
+            )
@@ -1,5 +1,5 @@
 import os, re
-from app.llm_inference import generate_response, generate_response_stream
+from app.llm_inference import generate_response, generate_response_stream, ensure_adapter
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from tools.tool_registry import TOOL_REGISTRY
 
@@ -29,6 +29,9 @@ def _format_tool_prompt(allowed_tools: list) -> str:
 
     return "\n".join(prompt_lines)
 
+TOOL_CALL_OPEN = "<tool_code>"
+TOOL_CALL_CLOSE = "</tool_code>"
+
 def _parse_tool_call(response: str):
     """Parses the LLM response to find a tool call."""
     match = re.search(r"<tool_code>(.*?)</tool_code>", response)
@@ -38,6 +41,13 @@ def _parse_tool_call(response: str):
         return call_str
     return None
 
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Length of the longest end of `text` that could be the start of `tag`."""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
 def _execute_tool(call_str: str) -> str:
     """Executes a tool call string and returns the result."""
     try:
@@ -63,6 +73,16 @@ def _execute_tool(call_str: str) -> str:
     except Exception as e:
         return f"Error executing tool '{call_str}': {e}"
 
+def _load_master_prompt(agent_config: dict):
+    """Reads the agent's prompt file, returning None if it cannot be found."""
+    for prompt_path in ('../agent' + agent_config['prompt_file'], agent_config['prompt_file']):
+        try:
+            with open(prompt_path, 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            continue
+    return None
+
 def handle_with_subagent(
     model: AutoModelForCausalLM,
     tokenizer: AutoTokenizer,
@@ -77,30 +97,18 @@ def handle_with_subagent(
     adapter_path = agent_config['model_path']
     allowed_tools = agent_config.get('tools_whitelist', [])
 
-    adapter_loaded = False
-    if os.path.isdir(adapter_path):
-        print(f"[{agent_name.capitalize()} Agent] Loading adapter from: {adapter_path}")
-        model.load_adapter(adapter_path, adapter_name=agent_name)
-        model.set_adapter(agent_name)
-        adapter_loaded = True
-    else:
+    adapter_name = ensure_adapter(model, agent_name, adapter_path)
+    if adapter_name is None:
         print(f"[{agent_name.capitalize()} Agent] Warning: Adapter not found at '{adapter_path}'. Using base model.")
 
-    print(os.getcwd())
-    print('../agent' + agent_config['prompt_file'])
-    try:
-        with open('../agent' + agent_config['prompt_file'], 'r') as f:
-            master_prompt = f.read().strip()
-    except FileNotFoundError:
-        try:
-            with open(agent_config['prompt_file'], 'r') as f:
-                master_prompt = f.read().strip()
-        except FileNotFoundError:
-            return f"Error: Prompt file not found."
+    master_prompt = _load_master_prompt(agent_config)
+    if master_prompt is None:
+        return f"Error: Prompt file not found."
 
     tool_prompt = _format_tool_prompt(allowed_tools)
     
     master_prompt = f"{master_prompt}\n{tool_prompt}"
+    static_prompt = master_prompt
     
     print(master_prompt)
 
@@ -114,6 +122,9 @@ def handle_with_subagent(
             prompt_text=user_query,
             prompt_history=prompt_history,
             prompt_master_prompt=master_prompt,
+            cache_prefix=static_prompt,
+            adapter_name=adapter_name,
+            stop_strings=[TOOL_CALL_CLOSE],
             **kwargs
         )
         print(f"--- [Loop {i+1}] LLM Raw Response: {llm_response} ---")
@@ -136,87 +147,90 @@ def handle_with_subagent(
             master_prompt = master_prompt + f"\nObservation: <tool_called>{tool_call_str}</tool_called>\n <tool_result>{result}</tool_result>"
             user_query = f"Now, provide a final answer to the user based on the tool's result. Initial Question to Awnser: {user_query}"
         else:
-            if adapter_loaded:
-                print(f"[{agent_name.capitalize()} Agent] Unloading adapter.")
-                model.delete_adapter(agent_name)
             return llm_response 
     
     final_answer = "The agent could not determine a final answer after using its tools."
-    if adapter_loaded:
-        model.delete_adapter(agent_name)
     return final_answer
 
 def handle_with_subagent_stream(
-    model,
-    tokenizer,
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
     agent_name: str,
-    user_query_with_history: str,
+    user_query: str,
+    prompt_history: list,
     agent_config: dict,
-    generation_kwargs: dict,
-    max_loops: int = 3
+    max_loops: int = 10,
+    **kwargs
 ) -> iter:
     """
-    Handles the user query with a subagent, supports tool use, and STREAMS the final response.
-    This is now a generator function.
+    Streaming variant of `handle_with_subagent`. Text is yielded as it arrives, except
+    for anything that could be the start of a tool call: once `<tool_code>` opens, the
+    rest of the turn is held back until generation ends and the tool is run.
     """
     adapter_path = agent_config['model_path']
     allowed_tools = agent_config.get('tools_whitelist', [])
     
-    adapter_loaded = False
-    if os.path.isdir(adapter_path):
-        print(f"[{agent_name.capitalize()} Agent] Loading adapter from: {adapter_path}")
-        model.load_adapter(adapter_path, adapter_name=agent_name)
-        model.set_adapter(agent_name)
-        adapter_loaded = True
-    else:
+    adapter_name = ensure_adapter(model, agent_name, adapter_path)
+    if adapter_name is None:
         print(f"[{agent_name.capitalize()} Agent] Warning: Adapter not found at '{adapter_path}'. Using base model.")
 
-    try:
-        with open('../agent' + agent_config['prompt_file'], 'r') as f:
-            master_prompt = f.read().strip()
-    except FileNotFoundError:
-        return f"Error: Prompt file not found."
+    master_prompt = _load_master_prompt(agent_config)
+    if master_prompt is None:
+        yield f"Error: Prompt file not found."
+        return
 
-    try:
-        tool_prompt = _format_tool_prompt(allowed_tools)
-        
-        initial_context = [
-            master_prompt,
-            tool_prompt,
-            f"\n{user_query_with_history}"
-        ]
-        
-        conversation_history = list(initial_context)
-
-        for i in range(max_loops):
-            full_prompt = "\n".join(conversation_history)
-
-            from .llm_inference import generate_response
-            llm_decision = generate_response(
-                model=model,
-                tokenizer=tokenizer,
-                prompt_text=full_prompt,
-                max_new_tokens=256,
-                **generation_kwargs
-            )
-            
-            tool_call_str = _parse_tool_call(llm_decision)
+    tool_prompt = _format_tool_prompt(allowed_tools)
+    master_prompt = f"{master_prompt}\n{tool_prompt}"
+    static_prompt = master_prompt
 
-            if tool_call_str:
-                result = _execute_tool(tool_call_str)
-                synthesis_prompt = f"""
-Observation: <tool_result>{result}</tool_result>
-Thought: Now I have the result. I will use it to form the final answer.
-Final Answer:"""
-                conversation_history.append(synthesis_prompt)
-            else:
-                final_prompt_for_streaming = f"{full_prompt}\nAssistant: {llm_decision}"
-                
-                print(f"[Subagent Handler] Streaming final answer for agent '{agent_name}'.")
-                yield from generate_response_stream(model, tokenizer, final_prompt_for_streaming, **generation_kwargs) # handle without stream generate_response
-                
-                break
-    finally:
-        if adapter_loaded:
-            print(f"[{agent_name.capitalize()} Agent] Unloading adapter.")
-            model.delete_adapter(agent_name)
\ No newline at end of file
+    separator = ""
+    for i in range(max_loops):
+        print(f"\n--- [Loop {i+1}] Streaming prompt to LLM ---")
+        llm_response = ""
+        sent = 0
+        tool_call_started = False
+        for chunk in generate_response_stream(
+            model=model,
+            tokenizer=tokenizer,
+            prompt_text=user_query,
+            prompt_history=prompt_history,
+            prompt_master_prompt=master_prompt,
+            cache_prefix=static_prompt,
+            adapter_name=adapter_name,
+            stop_strings=[TOOL_CALL_CLOSE],
+            **kwargs
+        ):
+            llm_response += chunk
+            if tool_call_started:
+                continue
+            if TOOL_CALL_OPEN in llm_response[sent:]:
+                tool_call_started = True
+                continue
+            # Hold back an ending that could still turn into the opening tag.
+            safe_end = len(llm_response) - _partial_tag_length(llm_response, TOOL_CALL_OPEN)
+            if safe_end > sent:
+                yield separator + llm_response[sent:safe_end]
+                separator = ""
+                sent = safe_end
+
+        tool_call_str = _parse_tool_call(llm_response)
+        if not tool_call_str:
+            if len(llm_response) > sent:
+                yield separator + llm_response[sent:]
+            return
+        if sent:
+            # Keep the text said before the tool call apart from the answer that follows it.
+            separator = "\n\n"
+
+        print(f"[Subagent Handler] Agent wants to call tool: {tool_call_str}")
+        tool_name = tool_call_str.split('(')[0]
+        if tool_name not in allowed_tools:
+            result = f"Error: You are not permitted to use the tool '{tool_name}'."
+        else:
+            result = _execute_tool(tool_call_str)
+        print(f"[Subagent Handler] Tool result: {result}")
+
+        master_prompt = master_prompt + f"\nObservation: <tool_called>{tool_call_str}</tool_called>\n <tool_result>{result}</tool_result>"
+        user_query = f"Now, provide a final answer to the user based on the tool's result. Initial Question to Awnser: {user_query}"
+
+    yield "The agent could not determine a final answer after using its tools."
@@ -1,10 +1,10 @@
 import argparse
+import json
 import os
 import sys
 import yaml
 import subprocess
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'configs/config.yaml')
 PROMPTS_DIR = os.path.join(os.path.dirname(__file__), 'configs/prompts')
@@ -33,25 +33,13 @@ def load_admin_llm():
     """Loads the base LLM for the admin agent's tasks."""
     global ADMIN_MODEL, ADMIN_TOKENIZER
     if ADMIN_MODEL is not None: return
+    from app.llm_inference import load_base_model_and_tokenizer
 
     print(f"--- Loading Admin Agent LLM ({ADMIN_AGENT_BASE_MODEL_ID}) ---")
     print("This may take a moment...")
-    compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
-
-    quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4", bnb_4bit_compute_dtype=compute_dtype, bnb_4bit_use_double_quant=False,)
-    
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"[LLM Inference] Using device: {device}")
-    attn_implementation = "sdpa"
+    precision = load_config().get('precision', {}).get('admin_profile', 'nf4')
     try:
-        ADMIN_TOKENIZER = AutoTokenizer.from_pretrained(ADMIN_AGENT_BASE_MODEL_ID)
-        ADMIN_MODEL = AutoModelForCausalLM.from_pretrained(
-            ADMIN_AGENT_BASE_MODEL_ID,
-            device_map=device,
-            quantization_config=quantization_config,
-            attn_implementation=attn_implementation,
-            torch_dtype=compute_dtype
-        )
+        ADMIN_MODEL, ADMIN_TOKENIZER = load_base_model_and_tokenizer(ADMIN_AGENT_BASE_MODEL_ID, precision)
         print("--- LLM Loaded Successfully ---")
     except Exception as e:
         print(f"FATAL: Could not load the language model. Error: {e}"); sys.exit(1)
@@ -200,6 +188,17 @@ def handle_agents_delete(args):
     save_config(config)
     print(f"Agent '{agent_name}' removed from configuration.")
 
+def _invalidate_response_cache(agent_name: str):
+    """Drops an agent's cached responses after its adapter was retrained."""
+    from app.redis_client import get_redis_client
+    from app.response_cache import ResponseCache
+    import redis
+    try:
+        removed = ResponseCache(get_redis_client()).invalidate_agent(agent_name)
+        print(f"Cleared {removed} response cache keys for '{agent_name}'.")
+    except redis.exceptions.RedisError as e:
+        print(f"Warning: Could not clear the response cache for '{agent_name}': {e}")
+
 def handle_train_run(args):
     """Runs the training script for a specific agent or the router."""
     target = args.target
@@ -247,9 +246,46 @@ def handle_train_run(args):
     try:
         subprocess.run(command, check=True)
         print(f"\n✅ Training for '{target}' completed successfully.")
+        if target != 'router':
+            _invalidate_response_cache(target)
     except subprocess.CalledProcessError as e:
         print(f"\n❌ Training for '{target}' failed with exit code {e.returncode}.")
 
+def handle_train_router_classifier(args):
+    """Trains the embedding-based router classifier used as the fast routing tier."""
+    from app.router_classifier import RouterClassifier, load_router_examples, time_predictions
+    import random
+
+    config = load_config()
+    agents = list(config.get('agents', {}).keys())
+    dataset_paths = args.dataset_path or ['data/agents/router_sft_data.jsonl', 'data/agents/router_sft_data_from_feedback.jsonl']
+    output_dir = args.output_dir or config.get('router', {}).get('classifier_path', 'models/router_classifier')
+
+    print(f"--- Training router classifier from: {', '.join(dataset_paths)} ---")
+    examples = load_router_examples(dataset_paths)
+    unknown = {label for _, label in examples if label not in agents}
+    if unknown:
+        print(f"Warning: Skipping examples for agents not in config.yaml: {sorted(unknown)}")
+        examples = [(query, label) for query, label in examples if label in agents]
+
+    if not examples:
+        print("Error: No router training examples found. Create data/agents/router_sft_data.jsonl or run the Django 'export_router_data' command first.")
+        return
+
+    random.Random(42).shuffle(examples)
+    holdout_size = len(examples) // 10
+    if holdout_size:
+        holdout, train_examples = examples[:holdout_size], examples[holdout_size:]
+        classifier = RouterClassifier.train(train_examples, epochs=args.epochs, learning_rate=args.learning_rate)
+        correct = sum(1 for query, label in holdout if classifier.predict(query)[0] == label)
+        print(f"Holdout accuracy: {correct}/{len(holdout)} ({correct / len(holdout):.1%})")
+
+    classifier = RouterClassifier.train(examples, epochs=args.epochs, learning_rate=args.learning_rate)
+    latency_ms = time_predictions(classifier, [query for query, _ in examples[:50]])
+    classifier.save(output_dir)
+    print(f"Trained on {len(examples)} examples across {len(classifier.labels)} agents. Mean routing latency: {latency_ms:.1f} ms.")
+    print(f"\n✅ Router classifier saved to '{output_dir}'.")
+
 def handle_train_dpo(args):
     """Runs the DPO training script for a specific agent."""
     target_agent = args.target
@@ -292,11 +328,178 @@ def handle_train_dpo(args):
     try:
         subprocess.run(command, check=True)
         print(f"\n✅ DPO training for '{target_agent}' completed successfully.")
+        _invalidate_response_cache(target_agent)
         print(f"New adapters saved to '{output_dir}'.")
         print(f"To use them, update 'model_path' for '{target_agent}' in config.yaml to point to this new directory.")
     except subprocess.CalledProcessError as e:
         print(f"\n❌ DPO training for '{target_agent}' failed with exit code {e.returncode}.")
 
+def _load_bench_adapters(model, config: dict, selected: list = None) -> list:
+    """Loads the agent adapters to benchmark; returns (label, adapter_name) pairs, base model first."""
+    from app.adapter_manager import get_adapter_manager
+    targets = [('base', None)]
+    for agent_name, agent_config in config.get('agents', {}).items():
+        if selected and agent_name not in selected:
+            continue
+        adapter_path = os.path.join(os.path.dirname(__file__), agent_config.get('model_path', ''))
+        adapter_name = get_adapter_manager().ensure(model, agent_name, adapter_path)
+        if adapter_name:
+            targets.append((agent_name, adapter_name))
+    return targets
+
+def handle_bench_speculative(args):
+    """Compares decode speed with and without the speculative-decoding draft model, per agent adapter."""
+    from app.llm_inference import load_base_model_and_tokenizer, load_draft_model, set_draft_model
+    from app.benchmark import BENCH_PROMPTS, measure_generation
+
+    config = load_config()
+    draft_model_id = args.draft_model or config.get('speculative', {}).get('draft_model')
+    if not draft_model_id:
+        print("Error: No draft model given. Pass --draft_model or set `speculative.draft_model` in config.yaml.")
+        return
+
+    model, tokenizer = load_base_model_and_tokenizer(config['base_model'], config.get('precision', {}).get('profile', 'int8'))
+    draft_model = load_draft_model(draft_model_id, args.num_assistant_tokens)
+    # A fixed draft length makes the acceptance estimate below exact.
+    draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+
+    print(f"--- Benchmarking speculative decoding with '{draft_model_id}' ({args.num_assistant_tokens} draft tokens) ---")
+    print(f"{'Target':<20} {'Mode':<12} {'TTFT ms':>9} {'Tok/s':>8} {'Tok/fwd':>8} {'Accept':>7}")
+    for label, adapter_name in _load_bench_adapters(model, config, args.agents):
+        for mode, draft in (('baseline', None), ('speculative', draft_model)):
+            set_draft_model(draft)
+            torch.manual_seed(0)
+            result = measure_generation(model, tokenizer, BENCH_PROMPTS, args.max_new_tokens, adapter_name, temperature=args.temperature)
+            acceptance = max(result['tokens_per_forward'] - 1, 0) / args.num_assistant_tokens if draft else None
+            acceptance_str = f"{acceptance:.0%}" if acceptance is not None else "-"
+            print(f"{label:<20} {mode:<12} {result['ttft_ms']:>9} {result['tokens_per_s']:>8} {result['tokens_per_forward']:>8} {acceptance_str:>7}")
+    set_draft_model(None)
+
+def _set_precision_profile(profile: str):
+    """
+    Points `precision.profile` in config.yaml at a profile by rewriting only that line,
+    so the file's comments survive (save_config would drop them).
+    """
+    with open(CONFIG_PATH, 'r') as f:
+        lines = f.readlines()
+    in_precision = False
+    for i, line in enumerate(lines):
+        if line.strip() and not line[0].isspace():
+            in_precision = line.startswith('precision:')
+        elif in_precision and line.lstrip().startswith('profile:'):
+            indent = line[:len(line) - len(line.lstrip())]
+            lines[i] = f"{indent}profile: {profile}\n"
+            with open(CONFIG_PATH, 'w') as f:
+                f.writelines(lines)
+            print(f"✅ Set precision.profile to '{profile}' in {CONFIG_PATH}")
+            return
+    config = load_config()
+    config.setdefault('precision', {})['profile'] = profile
+    save_config(config)
+
+def handle_bench_precision(args):
+    """Measures every precision profile on this host; with --apply the fastest viable one becomes the worker's."""
+    from app.llm_inference import PRECISION_PROFILES, precision_profile_available, load_base_model_and_tokenizer
+    from app.benchmark import BENCH_PROMPTS, measure_generation
+    import gc
+    import time
+
+    config = load_config()
+    profiles = args.profiles or list(PRECISION_PROFILES)
+    results = {}
+
+    print(f"--- Benchmarking precision profiles for '{config['base_model']}' ---")
+    for profile in profiles:
+        if not precision_profile_available(profile):
+            print(f"Skipping '{profile}': not supported on this host.")
+            continue
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            start = time.perf_counter()
+            model, tokenizer = load_base_model_and_tokenizer(config['base_model'], profile)
+            load_time = time.perf_counter() - start
+            torch.manual_seed(0)
+            result = measure_generation(model, tokenizer, BENCH_PROMPTS, args.max_new_tokens)
+        except Exception as e:
+            print(f"Skipping '{profile}': failed with {e}")
+            continue
+        result['load_s'] = round(load_time, 1)
+        result['memory_mb'] = round(model.get_memory_footprint() / (1024 * 1024))
+        if torch.cuda.is_available():
+            result['peak_gpu_mb'] = round(torch.cuda.max_memory_allocated() / (1024 * 1024))
+        results[profile] = result
+        del model
+        gc.collect()
+
+    if not results:
+        print("Error: No precision profile could be benchmarked on this host.")
+        return
+
+    print(f"\n{'Profile':<18} {'Load s':>7} {'Mem MB':>8} {'TTFT ms':>9} {'Tok/s':>8}")
+    for profile, result in results.items():
+        print(f"{profile:<18} {result['load_s']:>7} {result['memory_mb']:>8} {result['ttft_ms']:>9} {result['tokens_per_s']:>8}")
+
+    best = max(results, key=lambda profile: results[profile]['tokens_per_s'])
+    print(f"\nFastest viable profile: '{best}'")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'base_model': config['base_model'], 'results': results}, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.apply:
+        _set_precision_profile(best)
+    else:
+        print("Pass --apply to use it as precision.profile.")
+
+def handle_bench_cpu(args):
+    """Measures aggregate CPU throughput for NUM_WORKERS x threads-per-worker combinations."""
+    from app.benchmark import BENCH_PROMPTS, cpu_bench_worker
+    from app.cpu_affinity import available_cores, partition_cores
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing as mp
+
+    config = load_config()
+    cores = available_cores()
+    worker_counts = args.workers or [n for n in (1, 2, 4, 8, 16, 32) if n <= len(cores)]
+    interop_threads = config.get('cpu', {}).get('interop_threads', 1)
+    context = mp.get_context('spawn')
+
+    print(f"--- Benchmarking CPU throughput on {len(cores)} cores ---")
+    rows = []
+    for num_workers in worker_counts:
+        thread_counts = args.threads or [len(cores) // num_workers]
+        for threads in thread_counts:
+            if threads < 1:
+                continue
+            partitions = partition_cores(num_workers, threads)
+            with context.Manager() as manager, ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as executor:
+                barrier = manager.Barrier(num_workers)
+                futures = [
+                    executor.submit(cpu_bench_worker, config['base_model'], 'cpu-int8-dynamic', partition, interop_threads, BENCH_PROMPTS, args.max_new_tokens, barrier)
+                    for partition in partitions
+                ]
+                results = [future.result() for future in futures]
+            total_tokens = sum(result['tokens'] for result in results)
+            wall_time = max(result['duration_s'] for result in results)
+            rows.append({
+                'workers': num_workers,
+                'threads': threads,
+                'tokens_per_s': round(total_tokens / wall_time, 2),
+                'ttft_ms': round(sum(result['ttft_ms'] for result in results) / len(results), 1),
+            })
+            print(f"workers={num_workers} threads={threads}: {rows[-1]['tokens_per_s']} tok/s aggregate, {rows[-1]['ttft_ms']} ms TTFT")
+
+    if not rows:
+        print("Error: No worker/thread combination could be benchmarked.")
+        return
+
+    print(f"\n{'Workers':>8} {'Threads':>8} {'Tok/s':>9} {'TTFT ms':>9}")
+    for row in rows:
+        print(f"{row['workers']:>8} {row['threads']:>8} {row['tokens_per_s']:>9} {row['ttft_ms']:>9}")
+    best = max(rows, key=lambda row: row['tokens_per_s'])
+    print(f"\nBest throughput: NUM_WORKERS={best['workers']} with cpu.threads_per_worker={best['threads']}")
+
 
 def main():
     parser = argparse.ArgumentParser(description="Admin CLI for the Gemma Multi-Agent System.")
@@ -340,6 +543,13 @@ def main():
     parser_run_sft.add_argument('--learning_rate', type=float, default=5e-5, help='Learning rate')
     parser_run_sft.set_defaults(func=handle_train_run)
     
+    parser_router_clf = train_subparsers.add_parser('router-classifier', help='Train the fast embedding-based router classifier')
+    parser_router_clf.add_argument('--dataset_path', type=str, action='append', help="(Optional, repeatable) Router .jsonl dataset. Defaults to the router SFT data and exported feedback routes")
+    parser_router_clf.add_argument('--output_dir', type=str, help="(Optional) Where to save the classifier. Defaults to router.classifier_path in config.yaml")
+    parser_router_clf.add_argument('--epochs', type=int, default=500, help='Number of gradient descent steps')
+    parser_router_clf.add_argument('--learning_rate', type=float, default=5.0, help='Learning rate')
+    parser_router_clf.set_defaults(func=handle_train_router_classifier)
+
     parser_run_dpo = train_subparsers.add_parser('dpo', help='Run a Direct Preference Optimization (DPO) job on an existing agent')
     parser_run_dpo.add_argument('target', type=str, help="The agent name to refine with DPO")
     parser_run_dpo.add_argument('--dataset_path', type=str, help="(Optional) Path to the preference dataset. Defaults to data/<target>_dpo_data.jsonl")
@@ -347,6 +557,30 @@ def main():
     parser_run_dpo.add_argument('--batch_size', type=int, default=1, help='Training batch size')
     parser_run_dpo.add_argument('--learning_rate', type=float, default=1e-5, help='DPO learning rate')
     parser_run_dpo.set_defaults(func=handle_train_dpo)
+
+    parser_bench = subparsers.add_parser('bench', help='Benchmark local inference settings on this host')
+    bench_subparsers = parser_bench.add_subparsers(dest='bench_command', required=True)
+
+    parser_bench_spec = bench_subparsers.add_parser('speculative', help='Compare tokens/sec and draft acceptance with and without the draft model')
+    parser_bench_spec.add_argument('--draft_model', type=str, help="(Optional) Draft model ID. Defaults to speculative.draft_model in config.yaml")
+    parser_bench_spec.add_argument('--num_assistant_tokens', type=int, default=5, help='Tokens the draft model proposes per step')
+    parser_bench_spec.add_argument('--agents', type=str, nargs='*', help='(Optional) Only benchmark these agents')
+    parser_bench_spec.add_argument('--max_new_tokens', type=int, default=128, help='Tokens to generate per prompt')
+    parser_bench_spec.add_argument('--temperature', type=float, default=0.7, help='Sampling temperature')
+    parser_bench_spec.set_defaults(func=handle_bench_speculative)
+
+    parser_bench_precision = bench_subparsers.add_parser('precision', help='Measure load time, memory, TTFT and tokens/sec per precision profile')
+    parser_bench_precision.add_argument('--profiles', type=str, nargs='*', help='(Optional) Only benchmark these profiles')
+    parser_bench_precision.add_argument('--max_new_tokens', type=int, default=128, help='Tokens to generate per prompt')
+    parser_bench_precision.add_argument('--apply', action='store_true', help='Write the fastest profile to precision.profile in config.yaml')
+    parser_bench_precision.add_argument('--output', type=str, help='(Optional) JSON file to write the full results to')
+    parser_bench_precision.set_defaults(func=handle_bench_precision)
+
+    parser_bench_cpu = bench_subparsers.add_parser('cpu', help='Measure CPU throughput over NUM_WORKERS x threads-per-worker combinations')
+    parser_bench_cpu.add_argument('--workers', type=int, nargs='*', help='(Optional) Worker counts to try. Defaults to powers of two up to the core count')
+    parser_bench_cpu.add_argument('--threads', type=int, nargs='*', help='(Optional) Threads per worker to try. Defaults to an even share of the cores')
+    parser_bench_cpu.add_argument('--max_new_tokens', type=int, default=64, help='Tokens to generate per prompt')
+    parser_bench_cpu.set_defaults(func=handle_bench_cpu)
     
     args = parser.parse_args()
     args.func(args)
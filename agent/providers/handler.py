@@ -1,4 +1,5 @@
-import os
+import threading
+import httpx
 from langchain_openai import ChatOpenAI
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
@@ -8,26 +9,51 @@ PROVIDER_MAP = {
     'google': ChatGoogleGenerativeAI,
 }
 
+_CHAT_MODEL_CACHE = {}
+_CHAT_MODEL_LOCK = threading.Lock()
+_HTTP_CLIENTS = {}
+
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+
+def _pooled_http_clients() -> dict:
+    """
+    One keep-alive connection pool per process, shared by every OpenAI model instance.
+    The async client is only used from the process's provider executor loop.
+    """
+    if not _HTTP_CLIENTS:
+        _HTTP_CLIENTS['http_client'] = httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        _HTTP_CLIENTS['http_async_client'] = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    return _HTTP_CLIENTS
+
+
 def get_chat_model(provider_name, model_name, temperature, top_p):
     """
     Factory function to get an instance of a LangChain chat model.
+    Instances are cached per process by (provider, model, sampling params), so jobs
+    reuse the model's HTTP client and its kept-alive connections to the provider.
     """
     if provider_name not in PROVIDER_MAP:
         raise ValueError(f"Provider '{provider_name}' is not supported.")
 
-    model_class = PROVIDER_MAP[provider_name]
-    
-    chat_model = model_class(
-        model=model_name,
-        temperature=temperature,
-        top_p=top_p
-    )
+    cache_key = (provider_name, model_name, round(float(temperature), 3), round(float(top_p), 3))
+    with _CHAT_MODEL_LOCK:
+        chat_model = _CHAT_MODEL_CACHE.get(cache_key)
+        if chat_model is None:
+            model_class = PROVIDER_MAP[provider_name]
+            client_kwargs = _pooled_http_clients() if provider_name == 'openai' else {}
+
+            chat_model = model_class(
+                model=model_name,
+                temperature=temperature,
+                top_p=top_p,
+                **client_kwargs
+            )
+            _CHAT_MODEL_CACHE[cache_key] = chat_model
     return chat_model
 
-def invoke_llm_with_history(chat_model, prompt: str, history: list):
-    """
-    Invokes the given LangChain chat model with a prompt and formatted history.
-    """
+def _build_messages(prompt: str, history: list) -> list:
     messages = [SystemMessage(content="You are a helpful assistant.")]
     
     for msg in history:
@@ -37,7 +63,18 @@ def invoke_llm_with_history(chat_model, prompt: str, history: list):
             messages.append(AIMessage(content=msg['content']))
 
     messages.append(HumanMessage(content=prompt))
+    return messages
 
-    ai_response = chat_model.invoke(messages)
-
-    return ai_response.content
\ No newline at end of file
+async def astream_llm_with_history(chat_model, prompt: str, history: list):
+    """
+    Streams the given LangChain chat model's answer to a prompt and formatted history,
+    yielding the response text in the chunks the provider delivers them.
+    """
+    stream = chat_model.astream(_build_messages(prompt, history))
+    try:
+        async for chunk in stream:
+            if chunk.content:
+                yield chunk.content
+    finally:
+        # Releases the HTTP response when the caller stops early, e.g. a lost hedge race.
+        await stream.aclose()
@@ -0,0 +1,165 @@
+import math
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+
+class ProviderRouter:
+    """
+    Keeps rolling latency and error statistics per 'provider:model' target and uses
+    them to decide where a provider request goes. A target that fails
+    `failure_threshold` times in a row, or whose error rate over the last `window`
+    calls (no older than `max_age_s`) exceeds `max_error_rate`, is skipped for
+    `cooldown_s`. After that a single probe request is let through: if it succeeds the
+    target is used again with fresh statistics, otherwise it is skipped for another
+    cooldown. Latencies are times to the first streamed chunk; their percentile is how
+    long a request waits before it is hedged to the next target.
+    """
+    def __init__(self, config: dict = None):
+        """
+        :param config: The 'provider_routing' section of the config.yaml.
+        """
+        config = config or {}
+        self.window = int(config.get('window', 100))
+        self.max_age_s = float(config.get('max_age_s', 300.0))
+        self.min_samples = int(config.get('min_samples', 10))
+        self.max_error_rate = float(config.get('max_error_rate', 0.5))
+        self.failure_threshold = int(config.get('failure_threshold', 3))
+        self.cooldown_s = float(config.get('cooldown_s', 30.0))
+        hedging = config.get('hedging') or {}
+        self.hedging_enabled = hedging.get('enabled', False)
+        self.hedge_percentile = float(hedging.get('percentile', 95))
+        self.min_hedge_delay_s = float(hedging.get('min_delay_s', 1.0))
+        self.default_hedge_delay_s = float(hedging.get('default_delay_s', 5.0))
+        self.fallbacks = config.get('fallbacks') or {}
+        self.fail_over_to_local = config.get('fail_over_to_local', True)
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._consecutive_failures = Counter()
+        self._open_until = {}
+        self._probing = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, target: str, now: float):
+        samples = self._samples.get(target)
+        while samples and now - samples[0][0] > self.max_age_s:
+            samples.popleft()
+
+    def _trip(self, target: str, now: float, reason: str):
+        self._open_until[target] = now + self.cooldown_s
+        print(f"[Provider Routing] {target} {reason}. Skipping it for {self.cooldown_s:.0f}s.")
+
+    def record(self, target: str, latency_s: float, ok: bool):
+        """Records one call; `latency_s` may be None for failures mid-stream."""
+        now = time.monotonic()
+        with self._lock:
+            probe = self._probing.pop(target, None) is not None
+            if ok and target in self._open_until:
+                # The probe after a cooldown succeeded: start over with fresh statistics.
+                print(f"[Provider Routing] {target} recovered.")
+                del self._open_until[target]
+                self._samples.pop(target, None)
+            self._samples[target].append((now, latency_s, ok))
+            self._prune(target, now)
+            if ok:
+                self._consecutive_failures[target] = 0
+                return
+            self._consecutive_failures[target] += 1
+            if probe:
+                self._trip(target, now, "failed its probe request")
+            elif self._consecutive_failures[target] >= self.failure_threshold:
+                self._trip(target, now, f"failed {self._consecutive_failures[target]} times in a row")
+
+    def record_abandoned(self, target: str, latency_s: float):
+        """
+        Records a call given up after `latency_s` because another target answered first.
+        It counts as neither success nor failure, but its latency is kept as a lower
+        bound so a slow target's percentiles aren't made of its fast answers only.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._probing.pop(target, None)
+            self._samples[target].append((now, latency_s, None))
+            self._prune(target, now)
+
+    def _error_rate(self, target: str):
+        outcomes = [ok for _, _, ok in self._samples.get(target, ()) if ok is not None]
+        if len(outcomes) < self.min_samples:
+            return None
+        return sum(1 for ok in outcomes if not ok) / len(outcomes)
+
+    def _available(self, target: str, now: float, reserve_probe: bool) -> bool:
+        self._prune(target, now)
+        if target in self._open_until:
+            if self._open_until[target] > now:
+                return False
+            # Half-open: one probe at a time; a reservation nobody used expires after a cooldown.
+            reserved_at = self._probing.get(target)
+            if reserved_at is not None and now - reserved_at < self.cooldown_s:
+                return False
+            if reserve_probe:
+                self._probing[target] = now
+            return True
+        error_rate = self._error_rate(target)
+        if error_rate is not None and error_rate > self.max_error_rate:
+            self._trip(target, now, f"has a {error_rate:.0%} error rate")
+            return False
+        return True
+
+    def is_healthy(self, target: str) -> bool:
+        """Whether a request could be sent to the target now, without using up its probe."""
+        with self._lock:
+            return self._available(target, time.monotonic(), reserve_probe=False)
+
+    def candidates(self, target: str) -> list:
+        """
+        The target and its configured fallbacks, in order, without the unavailable ones.
+        A target whose cooldown has passed is included until a request `acquire`s its probe.
+        """
+        ordered = []
+        now = time.monotonic()
+        with self._lock:
+            for candidate in [target] + list(self.fallbacks.get(target, [])):
+                if candidate not in ordered and self._available(candidate, now, reserve_probe=False):
+                    ordered.append(candidate)
+        return ordered
+
+    def acquire(self, target: str) -> bool:
+        """
+        Called right before a request is sent to a candidate. Reserves the probe of a target
+        whose cooldown has passed, so it gets only one; False if the target became unavailable.
+        """
+        with self._lock:
+            return self._available(target, time.monotonic(), reserve_probe=True)
+
+    def has_candidates(self, target: str) -> bool:
+        return any(self.is_healthy(candidate) for candidate in [target] + list(self.fallbacks.get(target, [])))
+
+    def _latency_percentile(self, target: str, percentile: float):
+        with self._lock:
+            self._prune(target, time.monotonic())
+            latencies = sorted(latency for _, latency, ok in self._samples.get(target, ()) if ok is not False and latency is not None)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[max(math.ceil(percentile / 100 * len(latencies)) - 1, 0)]
+
+    def hedge_delay(self, target: str) -> float:
+        """How long to wait for the target's first chunk before also asking the next target."""
+        latency = self._latency_percentile(target, self.hedge_percentile)
+        if latency is None:
+            return self.default_hedge_delay_s
+        return max(latency, self.min_hedge_delay_s)
+
+    def stats(self) -> dict:
+        stats = {}
+        for target in list(self._samples):
+            p50, p95 = self._latency_percentile(target, 50), self._latency_percentile(target, 95)
+            with self._lock:
+                error_rate = self._error_rate(target)
+            stats[target] = {
+                'calls': len(self._samples[target]),
+                'error_rate': round(error_rate, 3) if error_rate is not None else None,
+                'p50_s': round(p50, 3) if p50 is not None else None,
+                'p95_s': round(p95, 3) if p95 is not None else None,
+                'healthy': self.is_healthy(target),
+            }
+        return stats
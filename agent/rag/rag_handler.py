@@ -10,12 +10,18 @@ INDEX_PATH = os.path.join(os.path.dirname(__file__), '../models/rag_index/docume
 DOC_PATH = os.path.join(os.path.dirname(__file__), '../data/knowledge_base.txt')
 
 
-def _load_rag_dependencies():
-    """Loads the RAG model, index, and documents into memory."""
-    global MODEL, INDEX, DOCUMENTS
+def get_sentence_model():
+    """Returns the shared SentenceTransformer, loading it on first use."""
+    global MODEL
     if MODEL is None:
         print("[RAG Handler] Loading SentenceTransformer model...")
         MODEL = SentenceTransformer('all-MiniLM-L6-v2')
+    return MODEL
+
+def _load_rag_dependencies():
+    """Loads the RAG model, index, and documents into memory."""
+    global INDEX, DOCUMENTS
+    get_sentence_model()
     if INDEX is None and os.path.exists(INDEX_PATH):
         print(f"[RAG Handler] Loading FAISS index from {INDEX_PATH}...")
         INDEX = faiss.read_index(INDEX_PATH)
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+
+from app.adapter_manager import AdapterManager
+
+
+class FakeModel:
+    """Records the PEFT adapter calls the manager makes on the shared base model."""
+    def __init__(self):
+        self.loaded = []
+        self.deleted = []
+        self.active = None
+        self.adapters_enabled = True
+
+    def load_adapter(self, path, adapter_name):
+        # Like PEFT, loading turns the new adapter on.
+        self.loaded.append(adapter_name)
+        self.active = adapter_name
+        self.adapters_enabled = True
+
+    def delete_adapter(self, adapter_name):
+        self.deleted.append(adapter_name)
+
+    def set_adapter(self, adapter_name):
+        self.active = adapter_name
+
+    def enable_adapters(self):
+        self.adapters_enabled = True
+
+    def disable_adapters(self):
+        self.adapters_enabled = False
+
+    def named_parameters(self):
+        return []
+
+
+class AdapterManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.model = FakeModel()
+        self.manager = AdapterManager({'max_resident': 2, 'pinned': ['router']})
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        root = directory.name
+        self.paths = {}
+        for name in ('router', 'coder', 'writer', 'math'):
+            self.paths[name] = os.path.join(root, name)
+            os.makedirs(self.paths[name])
+
+    def ensure(self, name):
+        return self.manager.ensure(self.model, name, self.paths[name])
+
+    def test_resident_adapters_are_reused(self):
+        self.assertEqual(self.ensure('coder'), 'coder')
+        self.assertEqual(self.ensure('coder'), 'coder')
+
+        self.assertEqual(self.model.loaded, ['coder'])
+        self.assertEqual((self.manager.hits, self.manager.misses), (1, 1))
+
+    def test_loading_an_adapter_keeps_the_active_one(self):
+        self.ensure('coder')
+        self.assertFalse(self.model.adapters_enabled)
+
+        self.manager.activate(self.model, 'coder')
+        self.ensure('writer')
+        self.assertEqual((self.model.active, self.model.adapters_enabled), ('coder', True))
+
+    def test_least_recently_used_adapter_is_evicted(self):
+        self.ensure('coder')
+        self.ensure('writer')
+        self.ensure('coder')
+        self.ensure('math')
+
+        self.assertEqual(self.model.deleted, ['writer'])
+        self.assertEqual(self.manager.stats()['resident'], ['coder', 'math'])
+
+    def test_pinned_and_in_use_adapters_are_never_evicted(self):
+        self.ensure('router')
+        self.manager.retain(self.ensure('coder'))
+        self.ensure('writer')
+
+        self.assertEqual(self.model.deleted, [])
+        self.assertEqual(self.manager.stats()['resident'], ['router', 'coder', 'writer'])
+
+        self.manager.release('coder')
+        self.ensure('math')
+        self.assertEqual(self.model.deleted, ['coder', 'writer'])
+
+    def test_evicting_the_active_adapter_switches_to_the_base_model(self):
+        evicted = []
+        self.manager.add_eviction_listener(evicted.append)
+        self.ensure('coder')
+        self.manager.activate(self.model, 'coder')
+        self.ensure('writer')
+        self.ensure('math')
+
+        self.assertEqual(evicted, ['coder'])
+        self.assertFalse(self.model.adapters_enabled)
+        self.assertIsNone(self.manager.stats()['active'])
+
+    def test_acquire_reloads_an_evicted_adapter_and_retains_it(self):
+        self.ensure('coder')
+        self.ensure('writer')
+        self.ensure('math')
+        self.assertNotIn('coder', self.manager.stats()['resident'])
+
+        self.assertEqual(self.manager.acquire(self.model, 'coder'), 'coder')
+        self.ensure('writer')
+
+        self.assertEqual(self.model.loaded.count('coder'), 2)
+        self.assertIn('coder', self.manager.stats()['resident'])
+
+    def test_unknown_or_missing_adapters_use_the_base_model(self):
+        self.assertIsNone(self.manager.acquire(self.model, 'never_loaded'))
+        self.assertIsNone(self.manager.acquire(self.model, None))
+        self.assertIsNone(self.manager.ensure(self.model, 'coder', '/does/not/exist'))
+        self.assertEqual(self.model.loaded, [])
+
+    def test_models_without_lora_support_refuse_adapters(self):
+        self.model.supports_lora_adapters = False
+
+        self.assertIsNone(self.ensure('coder'))
+        self.assertEqual(self.model.loaded, [])
+
+    def test_activate_switches_between_adapters_and_the_base_model(self):
+        self.ensure('coder')
+
+        self.manager.activate(self.model, 'coder')
+        self.assertEqual((self.model.active, self.model.adapters_enabled), ('coder', True))
+        self.manager.activate(self.model, None)
+        self.assertFalse(self.model.adapters_enabled)
+        with self.assertRaises(ValueError):
+            self.manager.activate(self.model, 'writer')
@@ -0,0 +1,147 @@
+import threading
+import time
+import unittest
+
+import torch
+from transformers import StoppingCriteria
+
+from app import llm_inference
+from app.batching_engine import BatchingEngine
+from app.llm_inference import generate_response_stream, set_inference_engine
+from tests.tiny_model import build_model, build_tokenizer
+
+PROMPTS = ["hello coder please help me", "sort a list", "write a poem about python numbers please"]
+# top_p 0 keeps only the most likely token, so sampling is greedy.
+GREEDY = {'temperature': 1.0, 'top_p': 0.0}
+
+
+class StopAfter(StoppingCriteria):
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.calls -= 1
+        return torch.full((input_ids.shape[0],), self.calls <= 0, dtype=torch.bool)
+
+
+class BatchingEngineTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(cls.tokenizer)
+        # Random weights never pick EOS on purpose; keep it from ending sequences by chance.
+        cls.model.generation_config.eos_token_id = cls.tokenizer.convert_tokens_to_ids("<system>")
+
+    def setUp(self):
+        self.engine = BatchingEngine(self.model, self.tokenizer, {'max_batch_size': 4})
+        self.addCleanup(self.engine.stop)
+
+    def ids(self, text):
+        return self.tokenizer(text)["input_ids"]
+
+    def greedy_reference(self, input_ids, max_new_tokens):
+        input_tensor = torch.tensor([input_ids])
+        output = self.model.generate(
+            input_ids=input_tensor, attention_mask=torch.ones_like(input_tensor),
+            max_new_tokens=max_new_tokens, do_sample=False
+        )
+        return output[0, len(input_ids):].tolist()
+
+    def test_batched_greedy_output_matches_sequential_generation(self):
+        # Submitted before the engine starts, so all three prompts share one batch.
+        requests = [self.engine.submit(self.ids(prompt), 8, **GREEDY) for prompt in PROMPTS]
+        self.engine.start()
+
+        results = [request.result(timeout=30) for request in requests]
+
+        self.assertEqual(results, [self.greedy_reference(self.ids(prompt), 8) for prompt in PROMPTS])
+        self.assertLess(self.engine.steps, 3 * 7)
+
+    def test_a_sequence_joining_a_running_batch_is_unaffected(self):
+        self.engine.start()
+        first = self.engine.submit(self.ids(PROMPTS[0]), 12, **GREEDY)
+        while len(first.generated) < 3:
+            time.sleep(0.001)
+        second = self.engine.submit(self.ids(PROMPTS[2]), 6, **GREEDY)
+
+        self.assertEqual(first.result(timeout=30), self.greedy_reference(self.ids(PROMPTS[0]), 12))
+        self.assertEqual(second.result(timeout=30), self.greedy_reference(self.ids(PROMPTS[2]), 6))
+
+    def test_stop_strings_and_stopping_criteria_retire_only_their_row(self):
+        reference = self.greedy_reference(self.ids(PROMPTS[0]), 8)
+        stop_text = self.tokenizer.decode(reference[2:3])
+        requests = [
+            self.engine.submit(self.ids(PROMPTS[0]), 8, stop_strings=[stop_text], **GREEDY),
+            self.engine.submit(self.ids(PROMPTS[1]), 8, stopping_criteria=[StopAfter(4)], **GREEDY),
+            self.engine.submit(self.ids(PROMPTS[2]), 8, **GREEDY),
+        ]
+        self.engine.start()
+
+        first, second, third = [request.result(timeout=30) for request in requests]
+
+        self.assertEqual(first, reference[:reference.index(reference[2]) + 1])
+        self.assertEqual(len(second), 4)
+        self.assertEqual(third, self.greedy_reference(self.ids(PROMPTS[2]), 8))
+
+    def test_cancelled_request_is_retired(self):
+        self.engine.start()
+        request = self.engine.submit(self.ids(PROMPTS[0]), 400, **GREEDY)
+        while len(request.generated) < 2:
+            time.sleep(0.001)
+
+        request.cancel()
+
+        self.assertLess(len(request.result(timeout=30)), 400)
+        self.assertEqual(self.engine.stats()['active_sequences'], 0)
+
+    def test_engine_survives_a_failing_request(self):
+        self.engine.start()
+        broken = self.engine.submit([len(self.tokenizer) + 100], 4, **GREEDY)
+
+        with self.assertRaises(Exception):
+            broken.result(timeout=30)
+        healthy = self.engine.submit(self.ids(PROMPTS[1]), 4, **GREEDY)
+        self.assertEqual(healthy.result(timeout=30), self.greedy_reference(self.ids(PROMPTS[1]), 4))
+
+    def test_calls_run_on_the_engine_thread(self):
+        self.engine.start()
+
+        thread_name = self.engine.call(lambda model, tokenizer: threading.current_thread().name)
+
+        self.assertEqual(thread_name, "batching-engine")
+
+
+class EngineStreamTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(cls.tokenizer)
+        cls.model.generation_config.eos_token_id = cls.tokenizer.convert_tokens_to_ids("<system>")
+
+    def setUp(self):
+        self.engine = BatchingEngine(self.model, self.tokenizer, {'max_batch_size': 4})
+        self.engine.start()
+        self.addCleanup(self.engine.stop)
+        self.addCleanup(set_inference_engine, llm_inference.INFERENCE_ENGINE)
+        set_inference_engine(self.engine)
+
+        self.submitted = []
+        submit = self.engine.submit
+        def record(*args, **kwargs):
+            request = submit(*args, **kwargs)
+            self.submitted.append(request)
+            return request
+        self.engine.submit = record
+
+    def test_streamed_text_matches_the_decoded_result(self):
+        text = "".join(generate_response_stream(self.model, self.tokenizer, PROMPTS[0], max_new_tokens=10, **GREEDY))
+
+        self.assertEqual(text, self.tokenizer.decode(self.submitted[0].result(), skip_special_tokens=True))
+
+    def test_closing_the_stream_cancels_the_engine_request(self):
+        stream = generate_response_stream(self.model, self.tokenizer, PROMPTS[0], max_new_tokens=400, **GREEDY)
+        next(stream)
+        stream.close()
+
+        self.assertTrue(self.submitted[0].cancelled)
+        self.assertLess(len(self.submitted[0].result(timeout=30)), 400)
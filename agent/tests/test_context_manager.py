@@ -0,0 +1,123 @@
+import unittest
+
+from app.context_manager import MESSAGE_OVERHEAD_TOKENS, TRUNCATION_MARKER, pack_history
+
+
+class WordTokenizer:
+    """One token per whitespace-separated word."""
+    def __init__(self):
+        self.vocab = []
+
+    def __call__(self, text, add_special_tokens=False):
+        ids = []
+        for word in text.split():
+            if word not in self.vocab:
+                self.vocab.append(word)
+            ids.append(self.vocab.index(word))
+        return {"input_ids": ids}
+
+    def decode(self, ids, skip_special_tokens=True):
+        return " ".join(self.vocab[i] for i in ids)
+
+
+def message(role, words):
+    return {"role": role, "content": " ".join(f"{role}{i}" for i in range(words))}
+
+def cost(words):
+    return words + MESSAGE_OVERHEAD_TOKENS
+
+
+class PackHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = WordTokenizer()
+        self.system = message("system", 10)
+        self.query = message("user", 5)
+
+    def test_everything_fits(self):
+        history = [self.system, message("user", 10), message("assistant", 10), self.query]
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=1000)
+
+        self.assertEqual(packed, history)
+        self.assertEqual(dropped, [])
+
+    def test_oldest_turns_are_dropped_first(self):
+        old_user, old_reply = message("user", 20), message("assistant", 20)
+        new_user, new_reply = message("user", 10), message("assistant", 10)
+        history = [self.system, old_user, old_reply, new_user, new_reply, self.query]
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=cost(10) + 2 * cost(10), min_truncated_tokens=1000)
+
+        self.assertEqual(packed, [self.system, new_user, new_reply, self.query])
+        self.assertEqual(dropped, [old_user, old_reply])
+
+    def test_boundary_turn_is_truncated_when_enough_budget_is_left(self):
+        old_user = message("user", 40)
+        reply = message("assistant", 10)
+        history = [self.system, old_user, reply, self.query]
+        budget = cost(10) + cost(10) + cost(20)
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=budget, min_truncated_tokens=8)
+
+        truncated = packed[1]
+        self.assertTrue(truncated["content"].startswith(TRUNCATION_MARKER))
+        self.assertTrue(truncated["content"].endswith("user39"))
+        self.assertEqual(len(truncated["content"][len(TRUNCATION_MARKER):].split()), 20)
+        self.assertEqual(dropped, [])
+
+    def test_packed_history_starts_with_a_user_turn(self):
+        old_user, old_reply = message("user", 30), message("assistant", 5)
+        history = [self.system, old_user, old_reply, self.query]
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=cost(10) + cost(5), min_truncated_tokens=1000)
+
+        self.assertEqual(packed, [self.system, self.query])
+        self.assertEqual(dropped, [old_user, old_reply])
+
+    def test_max_messages_limits_kept_turns(self):
+        turns = [message("user", 1), message("assistant", 1), message("user", 2), message("assistant", 2)]
+        history = [self.system] + turns + [self.query]
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=1000, max_messages=2)
+
+        self.assertEqual(packed, [self.system] + turns[2:] + [self.query])
+        self.assertEqual(dropped, turns[:2])
+
+    def test_summary_is_added_to_the_system_message_and_counts_towards_the_budget(self):
+        reply = message("assistant", 10)
+        history = [self.system, message("user", 10), reply, self.query]
+        summary = " ".join(f"summary{i}" for i in range(30))
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=cost(10) + 2 * cost(10), summary=summary, min_truncated_tokens=1000)
+
+        self.assertIn(summary, packed[0]["content"])
+        self.assertEqual(packed[-1], self.query)
+        self.assertEqual(len(dropped), 2)
+
+    def test_summary_is_left_out_while_the_turns_it_covers_fit(self):
+        turns = [dict(message("user", 10), id="1"), dict(message("assistant", 10), id="2")]
+
+        packed, dropped = pack_history(self.tokenizer, [self.system] + turns + [self.query], token_budget=1000, summary="earlier", summary_through="2")
+
+        self.assertEqual(packed, [self.system] + turns + [self.query])
+        self.assertEqual(dropped, [])
+
+    def test_summary_is_used_once_a_covered_turn_is_dropped(self):
+        turns = [dict(message("user", 10), id="1"), dict(message("assistant", 10), id="2"), dict(message("user", 10), id="3"), dict(message("assistant", 10), id="4")]
+        history = [self.system] + turns + [self.query]
+
+        packed, dropped = pack_history(self.tokenizer, history, token_budget=cost(10) + cost(5) + 2 * cost(10) + 5, summary="earlier", summary_through="2", min_truncated_tokens=1000)
+
+        self.assertIn("earlier", packed[0]["content"])
+        self.assertEqual(packed[1:], turns[2:] + [self.query])
+        self.assertEqual(dropped, turns[:2])
+
+    def test_summary_without_a_system_message_becomes_one(self):
+        packed, _ = pack_history(self.tokenizer, [self.query], token_budget=1000, summary="earlier")
+
+        self.assertEqual(packed[0]["role"], "system")
+        self.assertIn("earlier", packed[0]["content"])
+        self.assertEqual(packed[1], self.query)
+
+    def test_empty_history(self):
+        self.assertEqual(pack_history(self.tokenizer, [], token_budget=100), ([], []))
@@ -0,0 +1,59 @@
+import json
+import unittest
+from unittest import mock
+
+from app import conversation_summary
+from app.conversation_summary import enqueue_summary_update, run_summary_job, summary_key
+
+
+class FakeRedis:
+    def __init__(self, records=None):
+        self.values = {summary_key(conversation_id): json.dumps(record) for conversation_id, record in (records or {}).items()}
+
+    def get(self, key):
+        return self.values.get(key)
+
+
+def turns(*ids):
+    return [{'id': turn_id, 'role': 'user', 'content': f"message {turn_id}"} for turn_id in ids]
+
+
+class SummaryJobTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(conversation_summary, 'update_summary', side_effect=lambda model, tokenizer, redis_client, conversation_id, record, new_turns, max_new_tokens: new_turns)
+        self.update_summary = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def job(self, record, new_turns):
+        return {'conversation_id': 'c1', 'record': record, 'new_turns': new_turns, 'max_new_tokens': 32}
+
+    def test_update_is_queued_on_the_batch_lane(self):
+        job_queue = mock.Mock()
+
+        enqueue_summary_update(job_queue, 'c1', {'summary': '', 'last_message_id': None}, turns('1', '2'))
+
+        job_id, job_data_str, meta = job_queue.add.call_args.args
+        self.assertEqual(json.loads(job_data_str)['new_turns'], turns('1', '2'))
+        self.assertEqual(json.loads(job_data_str)['job_id'], job_id)
+        self.assertEqual(meta, {'user_id': None, 'lane': 'batch', 'kind': 'summary'})
+
+    def test_queued_turns_are_folded_into_an_unchanged_summary(self):
+        record = {'summary': 'old', 'last_message_id': None}
+        redis_client = FakeRedis()
+
+        self.assertEqual(run_summary_job(None, None, redis_client, self.job(record, turns('1', '2'))), turns('1', '2'))
+
+    def test_turns_a_newer_summary_covers_are_skipped(self):
+        redis_client = FakeRedis({'c1': {'summary': 'newer', 'last_message_id': '2'}})
+
+        folded = run_summary_job(None, None, redis_client, self.job({'summary': '', 'last_message_id': None}, turns('1', '2', '3')))
+
+        self.assertEqual(folded, turns('3'))
+        self.assertEqual(self.update_summary.call_args.args[4], {'summary': 'newer', 'last_message_id': '2'})
+
+    def test_outdated_update_is_dropped(self):
+        current = {'summary': 'newer', 'last_message_id': '9'}
+        redis_client = FakeRedis({'c1': current})
+
+        self.assertEqual(run_summary_job(None, None, redis_client, self.job({'summary': '', 'last_message_id': None}, turns('1', '2'))), current)
+        self.update_summary.assert_not_called()
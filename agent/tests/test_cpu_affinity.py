@@ -0,0 +1,35 @@
+import unittest
+from unittest import mock
+
+from app.cpu_affinity import partition_cores
+
+
+class PartitionCoresTests(unittest.TestCase):
+    def partition(self, cores, *args):
+        with mock.patch('app.cpu_affinity.available_cores', return_value=cores):
+            return partition_cores(*args)
+
+    def test_cores_are_split_evenly_into_disjoint_sets(self):
+        partitions = self.partition(list(range(8)), 4)
+
+        self.assertEqual(partitions, [[0, 1], [2, 3], [4, 5], [6, 7]])
+
+    def test_leftover_cores_stay_unused(self):
+        partitions = self.partition(list(range(7)), 3)
+
+        self.assertEqual(partitions, [[0, 1], [2, 3], [4, 5]])
+
+    def test_explicit_threads_per_worker(self):
+        partitions = self.partition([2, 3, 5, 7], 2, 1)
+
+        self.assertEqual(partitions, [[2], [3]])
+
+    def test_more_workers_than_cores_overlap_instead_of_failing(self):
+        partitions = self.partition([0, 1], 3)
+
+        self.assertEqual(partitions, [[0], [1], [0]])
+
+    def test_oversubscribed_sets_wrap_around(self):
+        partitions = self.partition(list(range(4)), 2, 3)
+
+        self.assertEqual(partitions, [[0, 1, 2], [3, 0, 1]])
@@ -0,0 +1,82 @@
+import json
+import unittest
+
+from app.job_queue import JobQueue
+
+
+class FakeRedis:
+    """Just enough of a Redis client for the JobQueue reclaim paths."""
+    def __init__(self, claimed=None, deleted=None, deliveries=None):
+        self.claimed = claimed or []
+        self.deleted = deleted or []
+        self.deliveries = deliveries or {}
+        self.acked = []
+        self.removed = []
+        self.added = []
+
+    def xautoclaim(self, stream, group, consumer, min_idle_time, start_id='0-0', count=None):
+        return ['0-0', self.claimed, self.deleted]
+
+    def xpending_range(self, stream, group, min, max, count):
+        return [{'message_id': min, 'times_delivered': self.deliveries[min]}] if min in self.deliveries else []
+
+    def xack(self, stream, group, *entry_ids):
+        self.acked.extend(entry_ids)
+
+    def xdel(self, stream, *entry_ids):
+        self.removed.extend(entry_ids)
+
+    def xadd(self, stream, fields, maxlen=None, approximate=True):
+        self.added.append((stream, fields))
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+def entry(entry_id, job_id):
+    return entry_id, {'job': json.dumps([job_id, json.dumps({'job_id': job_id})]), 'meta': json.dumps({'user_id': 7})}
+
+
+class JobQueueReclaimTests(unittest.TestCase):
+    def make_queue(self, redis_client):
+        return JobQueue(redis_client, {'stream': 'jobs', 'dead_letter_stream': 'jobs:dead', 'max_deliveries': 3})
+
+    def test_stale_jobs_are_reclaimed(self):
+        redis_client = FakeRedis(claimed=[entry('1-0', 'job-a')], deliveries={'1-0': 2})
+
+        jobs = self.make_queue(redis_client).reclaim(10)
+
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['entry_id'], '1-0')
+        self.assertEqual(jobs[0]['job_id'], 'job-a')
+        self.assertEqual(json.loads(jobs[0]['job_data']), {'job_id': 'job-a'})
+        self.assertEqual(jobs[0]['meta'], {'user_id': 7})
+        self.assertEqual(redis_client.acked, [])
+        self.assertEqual(redis_client.added, [])
+
+    def test_jobs_delivered_too_often_are_dead_lettered(self):
+        entry_id, fields = entry('1-0', 'job-a')
+        redis_client = FakeRedis(claimed=[(entry_id, fields)], deliveries={'1-0': 4})
+
+        jobs = self.make_queue(redis_client).reclaim(10)
+
+        self.assertEqual(jobs[0]['job_id'], 'job-a')
+        self.assertIsNone(jobs[0]['job_data'])
+        stream, dead_entry = redis_client.added[0]
+        self.assertEqual(stream, 'jobs:dead')
+        self.assertEqual(dead_entry['job'], fields['job'])
+        self.assertEqual(dead_entry['entry_id'], '1-0')
+        self.assertIn('reason', dead_entry)
+        self.assertEqual(redis_client.acked, ['1-0'])
+        self.assertEqual(redis_client.removed, ['1-0'])
+
+    def test_deleted_and_empty_entries_are_acked_and_skipped(self):
+        redis_client = FakeRedis(claimed=[('2-0', {})], deleted=['1-0'])
+
+        jobs = self.make_queue(redis_client).reclaim(10)
+
+        self.assertEqual(jobs, [])
+        self.assertEqual(sorted(redis_client.acked), ['1-0', '2-0'])
@@ -0,0 +1,26 @@
+import unittest
+
+from app.llm_inference import truncate_at_stop
+
+
+class TruncateAtStopTests(unittest.TestCase):
+    def test_without_stop_strings_text_is_unchanged(self):
+        self.assertEqual(truncate_at_stop("hello\nworld", []), ("hello\nworld", False))
+        self.assertEqual(truncate_at_stop("hello\nworld", None), ("hello\nworld", False))
+
+    def test_cuts_right_after_the_stop_string(self):
+        text = "Let me check. <tool_code>search('x')</tool_code> and more"
+
+        self.assertEqual(
+            truncate_at_stop(text, ["</tool_code>"]),
+            ("Let me check. <tool_code>search('x')</tool_code>", True)
+        )
+
+    def test_the_earliest_stop_string_wins(self):
+        self.assertEqual(truncate_at_stop("a STOP b END c", ["END", "STOP"]), ("a STOP", True))
+
+    def test_leading_whitespace_is_ignored(self):
+        self.assertEqual(truncate_at_stop("\n\ncoder\nmore", ["\n"]), ("\n\ncoder\n", True))
+
+    def test_no_match(self):
+        self.assertEqual(truncate_at_stop("no stop here", ["</tool_code>"]), ("no stop here", False))
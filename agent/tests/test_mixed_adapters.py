@@ -0,0 +1,90 @@
+import tempfile
+import unittest
+
+import torch
+from peft import LoraConfig, get_peft_model
+
+from app import adapter_manager
+from app.adapter_manager import init_adapter_manager
+from app.batching_engine import BatchingEngine
+from tests.tiny_model import build_model, build_tokenizer
+
+PROMPT = "hello coder please help me"
+
+
+def save_random_adapter(tokenizer, seed: int, output_dir: str):
+    """Saves a LoRA adapter with random (non-zero) weights for the tiny model."""
+    torch.manual_seed(seed)
+    peft_model = get_peft_model(build_model(tokenizer), LoraConfig(r=4, target_modules=["q_proj", "v_proj"], init_lora_weights=False))
+    peft_model.save_pretrained(output_dir)
+
+
+class MixedAdapterTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.adapter_paths = {}
+        for seed, name in enumerate(('coder', 'writer'), start=1):
+            cls.adapter_paths[name] = f"{cls.directory.name}/{name}"
+            save_random_adapter(cls.tokenizer, seed, cls.adapter_paths[name])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.addCleanup(setattr, adapter_manager, 'ADAPTER_MANAGER', adapter_manager.ADAPTER_MANAGER)
+        self.manager = init_adapter_manager({'max_resident': 4, 'pinned': []})
+        self.model = build_model(self.tokenizer)
+        self.model.generation_config.eos_token_id = self.tokenizer.convert_tokens_to_ids("<system>")
+        for name, path in self.adapter_paths.items():
+            self.manager.ensure(self.model, name, path)
+        self.input_ids = torch.tensor([self.tokenizer(PROMPT)["input_ids"]])
+
+    def logits_with(self, adapter_name):
+        self.manager.activate(self.model, adapter_name)
+        with torch.no_grad():
+            return self.model(input_ids=self.input_ids).logits[0]
+
+    def greedy_with(self, adapter_name, max_new_tokens):
+        self.manager.activate(self.model, adapter_name)
+        output = self.model.generate(
+            input_ids=self.input_ids, attention_mask=torch.ones_like(self.input_ids),
+            max_new_tokens=max_new_tokens, do_sample=False
+        )
+        return output[0, self.input_ids.shape[1]:].tolist()
+
+    def test_each_row_of_a_batch_gets_its_own_adapter(self):
+        adapters = ['coder', None, 'writer']
+        expected = [self.logits_with(name) for name in adapters]
+        self.manager.activate(self.model, None)
+
+        with self.manager.per_row_adapters(self.model, adapters), torch.no_grad():
+            batched = self.model(input_ids=self.input_ids.expand(len(adapters), -1)).logits
+
+        for row, logits in enumerate(expected):
+            torch.testing.assert_close(batched[row], logits, atol=1e-5, rtol=1e-5)
+        self.assertFalse(torch.allclose(expected[0], expected[1]))
+
+    def test_hooks_are_removed_after_the_block(self):
+        base_logits = self.logits_with(None)
+
+        with self.manager.per_row_adapters(self.model, ['coder']), torch.no_grad():
+            self.model(input_ids=self.input_ids)
+
+        with torch.no_grad():
+            torch.testing.assert_close(self.model(input_ids=self.input_ids).logits[0], base_logits)
+
+    def test_engine_decodes_different_adapters_in_one_batch(self):
+        adapters = ['coder', 'writer', None]
+        expected = [self.greedy_with(name, 6) for name in adapters]
+        self.manager.activate(self.model, None)
+        engine = BatchingEngine(self.model, self.tokenizer, {'max_batch_size': 4, 'mixed_adapter_batches': True})
+        self.addCleanup(engine.stop)
+
+        requests = [engine.submit(self.input_ids[0].tolist(), 6, temperature=1.0, top_p=0.0, adapter_name=name) for name in adapters]
+        engine.start()
+
+        self.assertEqual([request.result(timeout=30) for request in requests], expected)
+        self.assertEqual(self.manager._in_use, {})
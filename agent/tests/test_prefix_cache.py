@@ -0,0 +1,112 @@
+import unittest
+
+import torch
+
+from app.prefix_cache import PrefixCache, _cache_bytes, cache_from_layers, cache_layers, split_static_prefix
+from tests.tiny_model import build_model, build_tokenizer
+
+
+class PrefixCacheTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(cls.tokenizer)
+
+    def ids(self, text):
+        return self.tokenizer(text)["input_ids"]
+
+    def test_continuing_from_a_cached_prefix_matches_a_full_prefill(self):
+        cache = PrefixCache({'min_prefix_tokens': 2})
+        prompt_ids = self.ids("explain how to sort a list in python please")
+        prefix_len = 5
+
+        cache.get(self.model, None, prompt_ids[:prefix_len])
+        past = cache.get(self.model, None, prompt_ids[:prefix_len])
+        with torch.no_grad():
+            continued = self.model(
+                input_ids=torch.tensor([prompt_ids[prefix_len:]]),
+                cache_position=torch.arange(prefix_len, len(prompt_ids)),
+                past_key_values=past,
+                use_cache=True
+            ).logits[0, -1]
+            full = self.model(input_ids=torch.tensor([prompt_ids])).logits[0, -1]
+
+        torch.testing.assert_close(continued, full, atol=1e-4, rtol=1e-4)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['prefill_tokens_saved'], prefix_len)
+
+    def test_hits_are_private_copies(self):
+        cache = PrefixCache({'min_prefix_tokens': 2})
+        prefix_ids = self.ids("hello coder please help me")
+
+        first = cache.get(self.model, None, prefix_ids)
+        with torch.no_grad():
+            self.model(input_ids=torch.tensor([self.ids("sort")]), past_key_values=first, use_cache=True)
+        second = cache.get(self.model, None, prefix_ids)
+
+        self.assertEqual(first.get_seq_length(), len(prefix_ids) + 1)
+        self.assertEqual(second.get_seq_length(), len(prefix_ids))
+
+    def test_short_prefixes_are_not_cached(self):
+        cache = PrefixCache({'min_prefix_tokens': 32})
+
+        self.assertIsNone(cache.get(self.model, None, self.ids("hello coder")))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_entries_are_keyed_by_adapter_and_invalidated_with_it(self):
+        cache = PrefixCache({'min_prefix_tokens': 2})
+        prefix_ids = self.ids("hello coder please help me")
+
+        cache.get(self.model, None, prefix_ids)
+        cache.get(self.model, 'coder', prefix_ids)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        cache.invalidate_adapter('coder')
+        cache.get(self.model, None, prefix_ids)
+        cache.get(self.model, 'coder', prefix_ids)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 3))
+
+    def test_least_recently_used_prefix_is_evicted_over_budget(self):
+        prefixes = [self.ids(text) for text in ("hello coder please help me", "hello writer please help me", "hello math_agent please help me")]
+        entry_bytes = _cache_bytes(PrefixCache({'min_prefix_tokens': 2}).get(self.model, None, prefixes[0]))
+        cache = PrefixCache({'min_prefix_tokens': 2, 'memory_budget_mb': 2.5 * entry_bytes / (1024 * 1024)})
+
+        cache.get(self.model, None, prefixes[0])
+        cache.get(self.model, None, prefixes[1])
+        cache.get(self.model, None, prefixes[0])
+        cache.get(self.model, None, prefixes[2])
+
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.get(self.model, None, prefixes[0])
+        self.assertEqual(cache.stats()['hits'], 2)
+        cache.get(self.model, None, prefixes[1])
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_cache_layers_round_trip(self):
+        prompt_ids = self.ids("hello coder please")
+        with torch.no_grad():
+            past = self.model(input_ids=torch.tensor([prompt_ids]), use_cache=True).past_key_values
+
+        layers = cache_layers(past)
+        rebuilt = cache_from_layers(layers)
+
+        self.assertEqual(len(layers), self.model.config.num_hidden_layers)
+        self.assertEqual(rebuilt.get_seq_length(), len(prompt_ids))
+        torch.testing.assert_close(cache_layers(rebuilt)[1][1], layers[1][1])
+
+
+class SplitStaticPrefixTests(unittest.TestCase):
+    def test_prefix_ends_one_token_before_the_static_text_does(self):
+        tokenizer = build_tokenizer()
+        prompt = "<bos><system> explain the code <eot> <user> sort a list <eot> <assistant> "
+
+        input_ids, prefix_len = split_static_prefix(tokenizer, prompt, "explain the code <eot>")
+
+        self.assertEqual(input_ids, tokenizer(prompt)["input_ids"])
+        self.assertEqual(prefix_len, len(tokenizer("<bos><system> explain the code <eot>")["input_ids"]) - 1)
+
+    def test_missing_static_text_gives_no_prefix(self):
+        tokenizer = build_tokenizer()
+
+        self.assertEqual(split_static_prefix(tokenizer, "<user> hello", "not there")[1], 0)
+        self.assertEqual(split_static_prefix(tokenizer, "<user> hello", None)[1], 0)
@@ -0,0 +1,151 @@
+import fnmatch
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from app.response_cache import ResponseCache, normalize_query, scope_version
+
+SETTINGS = {'temperature': 0.2, 'top_p': 0.9}
+
+
+class FakeRedis:
+    """In-memory stand-in for the hash, sorted-set and string commands the cache uses."""
+    def __init__(self):
+        self.data = {}
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def expire(self, key, seconds):
+        pass
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(field, None)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hincrby(self, key, field, amount):
+        fields = self.data.setdefault(key, {})
+        fields[field] = int(fields.get(field, 0)) + amount
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.data.get(key, {}).pop(member, None)
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zpopmin(self, key, count):
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])[:count]
+        for member, _ in members:
+            del self.data[key][member]
+        return members
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key, match)]
+
+
+def fake_embedding(text):
+    # Queries that share their first word count as near-duplicates.
+    vector = np.zeros(8, dtype=np.float32)
+    vector[sum(map(ord, text.split()[0])) % 8] = 1.0
+    return vector
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.cache = ResponseCache(self.redis, {'max_entries_per_agent': 2, 'ttl_seconds': 60})
+        patcher = mock.patch.object(ResponseCache, '_embed', side_effect=fake_embedding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_miss_then_hit_returns_the_answering_agent(self):
+        self.assertIsNone(self.cache.get(['coder', 'writer'], 'v1', "How do I sort a list?", SETTINGS))
+
+        self.cache.put(['coder', 'writer'], 'v1', "How do I sort a list?", "Use sorted().", 'coder', SETTINGS)
+
+        self.assertEqual(
+            self.cache.get(['writer', 'coder'], 'v1', "how do i sort a list", SETTINGS),
+            {'response': "Use sorted().", 'agent_name': 'coder'}
+        )
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_entries_are_scoped_to_the_allowed_agents_and_version(self):
+        self.cache.put(['coder', 'writer'], 'v1', "sort a list", "Use sorted().", 'coder', SETTINGS)
+
+        self.assertIsNone(self.cache.get(['writer'], 'v1', "sort a list", SETTINGS))
+        self.assertIsNone(self.cache.get(['coder', 'writer'], 'v2', "sort a list", SETTINGS))
+        self.assertIsNone(self.cache.get(['coder', 'writer'], 'v1', "sort a list", {'temperature': 0.5, 'top_p': 0.9}))
+
+    def test_similar_query_hits_by_embedding(self):
+        self.cache.put(['coder'], 'v1', "sorting lists in python", "Use sorted().", 'coder', SETTINGS)
+
+        self.assertEqual(self.cache.get(['coder'], 'v1', "sorting a python list", SETTINGS)['response'], "Use sorted().")
+        self.assertIsNone(self.cache.get(['coder'], 'v1', "reversing a python list", SETTINGS))
+
+    def test_expired_entries_are_dropped(self):
+        self.cache.put(['coder'], 'v1', "sort a list", "Use sorted().", 'coder', SETTINGS)
+
+        with mock.patch('app.response_cache.time.time', return_value=time.time() + 120):
+            self.assertIsNone(self.cache.get(['coder'], 'v1', "sort a list", SETTINGS))
+        self.assertEqual(self.redis.hgetall("response_cache:coder:v1:entries"), {})
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for query in ("alpha one", "beta two", "gamma three"):
+            self.cache.put(['coder'], 'v1', query, query.upper(), 'coder', SETTINGS)
+
+        self.assertIsNone(self.cache.get(['coder'], 'v1', "alpha one", SETTINGS))
+        self.assertEqual(self.cache.get(['coder'], 'v1', "gamma three", SETTINGS)['response'], "GAMMA THREE")
+
+    def test_invalidate_agent_drops_every_scope_that_includes_it(self):
+        self.cache.put(['coder', 'writer'], 'v1', "sort a list", "Use sorted().", 'coder', SETTINGS)
+        self.cache.put(['writer'], 'v1', "write a poem", "Roses...", 'writer', SETTINGS)
+
+        self.assertGreater(self.cache.invalidate_agent('coder'), 0)
+
+        self.assertIsNone(self.cache.get(['coder', 'writer'], 'v1', "sort a list", SETTINGS))
+        self.assertEqual(self.cache.get(['writer'], 'v1', "write a poem", SETTINGS)['response'], "Roses...")
+
+    def test_eligibility(self):
+        only_query = [{'role': 'user', 'content': 'hi'}]
+        with_history = [{'role': 'user', 'content': 'a'}, {'role': 'assistant', 'content': 'b'}, {'role': 'user', 'content': 'c'}]
+
+        self.assertTrue(self.cache.is_eligible(only_query, 0.2))
+        self.assertFalse(self.cache.is_eligible(with_history, 0.2))
+        self.assertFalse(self.cache.is_eligible(only_query, 0.9))
+        self.assertFalse(self.cache.is_eligible(only_query, 0.2, has_summary=True))
+
+
+class HelperTests(unittest.TestCase):
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query("  How do I   sort a List?! "), "how do i sort a list")
+
+    def test_scope_version_is_stable_for_missing_paths(self):
+        self.assertEqual(scope_version(['/missing/a', '/missing/b']), scope_version(['/missing/a', '/missing/b']))
+        self.assertNotEqual(scope_version(['/missing/a']), scope_version(['/missing/a', '/missing/b']))
+
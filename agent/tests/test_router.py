@@ -0,0 +1,67 @@
+import unittest
+
+import torch
+
+from app import prefix_cache
+from app.prefix_cache import init_prefix_cache
+from app.router import _build_router_prompt, _end_of_turn_id, score_agents
+from tests.tiny_model import build_model, build_tokenizer
+
+AGENTS = ['coder', 'writer', 'write poem']
+
+
+def reference_scores(model, tokenizer, query, agents):
+    """Log-likelihood of every '<agent> <eot>' answer, from one full forward pass per agent."""
+    prompt = tokenizer.apply_chat_template(
+        [{"role": "user", "content": _build_router_prompt(query, agents)}], tokenize=False, add_generation_prompt=True
+    )
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    scores = []
+    for agent in agents:
+        answer_ids = tokenizer(agent, add_special_tokens=False)["input_ids"] + [tokenizer.convert_tokens_to_ids("<eot>")]
+        input_ids = torch.tensor([prompt_ids + answer_ids])
+        with torch.no_grad():
+            log_probs = torch.log_softmax(model(input_ids=input_ids).logits[0].float(), dim=-1)
+        scores.append(sum(float(log_probs[len(prompt_ids) + i - 1, token]) for i, token in enumerate(answer_ids)))
+    return scores
+
+
+class ScoreAgentsTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = build_tokenizer()
+        cls.model = build_model(cls.tokenizer)
+
+    def setUp(self):
+        self.addCleanup(setattr, prefix_cache, 'PREFIX_CACHE', prefix_cache.PREFIX_CACHE)
+        init_prefix_cache({'min_prefix_tokens': 4})
+
+    def test_end_of_turn_comes_from_the_chat_template(self):
+        self.assertEqual(_end_of_turn_id(self.tokenizer), self.tokenizer.convert_tokens_to_ids("<eot>"))
+
+    def test_end_of_turn_falls_back_to_eos_without_a_chat_template(self):
+        tokenizer = build_tokenizer()
+        tokenizer.chat_template = None
+
+        self.assertEqual(_end_of_turn_id(tokenizer), tokenizer.eos_token_id)
+
+    def test_batched_scores_match_separate_forward_passes(self):
+        query = "please write a poem about python"
+        expected = torch.softmax(torch.tensor(reference_scores(self.model, self.tokenizer, query, AGENTS)), dim=0)
+
+        best, confidence, distribution = score_agents(self.model, self.tokenizer, query, AGENTS)
+
+        for agent, probability in zip(AGENTS, expected.tolist()):
+            self.assertAlmostEqual(distribution[agent], probability, places=4)
+        self.assertEqual(best, AGENTS[int(expected.argmax())])
+        self.assertAlmostEqual(confidence, float(expected.max()), places=4)
+
+    def test_cached_prefix_gives_the_same_scores(self):
+        query = "sort a list of numbers"
+
+        first = score_agents(self.model, self.tokenizer, query, AGENTS)[2]
+        second = score_agents(self.model, self.tokenizer, query, AGENTS)[2]
+
+        self.assertEqual(prefix_cache.PREFIX_CACHE.hits, 1)
+        for agent in AGENTS:
+            self.assertAlmostEqual(first[agent], second[agent], places=5)
@@ -0,0 +1,135 @@
+import unittest
+from unittest import mock
+
+from providers.routing import ProviderRouter
+
+TARGET = 'openai:gpt-4o'
+FALLBACK = 'anthropic:claude'
+
+
+class ProviderRouterTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('providers.routing.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = ProviderRouter({
+            'window': 20,
+            'max_age_s': 300,
+            'min_samples': 4,
+            'max_error_rate': 0.5,
+            'failure_threshold': 3,
+            'cooldown_s': 30,
+            'fallbacks': {TARGET: [FALLBACK]},
+            'hedging': {'enabled': True, 'percentile': 95, 'min_delay_s': 0.5, 'default_delay_s': 5.0},
+        })
+
+    def fail(self, target, times):
+        for _ in range(times):
+            self.router.record(target, None, False)
+
+    def test_consecutive_failures_trip_the_target(self):
+        self.fail(TARGET, 3)
+
+        self.assertFalse(self.router.is_healthy(TARGET))
+        self.assertEqual(self.router.candidates(TARGET), [FALLBACK])
+        self.assertTrue(self.router.has_candidates(TARGET))
+
+    def test_a_success_resets_the_failure_streak(self):
+        for _ in range(6):
+            self.router.record(TARGET, 0.2, True)
+        self.fail(TARGET, 2)
+        self.router.record(TARGET, 0.2, True)
+        self.fail(TARGET, 2)
+
+        self.assertTrue(self.router.is_healthy(TARGET))
+
+    def test_tripped_target_gets_one_probe_after_the_cooldown(self):
+        self.fail(TARGET, 3)
+        self.now += 31
+
+        self.assertTrue(self.router.is_healthy(TARGET))
+        self.assertEqual(self.router.candidates(TARGET), [TARGET, FALLBACK])
+        self.assertTrue(self.router.acquire(TARGET))
+        # The probe is in flight, so nobody else is sent there.
+        self.assertEqual(self.router.candidates(TARGET), [FALLBACK])
+        self.assertFalse(self.router.acquire(TARGET))
+
+    def test_listing_candidates_does_not_use_up_the_probe(self):
+        self.fail(TARGET, 3)
+        self.fail(FALLBACK, 3)
+        self.now += 31
+
+        self.assertEqual(self.router.candidates(TARGET), [TARGET, FALLBACK])
+        self.assertTrue(self.router.acquire(TARGET))
+        # Only the target was tried, so the fallback's probe is still free.
+        self.assertEqual(self.router.candidates(TARGET), [FALLBACK])
+
+    def test_successful_probe_brings_the_target_back_with_fresh_statistics(self):
+        self.fail(TARGET, 3)
+        self.now += 31
+        self.router.acquire(TARGET)
+        self.router.record(TARGET, 0.3, True)
+
+        self.assertTrue(self.router.is_healthy(TARGET))
+        self.assertEqual(self.router.candidates(TARGET), [TARGET, FALLBACK])
+        self.assertEqual(self.router.stats()[TARGET]['calls'], 1)
+
+    def test_failed_probe_starts_another_cooldown(self):
+        self.fail(TARGET, 3)
+        self.now += 31
+        self.router.acquire(TARGET)
+        self.router.record(TARGET, None, False)
+
+        self.assertFalse(self.router.is_healthy(TARGET))
+        self.now += 31
+        self.assertEqual(self.router.candidates(TARGET), [TARGET, FALLBACK])
+
+    def test_unused_probe_reservation_expires(self):
+        self.fail(TARGET, 3)
+        self.now += 31
+        self.router.acquire(TARGET)
+        self.now += 31
+
+        self.assertEqual(self.router.candidates(TARGET), [TARGET, FALLBACK])
+
+    def test_high_error_rate_trips_the_target(self):
+        for _ in range(3):
+            self.router.record(TARGET, 0.2, True)
+            self.fail(TARGET, 2)
+
+        self.assertFalse(self.router.is_healthy(TARGET))
+
+    def test_old_failures_age_out_instead_of_blacklisting_forever(self):
+        for _ in range(2):
+            self.router.record(TARGET, 0.2, True)
+            self.fail(TARGET, 2)
+        self.now += 301
+        self.router.record(TARGET, 0.2, True)
+
+        self.assertTrue(self.router.is_healthy(TARGET))
+        self.assertIsNone(self.router.stats()[TARGET]['error_rate'])
+
+    def test_hedge_delay_uses_the_default_until_there_are_enough_samples(self):
+        self.assertEqual(self.router.hedge_delay(TARGET), 5.0)
+
+        for latency in (1.0, 2.0, 3.0, 4.0):
+            self.router.record(TARGET, latency, True)
+
+        self.assertEqual(self.router.hedge_delay(TARGET), 4.0)
+
+    def test_hedge_delay_has_a_floor(self):
+        for _ in range(4):
+            self.router.record(TARGET, 0.1, True)
+
+        self.assertEqual(self.router.hedge_delay(TARGET), 0.5)
+
+    def test_abandoned_calls_count_towards_latency_but_not_errors(self):
+        for _ in range(4):
+            self.router.record(TARGET, 1.0, True)
+        for _ in range(4):
+            self.router.record_abandoned(TARGET, 8.0)
+
+        stats = self.router.stats()[TARGET]
+        self.assertEqual(stats['error_rate'], 0.0)
+        self.assertEqual(stats['p95_s'], 8.0)
@@ -0,0 +1,84 @@
+import unittest
+
+from app.scheduler import FairScheduler
+
+
+def make_job(entry_id, user_id, lane='interactive', **meta):
+    return {'entry_id': entry_id, 'job_id': entry_id, 'job_data': '{}', 'meta': dict(meta, user_id=user_id, lane=lane)}
+
+def drain(scheduler):
+    jobs = []
+    while True:
+        job = scheduler.pop()
+        if job is None:
+            return jobs
+        jobs.append(job)
+        scheduler.finished(job['meta']['user_id'])
+
+
+class FairSchedulerTests(unittest.TestCase):
+    def test_lanes_get_slots_in_proportion_to_their_weight(self):
+        scheduler = FairScheduler({'lane_weights': {'interactive': 4, 'batch': 1}, 'max_concurrent_per_user': 100})
+        for i in range(20):
+            scheduler.push(make_job(f'i{i}', 'alice', 'interactive'))
+            scheduler.push(make_job(f'b{i}', 'bob', 'batch'))
+
+        first = [scheduler.pop()['meta']['lane'] for _ in range(10)]
+
+        self.assertEqual(first.count('interactive'), 8)
+        self.assertEqual(first.count('batch'), 2)
+
+    def test_user_with_many_jobs_does_not_starve_a_user_with_one(self):
+        scheduler = FairScheduler({'max_concurrent_per_user': 100})
+        for i in range(3):
+            scheduler.push(make_job(f'a{i}', 'alice'))
+        scheduler.push(make_job('b0', 'bob'))
+
+        order = [job['entry_id'] for job in drain(scheduler)]
+
+        self.assertEqual(order, ['a0', 'b0', 'a1', 'a2'])
+
+    def test_users_at_their_cap_are_skipped_until_a_job_finishes(self):
+        scheduler = FairScheduler({'max_concurrent_per_user': 1})
+        scheduler.push(make_job('a0', 'alice'))
+        scheduler.push(make_job('a1', 'alice'))
+
+        self.assertEqual(scheduler.pop()['entry_id'], 'a0')
+        self.assertIsNone(scheduler.pop())
+        scheduler.finished('alice')
+        self.assertEqual(scheduler.pop()['entry_id'], 'a1')
+
+    def test_per_user_cap_from_meta_overrides_the_default(self):
+        scheduler = FairScheduler({'max_concurrent_per_user': 1})
+        scheduler.push(make_job('a0', 'alice', max_concurrent=2))
+        scheduler.push(make_job('a1', 'alice', max_concurrent=2))
+
+        self.assertEqual(scheduler.pop()['entry_id'], 'a0')
+        self.assertEqual(scheduler.pop()['entry_id'], 'a1')
+
+    def test_heavier_user_gets_more_slots(self):
+        scheduler = FairScheduler({'max_concurrent_per_user': 100})
+        for i in range(6):
+            scheduler.push(make_job(f'a{i}', 'alice', weight=2))
+            scheduler.push(make_job(f'b{i}', 'bob', weight=1))
+
+        first = [scheduler.pop()['meta']['user_id'] for _ in range(6)]
+
+        self.assertEqual(first.count('alice'), 4)
+        self.assertEqual(first.count('bob'), 2)
+
+    def test_unknown_lane_falls_back_to_the_default_lane(self):
+        scheduler = FairScheduler()
+        scheduler.push(make_job('x', 'alice', lane='nonsense'))
+
+        self.assertEqual(scheduler.stats()['interactive'], 1)
+
+    def test_len_and_entry_ids_track_buffered_jobs(self):
+        scheduler = FairScheduler()
+        scheduler.push(make_job('a0', 'alice'))
+        scheduler.push(make_job('b0', 'bob', lane='batch'))
+
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(sorted(scheduler.entry_ids()), ['a0', 'b0'])
+        scheduler.pop()
+        self.assertEqual(len(scheduler), 1)
@@ -0,0 +1,43 @@
+"""A randomly initialised Llama model and word-level tokenizer small enough for CPU unit tests."""
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = ["<pad>", "<unk>", "<bos>", "<eos>", "<eot>", "<user>", "<assistant>", "<system>"]
+WORDS = (
+    "the a an of to and in is it for on with as that this what how why when where which who "
+    "user query agent agents available respond name select selected default suitable clearly "
+    "given determine best following format exact only replace chosen if no are with "
+    "coder writer general_agent math_agent code poem story write sort list python numbers "
+    "hello hi please help me explain summarize translate add two plus one three four five "
+    ". , : ; ! ? \" ' [ ] ( ) _ -"
+).split()
+
+CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% for message in messages %}<{{ message['role'] }}> {{ message['content'] }} <eot> {% endfor %}"
+    "{% if add_generation_prompt %}<assistant> {% endif %}"
+)
+
+
+def build_tokenizer() -> PreTrainedTokenizerFast:
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + sorted(set(WORDS)))}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.decoder = decoders.WordPiece(prefix="##", cleanup=False)
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<bos>", eos_token="<eos>", unk_token="<unk>", pad_token="<pad>",
+        additional_special_tokens=["<eot>", "<user>", "<assistant>", "<system>"]
+    )
+    hf_tokenizer.chat_template = CHAT_TEMPLATE
+    return hf_tokenizer
+
+
+def build_model(tokenizer, seed: int = 0) -> LlamaForCausalLM:
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512,
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id
+    )
+    return LlamaForCausalLM(config).eval()
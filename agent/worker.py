@@ -4,8 +4,13 @@ import yaml
 import json
 import redis
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from providers.handler import get_chat_model, invoke_llm_with_history
+import asyncio
+import functools
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from providers.handler import get_chat_model, astream_llm_with_history
+from providers.routing import ProviderRouter
 import multiprocessing as mp
 from dotenv import load_dotenv
 
@@ -13,10 +18,25 @@ load_dotenv()
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '.')))
 
-from app.llm_inference import load_base_model_and_tokenizer
+from app.llm_inference import load_base_model_and_tokenizer, load_tokenizer, load_draft_model, set_draft_model, set_static_cache_pool, run_on_model, get_cache_stats
+from app.static_cache import enable_compiled_decoding, warm_up_compiled_decoding
 from app.router import route_request
 from app.subagent_handler import handle_with_subagent, handle_with_subagent_stream
-from app.llm_inference import generate_response, generate_response_stream
+from app.llm_inference import generate_response, generate_response_stream, set_inference_engine, ensure_adapter
+from app.batching_engine import BatchingEngine
+from app.inference_server import InferenceClient, serve_inference, wait_for_inference_server
+from app.adapter_manager import init_adapter_manager
+from app.prefix_cache import init_prefix_cache
+from app.redis_client import get_redis_client, get_async_redis_client
+from app.job_queue import JobQueue
+from app.scheduler import FairScheduler
+from app.provider_executor import init_provider_executor
+from app.cancellation import CancellationCriteria, is_job_cancelled
+from app.context_manager import pack_history
+from app.cpu_affinity import partition_cores, init_cpu_worker, uses_cpu_inference
+from app.heartbeat import start_heartbeat, job_started, job_finished
+from app.response_cache import ResponseCache, scope_version
+from app.conversation_summary import load_summary, unsummarized_turns, update_summary_in_background, enqueue_summary_update, run_summary_job
 from safety.detector import SafetyDetector
 
 print("--- [WORKER] Initializing ---")
@@ -29,24 +49,369 @@ with open(CONFIG_PATH, 'r') as f:
 MODEL = None
 TOKENIZER = None
 AGENTS_CONFIG = CONFIG.get('agents', {})
+INFERENCE_CONFIG = CONFIG.get('inference', {})
+CONTEXT_CONFIG = CONFIG.get('context', {})
+CPU_CONFIG = CONFIG.get('cpu', {})
 ALL_SYSTEM_AGENTS = list(AGENTS_CONFIG.keys())
 SAFETY_DETECTOR = SafetyDetector(CONFIG.get('safety', {}))
+POOL_HEARTBEAT_PENDING = False
+RESPONSE_CACHE = ResponseCache(get_redis_client(), CONFIG.get('response_cache', {}))
+PROVIDER_ROUTER = ProviderRouter(CONFIG.get('provider_routing', {}))
+
+def publish_stream_event(redis_client, job_id: str, payload: dict):
+    """Publishes an incremental event for a job on its `job_stream:{job_id}` channel."""
+    try:
+        redis_client.publish(f"job_stream:{job_id}", json.dumps(payload))
+    except redis.exceptions.RedisError as e:
+        print(f"[Worker] WARNING: Could not publish stream event for job {job_id}: {e}")
+
+async def publish_stream_event_async(redis_client, job_id: str, payload: dict):
+    """`publish_stream_event` for coroutines on the provider executor's loop."""
+    try:
+        await redis_client.publish(f"job_stream:{job_id}", json.dumps(payload))
+    except redis.exceptions.RedisError as e:
+        print(f"[Worker] WARNING: Could not publish stream event for job {job_id}: {e}")
+
+def get_inference_server_address() -> tuple:
+    return (INFERENCE_CONFIG.get('server_host', 'localhost'), int(INFERENCE_CONFIG.get('server_port', 6100)))
+
+def get_inference_server_authkey() -> bytes:
+    return os.environ['INFERENCE_SERVER_AUTHKEY'].encode()
 
 def initialize_worker():
-    """Loads the LLM model into the worker process's memory."""
+    """
+    Loads the LLM model into the worker process's memory. In server mode only the
+    tokenizer is loaded and generation is sent to the inference server process.
+    """
     global MODEL, TOKENIZER
-    if MODEL is None:
-        worker_pid = os.getpid()
-        print(f"--- [Worker PID: {worker_pid}] Loading model... ---")
-        MODEL, TOKENIZER = load_base_model_and_tokenizer(CONFIG['base_model'])
-        print(f"--- [Worker PID: {worker_pid}] Model loaded successfully. ---")
+    if TOKENIZER is not None:
+        return
+    worker_pid = os.getpid()
+    if INFERENCE_CONFIG.get('mode', 'process_pool') == 'server':
+        print(f"--- [Worker PID: {worker_pid}] Connecting to inference server... ---")
+        TOKENIZER = load_tokenizer(CONFIG['base_model'])
+        set_inference_engine(InferenceClient(get_inference_server_address(), get_inference_server_authkey()))
+        return
+    print(f"--- [Worker PID: {worker_pid}] Loading model... ---")
+    MODEL, TOKENIZER = load_base_model_and_tokenizer(CONFIG['base_model'], CONFIG.get('precision', {}).get('profile', 'int8'))
+    speculative_config = CONFIG.get('speculative', {})
+    if speculative_config.get('enabled', False) and INFERENCE_CONFIG.get('mode', 'process_pool') == 'process_pool':
+        set_draft_model(load_draft_model(speculative_config['draft_model'], speculative_config.get('num_assistant_tokens', 5)))
+    init_adapter_manager(CONFIG.get('adapter_cache', {}))
+    init_prefix_cache(CONFIG.get('prefix_cache', {}))
+    compile_config = CONFIG.get('compile', {})
+    if compile_config.get('enabled', False) and INFERENCE_CONFIG.get('mode', 'process_pool') == 'process_pool':
+        static_cache_pool = enable_compiled_decoding(MODEL, compile_config)
+        warm_up_compiled_decoding(MODEL, TOKENIZER, static_cache_pool)
+        set_static_cache_pool(static_cache_pool)
+    print(f"--- [Worker PID: {worker_pid}] Model loaded successfully. ---")
+
+def warm_up_worker():
+    """
+    Gets a worker ready to serve its first local job without delay: loads the model,
+    makes the router and agent adapters resident, tokenizes the agent prompts and runs
+    a one-token generation so the first real request doesn't pay for any of it.
+    """
+    initialize_worker()
+    worker_pid = os.getpid()
+    start = time.time()
+    print(f"--- [Worker PID: {worker_pid}] Warming up... ---")
+    adapters = [("router", CONFIG['router']['model_path'])]
+    adapters += [(agent_name, agent_config['model_path']) for agent_name, agent_config in AGENTS_CONFIG.items()]
+    for adapter_name, adapter_path in adapters:
+        try:
+            ensure_adapter(MODEL, adapter_name, os.path.join(PROJECT_ROOT, adapter_path))
+        except Exception as e:
+            print(f"[Worker PID: {worker_pid}] WARNING: Could not pre-load adapter '{adapter_name}': {e}")
+
+    for agent_name, agent_config in AGENTS_CONFIG.items():
+        prompt_path = os.path.join(PROJECT_ROOT, agent_config['prompt_file'].lstrip('/'))
+        if os.path.exists(prompt_path):
+            with open(prompt_path, 'r') as f:
+                prompt_tokens = len(TOKENIZER(f.read().strip(), add_special_tokens=False)["input_ids"])
+            print(f"[Worker PID: {worker_pid}] Prompt of agent '{agent_name}': {prompt_tokens} tokens.")
+
+    generate_response(MODEL, TOKENIZER, prompt_text="Hello", max_new_tokens=1)
+    print(f"--- [Worker PID: {worker_pid}] Warm-up finished in {time.time() - start:.1f}s. ---")
+
+def start_pool_worker_heartbeat():
+    """Starts this pool process's readiness heartbeat once, after its model is usable."""
+    global POOL_HEARTBEAT_PENDING
+    if POOL_HEARTBEAT_PENDING and TOKENIZER is not None:
+        start_heartbeat(capacity=1, mode=INFERENCE_CONFIG.get('mode', 'process_pool'))
+        POOL_HEARTBEAT_PENDING = False
+
+def init_pool_worker(core_queue=None, interop_threads: int = 1):
+    """ProcessPoolExecutor initializer: pins the CPU if asked, warms up and starts the heartbeat."""
+    global POOL_HEARTBEAT_PENDING
+    if core_queue is not None:
+        init_cpu_worker(core_queue, interop_threads)
+    POOL_HEARTBEAT_PENDING = True
+    if not INFERENCE_CONFIG.get('warm_up', True):
+        # Without warm-up the model loads on the first job; the process is ready to take it.
+        start_heartbeat(capacity=1, mode=INFERENCE_CONFIG.get('mode', 'process_pool'))
+        POOL_HEARTBEAT_PENDING = False
+        return
+    try:
+        warm_up_worker()
+    except Exception as e:
+        # An initializer exception breaks the whole pool. The model is loaded again on the
+        # next job and the heartbeat starts once that succeeds.
+        print(f"[Worker PID: {os.getpid()}] ERROR: Warm-up failed, not reporting as ready yet: {e}")
+        return
+    start_pool_worker_heartbeat()
+
+def _noop():
+    return None
+
+def run_job(job_data_str):
+    """Runs `process_job`, counting it as active in this process's heartbeat."""
+    job_started()
+    try:
+        return process_job(job_data_str)
+    finally:
+        job_finished()
+        start_pool_worker_heartbeat()
+
+def check_input_guardrail(job_data: dict):
+    """Returns the blocked result if the user's query trips the content safety policy, else None."""
+    user_feature_flags = job_data.get('user_feature_flags', {})
+    if user_feature_flags.get('block_dangerous_content', False) and SAFETY_DETECTOR.contains_dangerous_content(job_data['user_query']):
+        response = "This request has been blocked as it violates the content safety policy."
+        display_name = "System Guardrail"
+        return json.dumps({'status': 'complete', 'response': response, 'agent_name': display_name})
+    return None
+
+def check_output_guardrail(job_data: dict, response: str, display_name: str) -> str:
+    """Builds the job's result, replacing the response if it trips the content safety policy."""
+    if job_data.get('user_feature_flags', {}).get('block_dangerous_content', False) and SAFETY_DETECTOR.contains_dangerous_content(response):
+        response = "The generated response was blocked as it was found to contain potentially harmful content."
+        display_name = "System Guardrail"
+
+    result = {
+        'status': 'complete',
+        'response': response,
+        'agent_name': display_name
+    }
+
+    return json.dumps(result)
+
+def resolve_target(job_data: dict) -> str:
+    """'local_system' or the 'provider:model' the job should run on."""
+    selected_model_or_system = job_data['expert_settings'].get('model_selection', 'local_system')
+
+    if job_data.get('user_feature_flags', {}).get('pii_force_local', False) and SAFETY_DETECTOR.contains_pii(job_data['user_query']):
+        print(f"[Worker Safety] PII detected in prompt for job {job_data['job_id']}. Forcing to local system.")
+        selected_model_or_system = 'local_system'
+    return selected_model_or_system
+
+def local_fallback_allowed(job_data: dict) -> bool:
+    """
+    Whether a provider job may fail over to the local system. The web app only allows it
+    for users who could have picked the local system themselves.
+    """
+    return bool(PROVIDER_ROUTER.fail_over_to_local and job_data.get('local_fallback', {}).get('allowed', False))
+
+def switch_to_local(job_data: dict):
+    """
+    Points a provider job at the local system with the agents the user may use there and
+    counts it against the user's daily local system limit.
+    """
+    local_fallback = job_data['local_fallback']
+    job_data['expert_settings'] = dict(job_data['expert_settings'], model_selection='local_system')
+    job_data['user_available_agents'] = local_fallback.get('available_agents', [])
+    rate_limit_key = local_fallback.get('rate_limit_key')
+    if rate_limit_key:
+        pipe = get_redis_client().pipeline()
+        pipe.incr(rate_limit_key)
+        pipe.expire(rate_limit_key, 86400)
+        pipe.execute()
+
+def provider_display_name(target: str) -> str:
+    provider_name, provider_model_name = target.split(':')
+    provider_config = CONFIG['providers'][provider_name]
+    model_details = next((m for m in provider_config['models'] if m['id'] == provider_model_name), None)
+
+    if model_details:
+        return f"{provider_config['display_name']}: {model_details['display_name']}"
+    return f"{provider_name.capitalize()}: {provider_model_name}"
+
+async def open_provider_stream(job_data: dict, target: str) -> tuple:
+    """
+    Starts the target's response stream and waits for its first chunk. Returns
+    (stream, first_chunk, latency_s). Failures are recorded here; a call that answers is
+    recorded by whoever reads its stream, once its outcome is known.
+    """
+    provider_name, provider_model_name = target.split(':')
+    chat_model = get_chat_model(
+        provider_name=provider_name,
+        model_name=provider_model_name,
+        temperature=job_data['expert_settings'].get('temperature', 0.7),
+        top_p=job_data['expert_settings'].get('top_p', 0.9)
+    )
+    stream = astream_llm_with_history(
+        chat_model=chat_model,
+        prompt=job_data['user_query'],
+        history=job_data['chat_history_for_providers']
+    )
+    start = time.monotonic()
+    try:
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = ""
+    except asyncio.CancelledError:
+        # Another target answered first.
+        PROVIDER_ROUTER.record_abandoned(target, time.monotonic() - start)
+        await stream.aclose()
+        raise
+    except Exception:
+        PROVIDER_ROUTER.record(target, time.monotonic() - start, False)
+        await stream.aclose()
+        raise
+    return stream, first_chunk, time.monotonic() - start
+
+async def race_provider_streams(job_data: dict, targets: list, check_health: bool = True) -> tuple:
+    """
+    Opens the first target's stream and, with hedging enabled, also the next target's
+    once the first hasn't answered within its hedge delay; whichever answers first wins.
+    Targets that fail are replaced by the next one. With `check_health` a target is only
+    started if the router still lets a request through to it.
+    Returns (target, stream, first_chunk, latency_s).
+    """
+    remaining = list(targets)
+    pending = {}
+    hedged = False
+    last_error = None
+
+    def start_next():
+        while remaining:
+            target = remaining.pop(0)
+            if not check_health or PROVIDER_ROUTER.acquire(target):
+                pending[asyncio.ensure_future(open_provider_stream(job_data, target))] = target
+                return
+
+    start_next()
+    try:
+        while pending:
+            can_hedge = PROVIDER_ROUTER.hedging_enabled and not hedged and remaining
+            timeout = PROVIDER_ROUTER.hedge_delay(next(iter(pending.values()))) if can_hedge else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                print(f"[Provider Routing] Hedging job {job_data['job_id']} to {remaining[0]}.")
+                start_next()
+                continue
+            winner = None
+            for task in done:
+                target = pending.pop(task)
+                try:
+                    stream, first_chunk, latency_s = task.result()
+                except Exception as e:
+                    print(f"[Provider Routing] {target} failed for job {job_data['job_id']}: {e}")
+                    last_error = e
+                    continue
+                if winner is None:
+                    winner = (target, stream, first_chunk, latency_s)
+                else:
+                    # Answered in the same instant as the winner; nobody will read it.
+                    PROVIDER_ROUTER.record(target, latency_s, True)
+                    await stream.aclose()
+            if winner is not None:
+                return winner
+            if not pending and remaining:
+                start_next()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            # Let the losers close their streams and record their samples.
+            await asyncio.gather(*pending, return_exceptions=True)
+    raise last_error or RuntimeError("No provider is available.")
+
+async def call_provider(job_data: dict, selected_model_or_system: str, stream_tokens: bool = False, cancellation: CancellationCriteria = None) -> tuple:
+    """
+    Answers the job with an external provider model, or one of its fallbacks if it is
+    unhealthy, slow or failing. Returns (response, display_name), or (None, None) if no
+    provider answered and the job may fail over to the local system.
+    With `stream_tokens` the chunks are published on the job's stream channel as the
+    provider delivers them, like local tokens; `cancellation` stops reading the stream.
+    """
+    targets = PROVIDER_ROUTER.candidates(selected_model_or_system)
+    check_health = bool(targets)
+    if not targets:
+        if local_fallback_allowed(job_data):
+            return None, None
+        # Nothing else could answer, so try the selected target even though it is unhealthy.
+        targets = [selected_model_or_system]
+
+    try:
+        target, stream, first_chunk, latency_s = await race_provider_streams(job_data, targets, check_health)
+    except Exception as e:
+        if local_fallback_allowed(job_data):
+            return None, None
+        return f"Error calling LangChain provider '{selected_model_or_system.split(':')[0]}': {e}", provider_display_name(selected_model_or_system)
+
+    display_name = provider_display_name(target)
+    print(f"[Worker] Calling LangChain provider: {display_name}")
+    redis_client = get_async_redis_client()
+    if stream_tokens:
+        await publish_stream_event_async(redis_client, job_data['job_id'], {'type': 'agent', 'agent_name': display_name})
+    response = ""
+    ok = True
+    try:
+        chunk = first_chunk
+        while True:
+            if cancellation is not None and await cancellation.check_async():
+                break
+            response += chunk
+            if chunk and stream_tokens:
+                await publish_stream_event_async(redis_client, job_data['job_id'], {'type': 'token', 'content': chunk})
+            chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        pass
+    except Exception as e:
+        ok = False
+        response = f"Error calling LangChain provider '{target.split(':')[0]}': {e}"
+    finally:
+        await stream.aclose()
+        # Latency is the time to the first chunk either way; the call fails if its stream broke.
+        PROVIDER_ROUTER.record(target, latency_s, ok)
+    if stream_tokens:
+        await publish_stream_event_async(redis_client, job_data['job_id'], {'type': 'end'})
+    return response, display_name
+
+async def process_provider_job(job_data_str):
+    """
+    Runs a job that targets an external provider on the orchestrator's ProviderExecutor,
+    so it doesn't hold a worker slot (or load anything) while waiting on the network.
+    """
+    job_data = json.loads(job_data_str)
+    print(f"[Worker] Processing provider job {job_data['job_id']}")
+    blocked_result = check_input_guardrail(job_data)
+    if blocked_result:
+        return blocked_result
+    cancellation = CancellationCriteria(job_data['job_id'])
+    # Output guardrails can only judge the full response, so don't stream to users that have them.
+    stream_tokens = not job_data.get('user_feature_flags', {}).get('block_dangerous_content', False)
+    response, display_name = await call_provider(job_data, resolve_target(job_data), stream_tokens, cancellation)
+    if response is None:
+        # The orchestrator re-queues the job for the worker pool.
+        return json.dumps({'status': 'failover'})
+    if cancellation.cancelled:
+        print(f"[Worker] Cancelled provider job {job_data['job_id']}")
+        return json.dumps({'status': 'cancelled', 'response': 'The request was cancelled.', 'agent_name': display_name})
+    return check_output_guardrail(job_data, response, display_name)
 
 def process_job(job_data_str):
     """
-    The main worker function, now capable of routing to local agents OR external providers.
+    The main worker function: answers a local system job with the pool's loaded model.
     """
     job_data = json.loads(job_data_str)
-    redis_pubsub_client = redis.Redis(decode_responses=True)
+    redis_pubsub_client = get_redis_client()
+    if job_data.get('kind') == 'summary':
+        initialize_worker()
+        run_summary_job(MODEL, TOKENIZER, redis_pubsub_client, job_data)
+        return json.dumps({'status': 'complete'})
     print(f"[Worker] Processing job {job_data['job_id']}")
     
     user_query = job_data['user_query']
@@ -60,98 +425,193 @@ def process_job(job_data_str):
     print(user_feature_flags.get('pii_force_local', False))
     print(SAFETY_DETECTOR.contains_pii(user_query))
 
-    if user_feature_flags.get('block_dangerous_content', False) and SAFETY_DETECTOR.contains_dangerous_content(user_query):
-        response = "This request has been blocked as it violates the content safety policy."
-        display_name = "System Guardrail"
-        return json.dumps({'status': 'complete', 'response': response, 'agent_name': display_name})
+    blocked_result = check_input_guardrail(job_data)
+    if blocked_result:
+        return blocked_result
 
-    selected_model_or_system = expert_settings.get('model_selection', 'local_system')
-    
-    if user_feature_flags.get('pii_force_local', False) and SAFETY_DETECTOR.contains_pii(user_query):
-        print(f"[Worker Safety] PII detected in prompt for job {job_data['job_id']}. Forcing to local system.")
-        selected_model_or_system = 'local_system'
-
-    if selected_model_or_system == 'local_system':
-        initialize_worker()
-        worker_pid = os.getpid()
-        print(f"--- [Worker PID: {worker_pid}] STARTING job {job_data['job_id']}. Re-using loaded model. ---")
+    selected_model_or_system = resolve_target(job_data)
 
-        pubsub_channel = f"job_stream:{worker_pid}"
-        user_query = job_data['user_query']
-        user_available_agents = job_data['enabled_local_agents'] if not job_data['user_available_agents'] else job_data['user_available_agents']
-        chat_history_context = list(job_data['chat_history_for_local'])
-        expert_settings = job_data['expert_settings']
+    if selected_model_or_system != 'local_system':
+        # The orchestrator runs provider jobs with `process_provider_job`, beside the pool.
+        raise ValueError(f"Job {job_data['job_id']} targets {selected_model_or_system}, not the local system.")
 
-        generation_kwargs = {
-            'temperature': expert_settings.get('temperature', 0.7),
-            'top_p': expert_settings.get('top_p', 0.9)
-        }
+    worker_pid = os.getpid()
+    job_id = job_data['job_id']
+    user_query = job_data['user_query']
+    user_available_agents = job_data['enabled_local_agents'] if not job_data['user_available_agents'] else job_data['user_available_agents']
+    chat_history_context = list(job_data['chat_history_for_local'])
+    expert_settings = job_data['expert_settings']
 
-        router_adapter_path = os.path.join(PROJECT_ROOT, CONFIG['router']['model_path'])
-        chosen_agent = route_request(MODEL, TOKENIZER, user_query, user_available_agents, router_adapter_path, **generation_kwargs)
+    cancellation = CancellationCriteria(job_id)
+    generation_kwargs = {
+        'temperature': expert_settings.get('temperature', 0.7),
+        'top_p': expert_settings.get('top_p', 0.9),
+        'stopping_criteria': [cancellation]
+    }
 
-        if chosen_agent and chosen_agent in user_available_agents:
+    router_adapter_path = os.path.join(PROJECT_ROOT, CONFIG['router']['model_path'])
+    classifier_path = os.path.join(PROJECT_ROOT, CONFIG['router'].get('classifier_path', 'models/router_classifier'))
+    conversation_id = job_data.get('conversation_id')
+    summary_record = load_summary(redis_pubsub_client, conversation_id)
+
+    # A cached answer covers whichever agent the router would pick, so it is looked up first.
+    cache_version = scope_version([router_adapter_path, classifier_path] + [
+        os.path.join(PROJECT_ROOT, AGENTS_CONFIG[agent]['model_path']) for agent in sorted(user_available_agents) if agent in AGENTS_CONFIG
+    ])
+    cache_settings = {'temperature': round(generation_kwargs['temperature'], 2), 'top_p': round(generation_kwargs['top_p'], 2)}
+    use_cache = RESPONSE_CACHE.is_eligible(job_data['chat_history_for_local'], generation_kwargs['temperature'], has_summary=bool(summary_record['summary']))
+    cached_entry = RESPONSE_CACHE.get(user_available_agents, cache_version, user_query, cache_settings) if use_cache else None
+
+    if cached_entry is not None:
+        chosen_agent = cached_entry['agent_name']
+        use_agent = chosen_agent != '__assistant__'
+        dropped_turns = []
+        response_stream = iter([cached_entry['response']])
+        print(f"[Worker PID: {worker_pid}] Answering job {job_id} from the response cache.")
+    else:
+        initialize_worker()
+        print(f"--- [Worker PID: {worker_pid}] STARTING job {job_id}. Re-using loaded model. ---")
+
+        chosen_agent = route_request(
+            MODEL, TOKENIZER, user_query, user_available_agents, router_adapter_path,
+            mode=CONFIG['router'].get('mode', 'generate'),
+            min_confidence=CONFIG['router'].get('min_confidence', 0.0),
+            classifier_path=classifier_path,
+            classifier_min_confidence=CONFIG['router'].get('classifier_min_confidence', 0.8),
+            **generation_kwargs
+        )
+
+        history_budget = AGENTS_CONFIG.get(chosen_agent, {}).get('history_token_budget', CONTEXT_CONFIG.get('history_token_budget', 2048))
+        chat_history_context, dropped_turns = pack_history(
+            TOKENIZER, chat_history_context, history_budget,
+            max_messages=CONTEXT_CONFIG.get('max_history_messages'),
+            min_truncated_tokens=CONTEXT_CONFIG.get('min_truncated_tokens', 64),
+            summary=summary_record['summary'],
+            summary_through=summary_record['last_message_id']
+        )
+        print(f"[Worker PID: {worker_pid}] Packed history into {history_budget} tokens, dropped {len(dropped_turns)} older turns.")
+
+        use_agent = bool(chosen_agent and chosen_agent in user_available_agents)
+        if use_agent:
             agent_config = AGENTS_CONFIG[chosen_agent]
             final_agent_config = {
                 'prompt_file': os.path.join(PROJECT_ROOT, agent_config['prompt_file']),
                 'model_path': os.path.join(PROJECT_ROOT, agent_config['model_path']),
                 'tools_whitelist': agent_config.get('tools_whitelist', [])
             }
-            response = handle_with_subagent(MODEL, TOKENIZER, agent_name=chosen_agent, user_query=user_query, prompt_history=chat_history_context, agent_config=final_agent_config, **generation_kwargs) # without streaming funcitonality use handle_with_subagent
-
-            display_name = chosen_agent.capitalize()
+            response_stream = handle_with_subagent_stream(MODEL, TOKENIZER, agent_name=chosen_agent, user_query=user_query, prompt_history=chat_history_context, agent_config=final_agent_config, **generation_kwargs)
         else:
-            response = generate_response(MODEL, TOKENIZER, user_query=user_query, **generation_kwargs) # without streaming use generate_response
-            display_name = "Assistant"
-        
-        print(f"[Worker PID: {worker_pid}] Finished job {job_data['job_id']}")
-
-        #for token in response_stream:
-        #        if token:
-        #            response += token
-        #            payload = json.dumps({'type': 'token', 'content': token})
-        #            redis_pubsub_client.publish(pubsub_channel, payload)
-
-    else:
-        provider_name, provider_model_name = selected_model_or_system.split(':')
-        provider_config = CONFIG['providers'][provider_name]
-        model_details = next((m for m in provider_config['models'] if m['id'] == provider_model_name), None)
-        
-        if model_details:
-            display_name = f"{provider_config['display_name']}: {model_details['display_name']}"
+            response_stream = generate_response_stream(MODEL, TOKENIZER, prompt_text=user_query, prompt_history=chat_history_context, **generation_kwargs)
+
+    display_name = chosen_agent.capitalize() if use_agent else "Assistant"
+
+    publish_stream_event(redis_pubsub_client, job_id, {'type': 'agent', 'agent_name': display_name})
+
+    # Output guardrails can only judge the full response, so don't stream to users that have them.
+    stream_tokens = not user_feature_flags.get('block_dangerous_content', False)
+
+    response = ""
+    for token in response_stream:
+        if cancellation.check():
+            break
+        if token:
+            response += token
+            if stream_tokens:
+                publish_stream_event(redis_pubsub_client, job_id, {'type': 'token', 'content': token})
+    if hasattr(response_stream, 'close'):
+        response_stream.close()
+    response = response.strip()
+
+    publish_stream_event(redis_pubsub_client, job_id, {'type': 'end'})
+    if cancellation.cancelled:
+        print(f"[Worker PID: {worker_pid}] Cancelled job {job_id}")
+        return json.dumps({'status': 'cancelled', 'response': 'The request was cancelled.', 'agent_name': display_name})
+
+    if use_cache and cached_entry is None and response:
+        RESPONSE_CACHE.put(user_available_agents, cache_version, user_query, response, chosen_agent if use_agent else '__assistant__', cache_settings)
+
+    new_turns = unsummarized_turns(summary_record, dropped_turns, chat_history_context)
+    if new_turns and conversation_id and CONTEXT_CONFIG.get('summarize_dropped_turns', True):
+        summary_max_new_tokens = CONTEXT_CONFIG.get('summary_max_new_tokens', 256)
+        if INFERENCE_CONFIG.get('mode', 'process_pool') == 'process_pool':
+            # Without an engine the model can't be shared, so the pool runs the update as a job of its own.
+            summary_queue = JobQueue(redis_pubsub_client, CONFIG.get('job_queue', {}))
+            enqueue_summary_update(summary_queue, conversation_id, summary_record, new_turns, max_new_tokens=summary_max_new_tokens)
         else:
-            display_name = f"{provider_name.capitalize()}: {provider_model_name}"
-        print(f"[Worker] Calling LangChain provider: {display_name}")
-
-        try:
-            chat_model = get_chat_model(
-                provider_name=provider_name,
-                model_name=provider_model_name,
-                temperature=job_data['expert_settings'].get('temperature', 0.7),
-                top_p=job_data['expert_settings'].get('top_p', 0.9)
+            update_summary_in_background(
+                MODEL, TOKENIZER, redis_pubsub_client, conversation_id, summary_record, new_turns,
+                max_new_tokens=summary_max_new_tokens
             )
-            
-            response = invoke_llm_with_history(
-                chat_model=chat_model,
-                prompt=job_data['user_query'],
-                history=job_data['chat_history_for_providers']
-            )
-        except Exception as e:
-            response = f"Error calling LangChain provider '{provider_name}': {e}"
+    print(f"[Worker PID: {worker_pid}] Finished job {job_id}")
+    if cached_entry is None:
+        cache_stats = run_on_model(MODEL, TOKENIZER, get_cache_stats)
+        print(f"[Worker PID: {worker_pid}] Adapter cache: {cache_stats['adapter_cache']}")
+        print(f"[Worker PID: {worker_pid}] Prefix cache: {cache_stats['prefix_cache']}")
 
-    if user_feature_flags.get('block_dangerous_content', False) and SAFETY_DETECTOR.contains_dangerous_content(response):
-        response = "The generated response was blocked as it was found to contain potentially harmful content."
-        display_name = "System Guardrail"
-
-    result = {
-        'status': 'complete',
-        'response': response,
-        'agent_name': display_name
-    }
-
-    return json.dumps(result)
 
+    return check_output_guardrail(job_data, response, display_name)
 
+def store_result(redis_client, job_id: str, result_str: str):
+    """
+    Pushes a job's result onto its `result:{job_id}` list, where the web app is waiting
+    on it with BLPOP, and notifies the job's stream channel that it is there.
+    """
+    pipe = redis_client.pipeline()
+    pipe.rpush(f"result:{job_id}", result_str)
+    pipe.expire(f"result:{job_id}", 300)
+    pipe.publish(f"job_stream:{job_id}", json.dumps({'type': 'result'}))
+    pipe.execute()
+
+def release_user_job(redis_client, user_id):
+    """Takes a job off the user's `user_jobs:{user_id}` count that the web app admits jobs by."""
+    if user_id is None:
+        return
+    try:
+        redis_client.decr(f"user_jobs:{user_id}")
+    except redis.exceptions.RedisError as e:
+        print(f"[Orchestrator] WARNING: Could not release job slot of user {user_id}: {e}")
+
+def complete_job(redis_client, job_queue: JobQueue, job: dict, future):
+    """Stores a finished job's result and acks its stream entry."""
+    job_id, entry_id = job['job_id'], job['entry_id']
+    # Nobody waits on the result of a summary update.
+    has_waiter = job['meta'].get('kind') != 'summary'
+    try:
+        result_str = future.result()
+        if has_waiter:
+            store_result(redis_client, job_id, result_str)
+        print(f"[Orchestrator] Job {job_id} completed successfully.")
+    except BrokenProcessPool:
+        print(f"[Orchestrator] Job {job_id} lost its worker process. Leaving it pending for reclaim.")
+        return
+    except Exception as exc:
+        print(f"[Orchestrator] Job {job_id} failed with an exception: {exc}")
+        if has_waiter:
+            error_result = json.dumps({'status': 'error', 'response': str(exc)})
+            store_result(redis_client, job_id, error_result)
+    release_user_job(redis_client, job['meta'].get('user_id'))
+    try:
+        job_queue.ack(entry_id)
+    except redis.exceptions.RedisError as e:
+        print(f"[Orchestrator] WARNING: Could not ack job {job_id}: {e}")
+
+def fail_over_to_local(job: dict) -> dict:
+    """Rewrites a provider job so the worker pool answers it with the local system."""
+    job_data = json.loads(job['job_data'])
+    print(f"[Orchestrator] Failing job {job['job_id']} over from {job_data['expert_settings'].get('model_selection')} to the local system.")
+    switch_to_local(job_data)
+    return dict(job, job_data=json.dumps(job_data))
+
+def complete_provider_job(redis_client, job_queue: JobQueue, failover_jobs, job: dict, future):
+    """Like `complete_job`, but hands jobs that no provider answered back to the orchestrator."""
+    try:
+        failed_over = json.loads(future.result()).get('status') == 'failover'
+    except Exception:
+        failed_over = False
+    if failed_over:
+        failover_jobs.put(fail_over_to_local(job))
+        return
+    complete_job(redis_client, job_queue, job, future)
 
 def main():
     try:
@@ -161,13 +621,7 @@ def main():
         pass
 
     redis_host = os.getenv('REDIS_HOST', 'localhost')
-    redis_client = redis.Redis(
-        host=os.getenv('REDIS_HOST', 'localhost'),
-        port=int(os.getenv('REDIS_PORT', 6379)),
-        db=int(os.getenv('REDIS_DB', 0)),
-        password=os.getenv('REDIS_PASSWORD'), 
-        decode_responses=True
-    )
+    redis_client = get_redis_client()
     try:
         redis_client.ping()
         print(f"--- [Orchestrator] Successfully connected to Redis at {redis_host}. ---")
@@ -176,40 +630,149 @@ def main():
         sys.exit(1)
 
     NUM_WORKERS = int(os.getenv("NUM_WORKERS", 1))
+    executor_class = ProcessPoolExecutor
+
+    inference_mode = INFERENCE_CONFIG.get('mode', 'process_pool')
+    if inference_mode == 'batched':
+        # One model in this process; jobs run in threads and share the engine's decode batch.
+        initialize_worker()
+        engine = BatchingEngine(MODEL, TOKENIZER, INFERENCE_CONFIG)
+        engine.start()
+        set_inference_engine(engine)
+        NUM_WORKERS = engine.max_batch_size
+        if INFERENCE_CONFIG.get('warm_up', True):
+            warm_up_worker()
+        start_heartbeat(capacity=NUM_WORKERS, mode=inference_mode)
+        executor_class = ThreadPoolExecutor
+        print(f"--- [Orchestrator] Batched inference enabled. Jobs share one model in-process. ---")
+    elif inference_mode == 'server':
+        # One process owns the model; worker processes only load the tokenizer and send it requests.
+        os.environ.setdefault('INFERENCE_SERVER_AUTHKEY', os.urandom(16).hex())
+        address = get_inference_server_address()
+        server_process = mp.Process(
+            target=serve_inference,
+            args=(CONFIG, address, get_inference_server_authkey()),
+            name="inference-server",
+            daemon=True
+        )
+        server_process.start()
+        print(f"--- [Orchestrator] Waiting for the inference server to load the model... ---")
+        wait_for_inference_server(address, get_inference_server_authkey(), server_process)
+        print(f"--- [Orchestrator] Inference server ready at {address[0]}:{address[1]}. ---")
+
+    executor_kwargs = {}
+    if executor_class is ProcessPoolExecutor:
+        executor_kwargs = {'initializer': init_pool_worker}
+    precision = CONFIG.get('precision', {}).get('profile', 'int8')
+    if inference_mode == 'process_pool' and uses_cpu_inference(precision) and CPU_CONFIG.get('pin_threads', True):
+        # Give every worker process its own cores instead of letting each one grab all of them.
+        core_queue = mp.Queue()
+        for cores in partition_cores(NUM_WORKERS, CPU_CONFIG.get('threads_per_worker')):
+            core_queue.put(cores)
+        executor_kwargs = {'initializer': init_pool_worker, 'initargs': (core_queue, CPU_CONFIG.get('interop_threads', 1))}
+        print(f"--- [Orchestrator] CPU inference: pinning each worker to its own core set. ---")
+
     print(f"--- [Orchestrator] Starting worker pool with {NUM_WORKERS} workers. ---")
 
-    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    job_queue = JobQueue(redis_client, CONFIG.get('job_queue', {}))
+    job_queue.ensure_group()
+
+    with executor_class(max_workers=NUM_WORKERS, **executor_kwargs) as executor:
         active_futures = {}
+        if executor_class is ProcessPoolExecutor:
+            # Worker processes start lazily; a no-op per worker spawns (and so warms up) all of them now.
+            for _ in range(NUM_WORKERS):
+                executor.submit(_noop)
+            print(f"--- [Orchestrator] Warming up {NUM_WORKERS} workers in the background. ---")
+
+        print(f"--- [Orchestrator] Consuming stream '{job_queue.stream}' as '{job_queue.consumer}'. ---")
+        scheduler = FairScheduler(CONFIG.get('scheduler', {}))
+        provider_executor = init_provider_executor(INFERENCE_CONFIG.get('provider_concurrency', 64))
+        provider_futures = {}
+        failover_jobs = queue.Queue()
+        max_buffered = int(CONFIG.get('scheduler', {}).get('max_buffered_jobs') or 4 * NUM_WORKERS)
+        last_reclaim = 0.0
 
-        print("--- [Orchestrator] Starting main processing loop... ---")
-        
         while True:
-            completed_job_ids = []
-            for job_id, future in active_futures.items():
+            for entry_id, (future, user_id) in list(active_futures.items()):
                 if future.done():
-                    try:
-                        result_str = future.result()
-                        redis_client.set(f"result:{job_id}", result_str, ex=300)
-                        print(f"[Orchestrator] Job {job_id} completed successfully.")
-                    except Exception as exc:
-                        print(f"[Orchestrator] Job {job_id} failed with an exception: {exc}")
-                        error_result = json.dumps({'status': 'error', 'response': str(exc)})
-                        redis_client.set(f"result:{job_id}", error_result, ex=300)
-                    
-                    completed_job_ids.append(job_id)
-
-            for job_id in completed_job_ids:
-                del active_futures[job_id]
-
-            if len(active_futures) < NUM_WORKERS:
-                job_tuple_str = redis_client.lpop("job_queue")
-                if job_tuple_str:
-                    job_id, job_data_str = json.loads(job_tuple_str)
-                    print(f"[Orchestrator] Submitting job {job_id} to worker pool.")
-                    future = executor.submit(process_job, job_data_str)
-                    active_futures[job_id] = future
-            
-            time.sleep(0.1)
+                    scheduler.finished(user_id)
+                    del active_futures[entry_id]
+            provider_futures = {entry_id: future for entry_id, future in provider_futures.items() if not future.done()}
+            free_slots = NUM_WORKERS - len(active_futures)
+            try:
+                jobs = []
+                if time.time() - last_reclaim >= job_queue.claim_idle_ms / 2000:
+                    job_queue.keep_alive(list(active_futures) + list(provider_futures) + scheduler.entry_ids())
+                    if len(scheduler) < max_buffered:
+                        jobs = job_queue.reclaim(max_buffered - len(scheduler))
+                    last_reclaim = time.time()
+
+                # Read ahead of the free slots so the scheduler can choose between users.
+                if len(scheduler) + len(jobs) < max_buffered:
+                    idle = free_slots > 0 and len(scheduler) == 0 and not jobs
+                    jobs += job_queue.read(max_buffered - len(scheduler) - len(jobs), block=idle)
+            except redis.exceptions.ConnectionError as e:
+                print(f"[Orchestrator] WARNING: Lost connection to Redis: {e}")
+                time.sleep(1.0)
+                continue
+
+            while not failover_jobs.empty():
+                scheduler.push(failover_jobs.get())
+
+            for job in jobs:
+                if job['job_data'] is None:
+                    error_result = json.dumps({'status': 'error', 'response': 'The request failed repeatedly and was abandoned.'})
+                    store_result(redis_client, job['job_id'], error_result)
+                    release_user_job(redis_client, job['meta'].get('user_id'))
+                    continue
+                if job['meta'].get('kind') == 'summary':
+                    scheduler.push(job)
+                    continue
+                job_data = json.loads(job['job_data'])
+                target = resolve_target(job_data)
+                if target != 'local_system' and not PROVIDER_ROUTER.has_candidates(target) and local_fallback_allowed(job_data):
+                    job = fail_over_to_local(job)
+                elif target != 'local_system':
+                    # Provider jobs only wait on the network: run them beside the pool, not in it.
+                    if is_job_cancelled(redis_client, job['job_id']):
+                        print(f"[Orchestrator] Dropping cancelled job {job['job_id']}.")
+                        release_user_job(redis_client, job['meta'].get('user_id'))
+                        job_queue.ack(job['entry_id'])
+                        continue
+                    print(f"[Orchestrator] Submitting job {job['job_id']} to the provider executor.")
+                    future = provider_executor.submit(process_provider_job, job['job_data'])
+                    future.add_done_callback(functools.partial(complete_provider_job, redis_client, job_queue, failover_jobs, job))
+                    provider_futures[job['entry_id']] = future
+                    continue
+                scheduler.push(job)
+
+            dispatched = False
+            while len(active_futures) < NUM_WORKERS:
+                job = scheduler.pop()
+                if job is None:
+                    break
+                job_id, user_id = job['job_id'], job['meta'].get('user_id')
+                if is_job_cancelled(redis_client, job_id):
+                    print(f"[Orchestrator] Dropping cancelled job {job_id}.")
+                    scheduler.finished(user_id)
+                    release_user_job(redis_client, user_id)
+                    job_queue.ack(job['entry_id'])
+                    continue
+                print(f"[Orchestrator] Submitting job {job_id} (lane '{job['meta'].get('lane', 'interactive')}', user {user_id}) to worker pool.")
+                try:
+                    future = executor.submit(run_job, job['job_data'])
+                except BrokenProcessPool:
+                    # Unacked jobs stay pending and are reclaimed once the orchestrator restarts.
+                    print("--- [Orchestrator] FATAL: The worker pool is broken. Exiting. ---")
+                    sys.exit(1)
+                future.add_done_callback(functools.partial(complete_job, redis_client, job_queue, job))
+                active_futures[job['entry_id']] = (future, user_id)
+                dispatched = True
+
+            if active_futures and not dispatched and (len(active_futures) >= NUM_WORKERS or len(scheduler)):
+                # Nothing can start until a running job finishes: wait for one rather than polling.
+                wait([future for future, _ in active_futures.values()], timeout=job_queue.block_ms / 1000, return_when=FIRST_COMPLETED)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import yaml
 import os
 import json
+import redis
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
@@ -14,6 +15,7 @@ from datetime import datetime, timedelta
 
 from accounts.decorators import admin_required
 from chat.models import AgentPermission, ChatMessage, SFTExample
+from chat.views import get_worker_capacity
 from accounts.models import UserProfile 
 
 CONFIG_PATH = os.path.join(settings.BASE_DIR.parent, 'agent/configs/config.yaml')
@@ -23,6 +25,59 @@ AVAILABLE_AGENTS = list(CONFIG.get('agents', {}).keys())
 AGENTS_CONFIG = CONFIG.get('agents', {})
 ALL_SYSTEM_AGENTS = list(AGENTS_CONFIG.keys())
 ALL_PROVIDER_CONFIGS = CONFIG.get('providers', {})
+RESPONSE_CACHE_STATS_KEY = "response_cache:stats"
+
+
+def get_response_cache_stats() -> dict:
+    """Reads the response cache hit/miss counters the workers keep in Redis."""
+    try:
+        raw = settings.REDIS_CLIENT.hgetall(RESPONSE_CACHE_STATS_KEY)
+    except redis.exceptions.RedisError:
+        raw = {}
+    hits, misses = int(raw.get('hits', 0)), int(raw.get('misses', 0))
+    by_agent = []
+    agent_names = {field.split(':', 1)[1] for field in raw if field.startswith(('hits:', 'misses:'))}
+    for agent_name in agent_names:
+        agent_hits, agent_misses = int(raw.get(f'hits:{agent_name}', 0)), int(raw.get(f'misses:{agent_name}', 0))
+        by_agent.append({
+            'agent_name': agent_name,
+            'hits': agent_hits,
+            'misses': agent_misses,
+            'hit_rate': round(100 * agent_hits / (agent_hits + agent_misses), 1) if agent_hits + agent_misses else 0.0,
+        })
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(100 * hits / (hits + misses), 1) if hits + misses else 0.0,
+        'by_agent': sorted(by_agent, key=lambda item: (-item['hits'], -item['misses'], item['agent_name'])),
+    }
+
+
+def read_provider_settings(post_data, provider_keys, existing: dict = None) -> dict:
+    """
+    Builds a profile's provider_settings from the permission form. Blank numbers mean
+    "use the default"; keys the form doesn't edit are kept from `existing`.
+    """
+    existing = existing or {}
+    provider_settings = {}
+    for key in provider_keys:
+        rate_limit_str = post_data.get(f'rate_limit_{key}', '')
+        weight_str = post_data.get(f'priority_weight_{key}', '').strip()
+        max_jobs_str = post_data.get(f'max_concurrent_jobs_{key}', '')
+        try:
+            priority_weight = float(weight_str) if weight_str else None
+        except ValueError:
+            priority_weight = None
+
+        settings_for_key = dict(existing.get(key, {}))
+        settings_for_key.update({
+            'enabled': post_data.get(f'enabled_{key}') == 'on',
+            'rate_limit': int(rate_limit_str) if rate_limit_str.isdigit() else None,
+            'priority_weight': priority_weight if priority_weight and priority_weight > 0 else None,
+            'max_concurrent_jobs': int(max_jobs_str) if max_jobs_str.isdigit() and int(max_jobs_str) > 0 else None,
+        })
+        provider_settings[key] = settings_for_key
+    return provider_settings
 
 
 @login_required
@@ -46,19 +101,7 @@ def manage_user_permissions_view(request, user_id):
     all_configurable_providers.update(CONFIG['providers'])
 
     if request.method == 'POST':
-        new_provider_settings = {}
-        for key, details in all_configurable_providers.items():
-            is_enabled = request.POST.get(f'enabled_{key}') == 'on'
-            rate_limit_str = request.POST.get(f'rate_limit_{key}', '')
-            rate_limit = None
-            if rate_limit_str.isdigit() and int(rate_limit_str) >= 0:
-                rate_limit = int(rate_limit_str)
-            
-            new_provider_settings[key] = {
-                'enabled': is_enabled,
-                'rate_limit': rate_limit
-            }
-        profile.provider_settings = new_provider_settings
+        profile.provider_settings = read_provider_settings(request.POST, all_configurable_providers.keys(), profile.provider_settings)
         
         selected_local_agents = request.POST.getlist('local_agents')
         profile.enabled_local_agents = [agent for agent in selected_local_agents if agent in AVAILABLE_AGENTS]
@@ -80,7 +123,8 @@ def manage_user_permissions_view(request, user_id):
             'display_name': details['display_name'],
             'enabled': user_specific_settings_for_provider.get('enabled', False),
             'rate_limit': user_specific_settings_for_provider.get('rate_limit', default_rate_limit),
-
+            'priority_weight': user_specific_settings_for_provider.get('priority_weight'),
+            'max_concurrent_jobs': user_specific_settings_for_provider.get('max_concurrent_jobs'),
         }
 
     context = {
@@ -258,6 +302,8 @@ def analytics_dashboard_view(request):
         'usage_by_user': usage_by_user,
         'chart_labels': json.dumps(chart_labels),
         'chart_data': json.dumps(chart_data),
+        'response_cache': get_response_cache_stats(),
+        'worker_capacity': get_worker_capacity(),
         
         'all_users': all_users,
         'all_agents': all_used_agents,
@@ -297,17 +343,7 @@ def create_user_view(request):
                     all_configurable_providers = {'local_system': CONFIG['local_system']}
                     all_configurable_providers.update(CONFIG['providers'])
                     
-                    new_provider_settings = {}
-                    for key in all_configurable_providers.keys():
-                        is_enabled = request.POST.get(f'enabled_{key}') == 'on'
-                        rate_limit_str = request.POST.get(f'rate_limit_{key}', '')
-                        rate_limit = None
-                        if rate_limit_str.isdigit() and int(rate_limit_str) >= 0:
-                            rate_limit = int(rate_limit_str)
-                        
-                        new_provider_settings[key] = {'enabled': is_enabled, 'rate_limit': rate_limit}
-                    
-                    profile.provider_settings = new_provider_settings
+                    profile.provider_settings = read_provider_settings(request.POST, all_configurable_providers.keys(), profile.provider_settings)
                     
                     selected_local_agents = request.POST.getlist('local_agents')
                     profile.enabled_local_agents = [agent for agent in selected_local_agents if agent in ALL_SYSTEM_AGENTS]
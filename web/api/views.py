@@ -10,7 +10,7 @@ from datetime import datetime
 
 from .serializers import ConversationSerializer, UserSettingsSerializer
 from chat.models import Conversation, ChatMessage
-from chat.views import REDIS_CLIENT, MAX_QUEUE_LENGTH, format_chat_history_for_llm, ALL_SYSTEM_AGENTS, CONFIG
+from chat.views import REDIS_CLIENT, MAX_QUEUE_LENGTH, CANCEL_KEY_TTL, LOCAL_HISTORY_MESSAGES, PROVIDER_HISTORY_MESSAGES, format_chat_history_for_llm, get_async_redis_client, get_worker_capacity, get_queue_length, build_job_meta, build_local_fallback, enqueue_job, ALL_SYSTEM_AGENTS, CONFIG
 from accounts.models import UserProfile 
 
 async def get_agent_response(query, conversation, conversation_id, request):
@@ -62,13 +62,16 @@ async def get_agent_response(query, conversation, conversation_id, request):
             user_available_agents = [agent for agent in permitted_agents if agent in session_enabled_agents]
         else:
             user_available_agents = permitted_agents
-    recent_messages_qs = conversation.messages.exclude(role=ChatMessage.Role.LOG).order_by('-created_at')[:11]
+    local_fallback = {'allowed': False}
+    if model_selection != 'local_system':
+        local_fallback = await sync_to_async(build_local_fallback)(current_user.id, profile, is_admin, expert_settings)
+    recent_messages_qs = conversation.messages.exclude(role=ChatMessage.Role.LOG).order_by('-created_at')[:LOCAL_HISTORY_MESSAGES]
     recent_messages = await sync_to_async(list)(recent_messages_qs)
     recent_messages.reverse()
     chat_history_for_local = format_chat_history_for_llm(recent_messages) if recent_messages else ""
     chat_history_for_providers = [
         {"role": "user" if msg.role == "user" else "assistant", "content": msg.content}
-        for msg in recent_messages
+        for msg in recent_messages[-PROVIDER_HISTORY_MESSAGES:]
     ]
 
     job_payload = {
@@ -80,25 +83,40 @@ async def get_agent_response(query, conversation, conversation_id, request):
         'chat_history_for_local': chat_history_for_local,
         'chat_history_for_providers': chat_history_for_providers,
         'user_available_agents': user_available_agents,
+        'local_fallback': local_fallback,
         'user_feature_flags': profile.feature_flags, 
         'conversation_id': str(conversation_id),
     }
     
-    current_queue_length = await sync_to_async(REDIS_CLIENT.llen)("job_queue")
+    # API clients can mark bulk work as 'batch' so it yields to interactive requests.
+    lane = 'batch' if request.data.get('priority') == 'batch' else 'api'
+    job_meta = build_job_meta(current_user.id, profile, target_system_key, is_admin, lane)
+    if target_system_key == 'local_system':
+        # Provider jobs never reach a local worker, so only local jobs wait for one.
+        worker_capacity = await sync_to_async(get_worker_capacity)()
+        if worker_capacity['workers'] == 0:
+            raise Exception("No agent worker is ready yet. Please try again in a moment.")
+
+    current_queue_length = await sync_to_async(get_queue_length)()
     if current_queue_length >= MAX_QUEUE_LENGTH:
         raise Exception("The agent service is currently overloaded. Please try again shortly.")
     
-    await sync_to_async(REDIS_CLIENT.rpush)("job_queue", json.dumps([job_id, json.dumps(job_payload)]))
+    await sync_to_async(enqueue_job)(job_id, job_payload, job_meta)
     
     polling_timeout = 60
-    start_time = asyncio.get_event_loop().time()
-    while (asyncio.get_event_loop().time() - start_time) < polling_timeout:
-        result_str = await sync_to_async(REDIS_CLIENT.get)(f"result:{job_id}")
-        if result_str:
-            await sync_to_async(REDIS_CLIENT.delete)(f"result:{job_id}")
-            return json.loads(result_str)
-        await asyncio.sleep(1)
-    
+    async_redis = get_async_redis_client()
+    job_finished = False
+    try:
+        # The worker pushes the result onto this list, so BLPOP returns as soon as it is done.
+        popped = await async_redis.blpop(f"result:{job_id}", timeout=polling_timeout)
+        if popped:
+            job_finished = True
+            return json.loads(popped[1])
+    finally:
+        if not job_finished:
+            # The client disconnected or we timed out: tell the worker to stop generating.
+            await async_redis.set(f"cancel:{job_id}", 1, ex=CANCEL_KEY_TTL)
+        await async_redis.aclose()
     raise asyncio.TimeoutError("Request timed out waiting for agent.")
 
 
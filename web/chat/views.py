@@ -3,7 +3,10 @@ import os
 import yaml
 import asyncio
 import redis
+import redis.asyncio
+import time
 import uuid
+import weakref
 import markdown
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import StreamingHttpResponse, JsonResponse, HttpResponseForbidden
@@ -26,6 +29,55 @@ except redis.exceptions.ConnectionError:
     print("[Django] FATAL: Could not connect to Redis. Is the Redis server running?")
     REDIS_CLIENT = None
 MAX_QUEUE_LENGTH = 10
+CANCEL_KEY_TTL = 600
+WORKER_READY_KEY = "worker:ready"
+
+_ASYNC_REDIS_POOLS = weakref.WeakKeyDictionary()
+
+def get_async_redis_client():
+    """
+    Creates an asyncio Redis client on the current event loop's connection pool.
+    asyncio connections can't be shared across loops, so there is one pool per loop;
+    requests on the same loop reuse its connections instead of connecting per stream.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _ASYNC_REDIS_POOLS.get(loop)
+    if pool is None:
+        pool = redis.asyncio.ConnectionPool(**settings.REDIS_CONNECTION_KWARGS)
+        _ASYNC_REDIS_POOLS[loop] = pool
+    return redis.asyncio.Redis(connection_pool=pool)
+
+def get_worker_capacity() -> dict:
+    """
+    Sums the readiness heartbeats the agent workers keep in the `worker:ready` hash.
+    Each warmed-up worker refreshes its own entry; entries past their 'expires_at'
+    belong to dead workers and are removed.
+    """
+    workers = []
+    if REDIS_CLIENT is None:
+        return {'workers': 0, 'capacity': 0, 'active_jobs': 0}
+    try:
+        entries = REDIS_CLIENT.hgetall(WORKER_READY_KEY)
+    except redis.exceptions.RedisError:
+        entries = {}
+    now = time.time()
+    expired = []
+    for worker_id, value in entries.items():
+        worker = json.loads(value)
+        if worker.get('expires_at', 0) < now:
+            expired.append(worker_id)
+        else:
+            workers.append(worker)
+    if expired:
+        try:
+            REDIS_CLIENT.hdel(WORKER_READY_KEY, *expired)
+        except redis.exceptions.RedisError:
+            pass
+    return {
+        'workers': len(workers),
+        'capacity': sum(worker.get('capacity', 0) for worker in workers),
+        'active_jobs': sum(worker.get('active_jobs', 0) for worker in workers),
+    }
 
 PROJECT_ROOT = os.path.abspath(os.path.join(settings.BASE_DIR, '../agent'))
 print(PROJECT_ROOT)
@@ -33,6 +85,82 @@ CONFIG_PATH = PROJECT_ROOT + '/configs/config.yaml'
 with open(CONFIG_PATH, 'r') as f:
     CONFIG = yaml.safe_load(f)
 AGENTS_CONFIG = CONFIG.get('agents', {})
+# The local system packs and summarizes history itself, so it gets a longer window than providers.
+LOCAL_HISTORY_MESSAGES = CONFIG.get('context', {}).get('history_fetch_messages', 40)
+PROVIDER_HISTORY_MESSAGES = 11
+JOB_QUEUE_CONFIG = CONFIG.get('job_queue', {})
+JOB_STREAM = JOB_QUEUE_CONFIG.get('stream', 'jobs')
+JOB_GROUP = JOB_QUEUE_CONFIG.get('group', 'workers')
+MAX_QUEUED_JOBS_PER_USER = CONFIG.get('scheduler', {}).get('max_queued_jobs_per_user', 3)
+USER_JOBS_KEY_TTL = 600
+
+def get_queue_length() -> int:
+    """Jobs in the stream that no orchestrator has picked up yet."""
+    length = REDIS_CLIENT.xlen(JOB_STREAM)
+    try:
+        pending = REDIS_CLIENT.xpending(JOB_STREAM, JOB_GROUP)['pending']
+    except redis.exceptions.ResponseError:
+        # The consumer group is created by the first orchestrator to start.
+        pending = 0
+    return length - pending
+
+def build_local_fallback(user_id, profile, is_admin: bool, expert_settings: dict) -> dict:
+    """
+    Whether the worker may answer a provider job with the local system when no provider
+    is available: only if the user may use the local system and is under its daily
+    limit. The worker counts a fallback against that limit through 'rate_limit_key'.
+    """
+    rate_limit_key = None
+    if is_admin:
+        permitted_agents = ALL_SYSTEM_AGENTS
+    else:
+        local_settings = profile.provider_settings.get('local_system', {})
+        if not local_settings.get('enabled', False):
+            return {'allowed': False}
+        rate_limit = local_settings.get('rate_limit')
+        if rate_limit is None:
+            rate_limit = CONFIG.get('local_system', {}).get('default_rate_limit')
+        if rate_limit is not None and rate_limit > 0:
+            rate_limit_key = f"rate_limit:{user_id}:local_system:{datetime.utcnow().strftime('%Y-%m-%d')}"
+            current_usage = REDIS_CLIENT.get(rate_limit_key)
+            if current_usage and int(current_usage) >= rate_limit:
+                return {'allowed': False}
+        permitted_agents = profile.enabled_local_agents
+
+    session_enabled_agents = expert_settings.get('enabled_agents')
+    if session_enabled_agents is not None:
+        permitted_agents = [agent for agent in permitted_agents if agent in session_enabled_agents]
+    return {'allowed': True, 'available_agents': list(permitted_agents), 'rate_limit_key': rate_limit_key}
+
+def build_job_meta(user_id, profile, target_system_key: str, is_admin: bool, lane: str) -> dict:
+    """
+    Scheduling hints for the orchestrator's fair scheduler: the job's priority lane and
+    the user's weight and concurrency cap from their settings for the target system.
+    """
+    system_settings = profile.provider_settings.get(target_system_key, {})
+    return {
+        'user_id': user_id,
+        'lane': 'admin' if is_admin else lane,
+        'weight': system_settings.get('priority_weight') or 1,
+        'max_concurrent': system_settings.get('max_concurrent_jobs'),
+    }
+
+def enqueue_job(job_id: str, job_payload: dict, meta: dict):
+    """
+    Queues a job unless its user already has MAX_QUEUED_JOBS_PER_USER jobs waiting or
+    running. The orchestrator takes finished jobs off the `user_jobs:{user_id}` count.
+    """
+    user_jobs_key = f"user_jobs:{meta['user_id']}"
+    queued = REDIS_CLIENT.incr(user_jobs_key)
+    if queued < 1:
+        # The count expired while jobs were still running and went negative.
+        REDIS_CLIENT.set(user_jobs_key, 1)
+        queued = 1
+    REDIS_CLIENT.expire(user_jobs_key, USER_JOBS_KEY_TTL)
+    if queued > MAX_QUEUED_JOBS_PER_USER and meta['lane'] != 'admin':
+        REDIS_CLIENT.decr(user_jobs_key)
+        raise Exception(f"You already have {MAX_QUEUED_JOBS_PER_USER} requests in progress. Please wait for one to finish.")
+    REDIS_CLIENT.xadd(JOB_STREAM, {'job': json.dumps([job_id, json.dumps(job_payload)]), 'meta': json.dumps(meta)})
 
 ALL_SYSTEM_AGENTS = list(AGENTS_CONFIG.keys())
 ALL_PROVIDER_CONFIGS = CONFIG.get('providers', {})
@@ -55,11 +183,12 @@ def format_chat_history_for_llm(messages):
 
     Returns:
         A list of dictionaries, where each dictionary has 'role' and 'content' keys.
+        Messages also carry their 'id' so the worker can track which turns are summarized.
         Example:
         [
             {"role": "system", "content": "This is the previous conversation history. Based on this, please respond to the user."},
-            {"role": "user", "content": "Hello!"},
-            {"role": "assistant", "content": "Hi there!"},
+            {"role": "user", "content": "Hello!", "id": "..."},
+            {"role": "assistant", "content": "Hi there!", "id": "..."},
             # ...
         ]
     """
@@ -72,12 +201,14 @@ def format_chat_history_for_llm(messages):
         if msg.role == ChatMessage.Role.USER:
             formatted_history.append({
                 "role": "user",
-                "content": msg.content
+                "content": msg.content,
+                "id": str(msg.id)
             })
         elif msg.role == ChatMessage.Role.AGENT:
             formatted_history.append({
                 "role": "assistant",
-                "content": msg.content
+                "content": msg.content,
+                "id": str(msg.id)
             })
 
     return formatted_history
@@ -178,8 +309,9 @@ def save_expert_settings_view(request):
 @login_required
 async def process_chat_view(request, conversation_id):
     """
-    Handles an incoming chat query by placing it on the Redis queue
-    and then streaming back the results by polling Redis.
+    Handles an incoming chat query by placing it on the Redis queue,
+    relaying streamed tokens from the worker's pub/sub channel and
+    finally sending the stored result.
     """
     if not REDIS_CLIENT:
         async def error_stream():
@@ -247,13 +379,16 @@ async def process_chat_view(request, conversation_id):
                     user_available_agents = [agent for agent in permitted_agents if agent in session_enabled_agents]
                 else:
                     user_available_agents = permitted_agents
-            recent_messages_qs = conversation.messages.exclude(role=ChatMessage.Role.LOG).order_by('-created_at')[:11]
+            local_fallback = {'allowed': False}
+            if model_selection != 'local_system':
+                local_fallback = await sync_to_async(build_local_fallback)(current_user.id, profile, is_admin, expert_settings)
+            recent_messages_qs = conversation.messages.exclude(role=ChatMessage.Role.LOG).order_by('-created_at')[:LOCAL_HISTORY_MESSAGES]
             recent_messages = await sync_to_async(list)(recent_messages_qs)
             recent_messages.reverse()
             chat_history_for_local = format_chat_history_for_llm(recent_messages) if recent_messages else ""
             chat_history_for_providers = [
                 {"role": "user" if msg.role == "user" else "assistant", "content": msg.content}
-                for msg in recent_messages
+                for msg in recent_messages[-PROVIDER_HISTORY_MESSAGES:]
             ]
 
             job_payload = {
@@ -265,39 +400,73 @@ async def process_chat_view(request, conversation_id):
                 'chat_history_for_local': chat_history_for_local,
                 'chat_history_for_providers': chat_history_for_providers,
                 'user_available_agents': user_available_agents,
+                'local_fallback': local_fallback,
                 'user_feature_flags': profile.feature_flags, 
                 'conversation_id': str(conversation_id),
             }
             
-            current_queue_length = await sync_to_async(REDIS_CLIENT.llen)("job_queue")
+            job_meta = build_job_meta(current_user.id, profile, target_system_key, is_admin, 'interactive')
+            queued_status = ""
+            if target_system_key == 'local_system':
+                # Provider jobs never reach a local worker, so only local jobs wait for one.
+                worker_capacity = await sync_to_async(get_worker_capacity)()
+                ready_workers = worker_capacity['workers']
+                if ready_workers == 0:
+                    raise Exception("No agent worker is ready yet. Please try again in a moment.")
+                queued_status = f", {ready_workers} workers ready"
+
+            current_queue_length = await sync_to_async(get_queue_length)()
             if current_queue_length >= MAX_QUEUE_LENGTH:
                 raise Exception("The agent service is currently overloaded. Please try again shortly.")
-            
-            await sync_to_async(REDIS_CLIENT.rpush)("job_queue", json.dumps([job_id, json.dumps(job_payload)]))
-            yield f"data: {json.dumps({'type': 'log', 'content': f'Request queued (Position: {current_queue_length + 1})'})}\n\n"
-            
-            polling_timeout = 600
-            start_time = asyncio.get_event_loop().time()
-            while (asyncio.get_event_loop().time() - start_time) < polling_timeout:
-                result_str = await sync_to_async(REDIS_CLIENT.get)(f"result:{job_id}")
-                if result_str:
-                    result_data = json.loads(result_str)
-                    if result_data['status'] == 'complete':
-                        final_msg = await sync_to_async(ChatMessage.objects.create)(
-                            conversation=conversation, role=ChatMessage.Role.AGENT,
-                            content=result_data['response'], agent_name=result_data['agent_name']
-                        )
-                        final_msg.content = mark_safe(markdown.markdown(final_msg.content))
-                        yield f"data: {json.dumps({'type': 'final_answer', 'content': mark_safe(markdown.markdown(result_data['response'])), 'agent_name': result_data['agent_name'], 'id': str(final_msg.id)})}\n\n"
-                    else:
-                        yield f"data: {json.dumps({'type': 'error', 'content': mark_safe(markdown.markdown(result_data['response']))})}\n\n"
-
-                    await sync_to_async(REDIS_CLIENT.delete)(f"result:{job_id}")
-                    break
+
+            # Subscribe before queueing so no streamed tokens are missed.
+            async_redis = get_async_redis_client()
+            pubsub = async_redis.pubsub()
+            await pubsub.subscribe(f"job_stream:{job_id}")
+            job_finished = False
+            try:
+                await sync_to_async(enqueue_job)(job_id, job_payload, job_meta)
+                yield f"data: {json.dumps({'type': 'log', 'content': f'Request queued (Position: {current_queue_length + 1}{queued_status})'})}\n\n"
                 
-                await asyncio.sleep(1)
-            else: 
-                yield f"data: {json.dumps({'type': 'error', 'content': 'The request timed out while waiting for an agent to become available.'})}\n\n"
+                polling_timeout = 600
+                start_time = asyncio.get_event_loop().time()
+                while (asyncio.get_event_loop().time() - start_time) < polling_timeout:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=5.0)
+                    if message:
+                        event = json.loads(message['data'])
+                        if event['type'] == 'token':
+                            yield f"data: {json.dumps({'type': 'token', 'content': event['content']})}\n\n"
+                        elif event['type'] == 'agent':
+                            yield f"data: {json.dumps({'type': 'agent', 'agent_name': event['agent_name']})}\n\n"
+                        if event['type'] != 'result':
+                            continue
+
+                    # The worker pushes the result and then announces it; without an
+                    # announcement this is only a cheap check in case one was missed.
+                    result_str = await async_redis.lpop(f"result:{job_id}")
+                    if result_str:
+                        result_data = json.loads(result_str)
+                        if result_data['status'] == 'complete':
+                            final_msg = await sync_to_async(ChatMessage.objects.create)(
+                                conversation=conversation, role=ChatMessage.Role.AGENT,
+                                content=result_data['response'], agent_name=result_data['agent_name']
+                            )
+                            final_msg.content = mark_safe(markdown.markdown(final_msg.content))
+                            yield f"data: {json.dumps({'type': 'final_answer', 'content': mark_safe(markdown.markdown(result_data['response'])), 'agent_name': result_data['agent_name'], 'id': str(final_msg.id)})}\n\n"
+                        else:
+                            yield f"data: {json.dumps({'type': 'error', 'content': mark_safe(markdown.markdown(result_data['response']))})}\n\n"
+
+                        job_finished = True
+                        break
+                else: 
+                    yield f"data: {json.dumps({'type': 'error', 'content': 'The request timed out while waiting for an agent to become available.'})}\n\n"
+            finally:
+                if not job_finished:
+                    # The client disconnected or we timed out: tell the worker to stop generating.
+                    await async_redis.set(f"cancel:{job_id}", 1, ex=CANCEL_KEY_TTL)
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+                await async_redis.aclose()
 
         except (PermissionDenied, Exception) as e:
             yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
@@ -143,17 +143,37 @@ chatForm.addEventListener('submit', function(e) {
     const eventSource = new EventSource(`/chat/process/${conversationId}/?query=${encodeURIComponent(query)}`);
     let connectionClosedCleanly = false;
     let agentMessageDiv = null;
+    let streamingAgentName = '';
+    let streamingMessageDiv = null;
+    let streamedText = '';
     eventSource.onmessage = function(event) {
         const data = JSON.parse(event.data);
-        hideTypingIndicator()
         
         if (data.type === 'done') {
+            hideTypingIndicator();
             connectionClosedCleanly = true;
             eventSource.close();
             enableInput();
             return; // Stop processing
         }
-        if (data.type === 'final_answer') {
+        if (data.type === 'agent') {
+            streamingAgentName = data.agent_name;
+        } else if (data.type === 'token') {
+            // Show tokens as plain text while streaming; the final answer replaces them with rendered HTML.
+            hideTypingIndicator();
+            if (!streamingMessageDiv) {
+                appendMessage('', 'agent', streamingAgentName);
+                streamingMessageDiv = chatContainer.lastElementChild;
+            }
+            streamedText += data.content;
+            streamingMessageDiv.querySelector('.text').textContent = streamedText;
+            chatContainer.scrollTop = chatContainer.scrollHeight;
+        } else if (data.type === 'final_answer') {
+            hideTypingIndicator();
+            if (streamingMessageDiv) {
+                streamingMessageDiv.remove();
+                streamingMessageDiv = null;
+            }
             if (agentMessageDiv) {
                 // This case is unlikely with current backend but good for robustness
                 agentMessageDiv.querySelector('.text').innerText = data.content;
@@ -164,6 +184,7 @@ chatForm.addEventListener('submit', function(e) {
             // We're not displaying logs on the frontend anymore, but you could add a log div here
             console.log('Log:', data.content);
         } else if (data.type === 'error') {
+            hideTypingIndicator();
             appendMessage(`Error: ${data.content}`, 'agent', 'System');
             connectionClosedCleanly = true;
             eventSource.close();
@@ -201,10 +201,12 @@ RQ_QUEUES = {
 }
 
 
-REDIS_CLIENT = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=int(os.getenv('REDIS_PORT', 6379)),
-    db=int(os.getenv('REDIS_DB', 0)),
-    password=os.getenv('REDIS_PASSWORD'), 
-    decode_responses=True
-)
\ No newline at end of file
+REDIS_CONNECTION_KWARGS = {
+    'host': os.getenv('REDIS_HOST', 'localhost'),
+    'port': int(os.getenv('REDIS_PORT', 6379)),
+    'db': int(os.getenv('REDIS_DB', 0)),
+    'password': os.getenv('REDIS_PASSWORD'),
+    'decode_responses': True,
+}
+
+REDIS_CLIENT = redis.Redis(**REDIS_CONNECTION_KWARGS)